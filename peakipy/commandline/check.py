@@ -47,9 +47,7 @@ import os
 from sys import exit
 from pathlib import Path
 
-import pandas as pd
 import numpy as np
-import nmrglue as ng
 import matplotlib.pyplot as plt
 from colorama import Fore, init
 
@@ -64,15 +62,12 @@ from matplotlib.widgets import Button
 
 from peakipy.core import (
     make_mask,
-    pvoigt2d,
-    voigt2d,
-    pv_pv,
-    pv_g,
-    pv_l,
-    gaussian_lorentzian,
+    lineshapes,
     Pseudo3D,
     run_log,
     read_config,
+    read_table,
+    read_pipe,
 )
 
 columns_to_print = [
@@ -89,6 +84,21 @@ columns_to_print = [
     "lineshape",
 ]
 
+# columns needed to simulate the fitted lineshapes (missing ones are skipped)
+columns_to_simulate = [
+    "center_x",
+    "center_y",
+    "sigma_x",
+    "sigma_y",
+    "fraction",
+    "fraction_x",
+    "fraction_y",
+    "gamma_x",
+    "gamma_y",
+    "x_radius",
+    "y_radius",
+]
+
 
 def check_input(args):
     """ validate commandline input """
@@ -100,8 +110,7 @@ def check_input(args):
                 error=Fore.RED + f"{args['<fits>']} should exist and be readable",
             ),
             "<nmrdata>": And(
-                os.path.exists,
-                ng.pipe.read,
+                read_pipe,
                 error=Fore.RED
                 + f"{args['<nmrdata>']} either does not exist or is not an NMRPipe format 2D or 3D",
             ),
@@ -148,7 +157,13 @@ def main(argv):
     args = docopt(__doc__, argv=argv)
     args = check_input(args)
     fits = Path(args.get("<fits>"))
-    fits = pd.read_csv(fits)
+    # only load the columns that are plotted or printed
+    try:
+        fits = read_table(
+            fits, columns=columns_to_print + columns_to_simulate, categories=True
+        )
+    except ImportError as e:
+        exit(Fore.RED + f"🤔 {e}")
 
     # get dims from config file
     config_path = Path("peakipy.config")
@@ -157,7 +172,7 @@ def main(argv):
     dims = args.get("--dims")
     colors = args.get("colors")
     data_path = args.get("<nmrdata>")
-    dic, data = ng.pipe.read(data_path)
+    dic, data = read_pipe(data_path)
     pseudo3D = Pseudo3D(dic, data, dims)
 
     outname = args.get("--outname")
@@ -219,13 +234,12 @@ def main(argv):
         if len(fits) < 1:
             exit(f"Are you sure clusters {clusters} exist?")
 
-    groups = fits.groupby("clustid")
+    # all peaks of a fit share one lineshape
+    if fits.lineshape.nunique() > 1:
+        exit(Fore.RED + f"Found more than one lineshape in {args['<fits>']}")
+    lineshape = lineshapes[fits.lineshape.iloc[0]]
 
-    # make plotting meshes
-    x = np.arange(pseudo3D.f2_size)
-    y = np.arange(pseudo3D.f1_size)
-    XY = np.meshgrid(x, y)
-    X, Y = XY
+    groups = fits.groupby("clustid")
 
     with PdfPages(outname) as pdf:
 
@@ -242,8 +256,6 @@ def main(argv):
                 )
             )
 
-            mask = np.zeros((pseudo3D.f1_size, pseudo3D.f2_size), dtype=bool)
-
             first_plane = group[group.plane == selected_plane]
 
             x_radius = group.x_radius.max()
@@ -270,6 +282,11 @@ def main(argv):
             if max_x > pseudo3D.f2_size:
                 max_x = pseudo3D.f2_size
 
+            # everything below is local to the cluster bounding box
+            x = np.arange(min_x, max(min_x, max_x))
+            y = np.arange(min_y, max(min_y, max_y))
+            X, Y = np.meshgrid(x, y)
+            mask = np.zeros(X.shape, dtype=bool)
             masks = []
             # make masks
             for cx, cy, rx, ry, name in zip(
@@ -280,81 +297,35 @@ def main(argv):
                 first_plane.assignment,
             ):
 
-                tmp_mask = make_mask(mask, cx, cy, rx, ry)
+                tmp_mask = make_mask(mask, cx - min_x, cy - min_y, rx, ry)
                 mask += tmp_mask
                 masks.append(tmp_mask)
 
-            # generate simulated data
-            for plane_id, plane in group.groupby("plane"):
-                sim_data_singles = []
-                sim_data = np.zeros((pseudo3D.f1_size, pseudo3D.f2_size))
-                shape = sim_data.shape
-                try:
-                    for amp, c_x, c_y, s_x, s_y, frac_x, frac_y, ls in zip(
-                        plane.amp,
-                        plane.center_x,
-                        plane.center_y,
-                        plane.sigma_x,
-                        plane.sigma_y,
-                        plane.fraction_x,
-                        plane.fraction_y,
-                        plane.lineshape,
-                    ):
-
-                        sim_data_i = pv_pv(
-                            XY, amp, c_x, c_y, s_x, s_y, frac_x, frac_y
-                        ).reshape(shape)
-                        sim_data += sim_data_i
-                        sim_data_singles.append(sim_data_i)
-                except:
-                    for amp, c_x, c_y, s_x, s_y, frac, ls in zip(
-                        plane.amp,
-                        plane.center_x,
-                        plane.center_y,
-                        plane.sigma_x,
-                        plane.sigma_y,
-                        plane.fraction,
-                        plane.lineshape,
-                    ):
-                        # print(amp)
-                        if (ls == "G") or (ls == "L") or (ls == "PV"):
-                            sim_data_i = pvoigt2d(
-                                XY, amp, c_x, c_y, s_x, s_y, frac
-                            ).reshape(shape)
-                        elif ls == "PV_L":
-                            sim_data_i = pv_l(
-                                XY, amp, c_x, c_y, s_x, s_y, frac
-                            ).reshape(shape)
-
-                        elif ls == "PV_G":
-                            sim_data_i = pv_g(
-                                XY, amp, c_x, c_y, s_x, s_y, frac
-                            ).reshape(shape)
-
-                        elif ls == "G_L":
-                            sim_data_i = gaussian_lorentzian(
-                                XY, amp, c_x, c_y, s_x, s_y, frac
-                            ).reshape(shape)
-
-                        elif ls == "V":
-                            sim_data_i = voigt2d(
-                                XY, amp, c_x, c_y, s_x, s_y, frac
-                            ).reshape(shape)
-                        sim_data += sim_data_i
-                        sim_data_singles.append(sim_data_i)
-
-                masked_data = pseudo3D.data[plane_id].copy()
-                masked_sim_data = sim_data.copy()
+            # simulate every peak of every plane of the cluster at once
+            # (a stable sort keeps the peaks of each plane in the order of masks)
+            group = group.sort_values("plane", kind="mergesort")
+            plane_ids, plane_index = np.unique(
+                group.plane.to_numpy(), return_inverse=True
+            )
+            sim_singles = lineshape.simulate(group, x, y)
+            sim_planes = np.zeros((len(plane_ids),) + X.shape)
+            np.add.at(sim_planes, plane_index, sim_singles)
+            # only read the bounding box of each plane
+            data_window = pseudo3D.data[
+                :, min_y : min_y + len(y), min_x : min_x + len(x)
+            ]
+
+            for num, (plane_id, plane) in enumerate(group.groupby("plane")):
+                sim_data_singles = list(sim_singles[plane_index == num])
+                masked_data = np.array(data_window[plane_id], dtype=float)
+                sim_plot = sim_planes[num]
                 masked_data[~mask] = np.nan
-                masked_sim_data[~mask] = np.nan
+                sim_plot[~mask] = np.nan
 
                 fig = plt.figure(figsize=(10, 6))
                 ax = fig.add_subplot(111, projection="3d")
-                # slice out plot area
-                x_plot = pseudo3D.uc_f2.ppm(X[min_y:max_y, min_x:max_x])
-                y_plot = pseudo3D.uc_f1.ppm(Y[min_y:max_y, min_x:max_x])
-                masked_data = masked_data[min_y:max_y, min_x:max_x]
-                sim_plot = masked_sim_data[min_y:max_y, min_x:max_x]
+                x_plot = pseudo3D.axis_f2.ppm(X)
+                y_plot = pseudo3D.axis_f1.ppm(Y)
                 # or len(masked_data)<1 or len(sim_plot)<1
 
                 if len(x_plot) < 1 or len(y_plot) < 1:
@@ -401,10 +372,6 @@ def main(argv):
                         # for making colored masks
                         for single_mask, single in zip(masks, sim_data_singles):
                             single[~single_mask] = np.nan
-                        sim_data_singles = [
-                            sim_data_single[min_y:max_y, min_x:max_x]
-                            for sim_data_single in sim_data_singles
-                        ]
                         #  for plotting single fit surfaces
                         single_colors = [
                             cm.viridis(i)
@@ -6,7 +6,7 @@
 
     Arguments:
         <peaklist>  peaklist output from read_peaklist.py (csv, tab or pkl)
-        <data>      NMRPipe data
+        <data>      NMRPipe data (single file, filename template or directory of planes)
 
     Options:
         --dims=<id,f1,f2>  order of dimensions [default: 0,1,2]
@@ -42,7 +42,6 @@ from colorama import Fore, init
 
 init(autoreset=True)
 
-import nmrglue as ng
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.cm import magma, autumn, viridis
@@ -72,9 +71,9 @@ from bokeh.models.widgets import (
 from bokeh.plotting import figure
 
 from bokeh.server.server import Server
-from bokeh.palettes import PuBuGn9, Category20
+from bokeh.palettes import PuBuGn9
 
-from peakipy.core import run_log, LoadData
+from peakipy.core import run_log, LoadData, write_table, cluster_colors, read_pipe
 
 log_style = "overflow:scroll;"
 log_div = """<div style=%s>%s</div>"""
@@ -202,7 +201,8 @@ class BokehScript:
     def setup_save_buttons(self):
         # save file
         self.savefilename = TextInput(
-            title="Save file as (.csv)", placeholder="edited_peaks.csv"
+            title="Save file as (.csv, .tab, .parquet, .feather, .h5, .npz or .pkl)",
+            placeholder="edited_peaks.csv",
         )
         self.button = Button(label="Save", button_type="success")
         self.button.on_event(ButtonClick, self.save_peaks)
@@ -388,19 +388,13 @@ class BokehScript:
         self.fit_reports = ""
         self.fit_reports_div = Div(text="", height=400, style={"overflow": "scroll"})
         # Plane selection
-        self.select_planes_list = [
-            f"{i}"
-            for i in range(self.peakipy_data.data.shape[self.peakipy_data.planes])
-        ]
+        self.select_planes_list = [f"{i}" for i in range(self.peakipy_data.n_planes)]
         self.select_plane = Select(
             title="Select plane:",
             value=self.select_planes_list[0],
             options=self.select_planes_list,
         )
-        self.select_planes_dic = {
-            f"{i}": i
-            for i in range(self.peakipy_data.data.shape[self.peakipy_data.planes])
-        }
+        self.select_planes_dic = {f"{i}": i for i in range(self.peakipy_data.n_planes)}
         self.select_plane.on_change("value", self.update_contour)
 
         self.checkbox_group = CheckboxGroup(
@@ -548,14 +542,12 @@ class BokehScript:
 
     def update_memcnt(self):
 
-        for ind, group in self.peakipy_data.df.groupby("CLUSTID"):
-            self.peakipy_data.df.loc[group.index, "MEMCNT"] = len(group)
+        self.peakipy_data.df["MEMCNT"] = self.peakipy_data.df.groupby(
+            "CLUSTID"
+        ).CLUSTID.transform("size")
 
         # set cluster colors (set to black if singlet peaks)
-        self.peakipy_data.df["color"] = self.peakipy_data.df.apply(
-            lambda x: Category20[20][int(x.CLUSTID) % 20] if x.MEMCNT > 1 else "black",
-            axis=1,
-        )
+        self.peakipy_data.df["color"] = cluster_colors(self.peakipy_data.df)
         # change color of excluded peaks
         include_no = self.peakipy_data.df.include == "no"
         self.peakipy_data.df.loc[include_no, "color"] = "ghostwhite"
@@ -622,10 +614,11 @@ class BokehScript:
             print(f"Making backup {to_save}.bak")
 
         print(Fore.GREEN + f"Saving peaks to {to_save}")
-        if to_save.suffix == ".csv":
-            self.peakipy_data.df.to_csv(to_save, float_format="%.4f", index=False)
-        else:
-            self.peakipy_data.df.to_pickle(to_save)
+        try:
+            write_table(self.peakipy_data.df, to_save)
+        except ImportError as e:
+            # keep the server running so the peaks can be saved in another format
+            print(Fore.RED + f"🤔 {e}")
 
     def select_callback(self, attrname, old, new):
         # print(Fore.RED + "Calling Select Callback")
@@ -651,8 +644,8 @@ class BokehScript:
         index = self.peakipy_data.df.INDEX.max() + 1
         x_ppm = event.x
         y_ppm = event.y
-        x_axis = self.peakipy_data.uc_f2.f(x_ppm, "ppm")
-        y_axis = self.peakipy_data.uc_f1.f(y_ppm, "ppm")
+        x_axis = self.peakipy_data.axis_f2.pts(x_ppm)
+        y_axis = self.peakipy_data.axis_f1.pts(y_ppm)
         xw_hz = 20.0
         yw_hz = 20.0
         xw = xw_hz * self.peakipy_data.pt_per_hz_f2
@@ -879,8 +872,7 @@ def check_input(args):
                 + f"{args['<peaklist>']} should exist and be readable .csv file",
             ),
             "<data>": And(
-                os.path.exists,
-                ng.pipe.read,
+                read_pipe,
                 error=Fore.RED
                 + f"{args['<data>']} either does not exist or is not an NMRPipe format 2D or 3D",
             ),
@@ -902,7 +894,10 @@ def main(args):
     from bokeh.util.browser import view
 
     run_log()
-    bs = BokehScript(args)
+    try:
+        bs = BokehScript(args)
+    except ImportError as e:
+        sys.exit(Fore.RED + f"🤔 {e}")
     server = Server({"/edit": bs.init})
     server.start()
     print(Fore.GREEN + "Opening peakipy: Edit fits on http://localhost:5006/edit")
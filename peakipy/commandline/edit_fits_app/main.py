@@ -36,7 +36,6 @@ from docopt import docopt
 from pathlib import Path
 
 import pandas as pd
-import nmrglue as ng
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.cm import magma, autumn
@@ -71,7 +70,7 @@ from bokeh.plotting import figure
 from bokeh.io import curdoc
 from bokeh.palettes import PuBuGn9, Category20
 
-from peakipy.core import Pseudo3D
+from peakipy.core import Pseudo3D, read_pipe
 
 
 def clusters(
@@ -360,7 +359,7 @@ else:
 
 # read pipe data
 data_path = args.get("<data>")
-dic, data = ng.pipe.read(data_path)
+dic, data = read_pipe(data_path)
 pseudo3D = Pseudo3D(dic, data, dims)
 data = pseudo3D.data
 udic = pseudo3D.udic
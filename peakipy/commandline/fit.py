@@ -6,10 +6,14 @@
 
     Arguments:
         <peaklist>                                  peaklist output from read_peaklist.py
-        <data>                                      2D or pseudo3D NMRPipe data (single file)
+        <data>                                      2D or pseudo3D NMRPipe data (single file, filename
+                                                    template e.g. planes/test%03d.ft2 or directory of planes)
         <output>                                    output peaklist "<output>.csv" will output CSV
-                                                    format file, "<output>.tab" will give a tab delimited output
-                                                    while "<output>.pkl" results in Pandas pickle of DataFrame
+                                                    format file, "<output>.tab" will give a tab delimited output,
+                                                    "<output>.parquet", "<output>.feather", "<output>.h5" and
+                                                    "<output>.npz" give typed columnar outputs (parquet and
+                                                    feather need pyarrow, h5 needs pytables) while
+                                                    "<output>.pkl" results in Pandas pickle of DataFrame
 
     Options:
         -h --help                                   Show this page
@@ -34,13 +38,56 @@
         --exclude_plane=<int>                       Specific plane(s) to fit [default: -1]
                                                     eg. --plane=1 or --plane=1,4,5
 
+        --global                                    Fit all planes of each cluster at once with shared
+                                                    centers, linewidths and fractions and separate
+                                                    amplitudes for each plane (--fix is ignored)
+
+        --decay=<model>                             Decay model for amplitudes in --global fits (None or exp)
+                                                    exp fits amp0 * exp(-rate * vclist) for each peak
+                                                    and requires a vclist [default: None]
+
+        --engine=<engine>                           Fitting engine (lmfit or direct). direct uses
+                                                    scipy.optimize.least_squares with settings taken from
+                                                    "least_squares" in peakipy.config [default: lmfit]
+
+        --nnls                                      Constrain amplitudes to be positive when only
+                                                    amplitudes are fitted to each plane (see --fix)
+
+        --block_size=<n_planes>                     Read and fit <n_planes> planes at a time to limit memory use
+                                                    for long series. All clusters are fitted to each block of
+                                                    planes before the next is read (not used with --global)
+                                                    [default: None]
+
         --nomp                                      Do not use multiprocessing
 
+        --spool=<dir>                               Queue clusters as tasks in <dir> (on a filesystem shared
+                                                    with other hosts) to be fitted by "peakipy worker <dir>"
+                                                    processes as well as this one [default: None]
+
+        --no-cache                                  Refit every cluster instead of reusing results cached
+                                                    from previous runs with unchanged data and settings
+
         --plot=<dir>                                Whether to plot wireframe fits for each peak
                                                     (saved into <dir>) [default: None]
 
         --show                                      Whether to show (using plt.show()) wireframe
-                                                    fits for each peak. Only works if --plot is also selected
+                                                    fits for each peak. Only works if --plot and --nomp are
+                                                    also selected
+
+        --plot_style=<style>                        3d wireframes of data and fit or cheaper 2d heatmaps of
+                                                    the residuals with contours of data and fit [default: 3d]
+
+        --plot_flagged                              Only plot clusters whose fits need checking (slope of
+                                                    simulated vs measured intensities outside 0.95-1.05)
+
+        --plot_workers=<n>                          Number of processes rendering plots while the clusters
+                                                    are fitted [default: 1]
+
+        --resume                                    Skip clusters that were already fitted by an interrupted
+                                                    run with the same inputs (recorded in <output>.journal)
+
+        --workspace=<dir>                           Save the peaks and fit results of each task to a
+                                                    new directory created inside <dir> [default: None]
 
         --verb                                      Print what's going on
 
@@ -66,30 +113,60 @@
 """
 import sys
 import os
+import time
+import uuid
+import pickle
+import shutil
+import socket
+import tempfile
+import threading
+import traceback
+from contextlib import contextmanager
 from pathlib import Path
-from multiprocessing import cpu_count, Pool
+from multiprocessing import cpu_count, Pool, get_context
+from concurrent.futures import ProcessPoolExecutor
 
-import nmrglue as ng
 import numpy as np
 import pandas as pd
 
 from docopt import docopt
+from lmfit import fit_report as lmfit_fit_report
 from colorama import Fore, init
 
 from tabulate import tabulate
-from skimage.filters import threshold_otsu
 from schema import Schema, And, Or, Use, SchemaError
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8 (SharedArray falls back to memory mapped temporary files)
+    shared_memory = None
+
 from peakipy.core import (
     fix_params,
     get_params,
     fit_first_plane,
+    cluster_window,
+    FitCache,
+    hash_inputs,
+    import_optional,
+    categorize,
+    table_formats,
+    write_table,
+    fit_amplitudes,
+    fit_global,
+    only_amplitudes_vary,
     LoadData,
     run_log,
     read_config,
-    voigt2d,
-    pvoigt2d,
-    pv_pv,
+    set_voigt_accuracy,
+    lineshapes,
+    read_pipe,
+    Planes,
+    plane_noise,
+    data_signature,
+    fit_quality,
+    qc_columns,
 )
 
 # colorama
@@ -97,10 +174,6 @@ init(autoreset=True)
 # some constants
 π = np.pi
 sqrt2 = np.sqrt(2.0)
-# temp and log paths
-tmp_path = Path("tmp")
-tmp_path.mkdir(exist_ok=True)
-log_path = Path("log.txt")
 # for printing dataframes
 column_selection = ["INDEX", "ASS", "X_PPM", "Y_PPM", "CLUSTID", "MEMCNT"]
 
@@ -119,62 +192,194 @@ def check_xybounds(x):
 # prepare data for multiprocessing
 
 
-def chunks(l, n):
-    """ split list into n chunks
+def cluster_costs(peaklist, n_planes):
+    """ Estimate the relative cost of fitting each cluster
 
-        will return empty lists if n > len(l)
+        The fit of the summed planes scales with the number of mask pixels
+        times the number of parameters (and iterations), and each plane is then
+        refitted over the same pixels.
 
-        :param l: list of values you wish to split
-        :type l: list
-        :param n: number of sub lists you want to generate
-        :type n: int
+        :param peaklist: Peaklist data generated by peakipy read or edit scripts
+        :type peaklist: pandas.DataFrame
+        :param n_planes: number of planes to fit
+        :type n_planes: int
 
-        :returns sub_lists: list of lists
-        :rtype sub_lists: list
+        :returns costs: estimated cost indexed by CLUSTID
+        :rtype costs: pandas.Series
     """
-    # create n empty lists
-    sub_lists = [[] for _ in range(n)]
-    # append into n lists
-    for num, i in enumerate(l):
-        sub_lists[num % n].append(i)
-    return sub_lists
+    pixels = np.pi * peaklist.X_RADIUS * peaklist.Y_RADIUS
+    groups = pixels.groupby(peaklist.CLUSTID)
+    n_peaks = groups.size()
+    return groups.sum() * n_peaks * (n_peaks + n_planes)
 
 
-def split_peaklist(peaklist, n_cpu, tmp_path=tmp_path):
-    """ split peaklist into smaller files based on number of cpus
+def schedule_clusters(peaklist, n_planes, n_workers, batches_per_worker=4):
+    """ Group clusters into tasks ordered by decreasing cost
+
+        Clusters are dispatched largest first (longest processing time first)
+        so that the expensive clusters do not end up at the end of a run.
+        Cheap clusters (typically singlets) are batched together until a batch
+        costs about 1/(n_workers * batches_per_worker) of the total to limit
+        the overhead of sending many tiny tasks.
 
         :param peaklist: Peaklist data generated by peakipy read or edit scripts
         :type peaklist: pandas.DataFrame
+        :param n_planes: number of planes to fit
+        :type n_planes: int
+        :param n_workers: number of worker processes
+        :type n_workers: int
+        :param batches_per_worker: target number of tasks per worker
+        :type batches_per_worker: int
+
+        :returns tasks: list of CLUSTID lists
+        :rtype tasks: list
+    """
+    costs = cluster_costs(peaklist, n_planes).sort_values(
+        ascending=False, kind="mergesort"
+    )
+    target = costs.sum() / (n_workers * batches_per_worker)
+    tasks = []
+    batch = []
+    batch_cost = 0.0
+    for clustid, cost in costs.items():
+        if cost >= target:
+            tasks.append([clustid])
+            continue
+        batch.append(clustid)
+        batch_cost += cost
+        if batch_cost >= target:
+            tasks.append(batch)
+            batch = []
+            batch_cost = 0.0
+    if batch:
+        tasks.append(batch)
+    return tasks
+
+
+def make_workspace(parent):
+    """ Create a unique directory for the temporary files of a run
+
+        :param parent: directory in which to create the workspace
+        :type parent: pathlib.Path
+
+        :returns workspace: path to new directory
+        :rtype workspace: pathlib.Path
+    """
+    parent = Path(parent)
+    parent.mkdir(parents=True, exist_ok=True)
+    return Path(tempfile.mkdtemp(prefix="fit_", dir=parent))
+
+
+class SharedArray:
+    """ Read-only view of a numpy array held in shared memory
+
+        Pickling only sends the name of the shared memory block so the array
+        is attached (not copied) when passed to worker processes. The process
+        that created the block should call :meth:`unlink` once it is finished.
+        Where multiprocessing.shared_memory is not available (python < 3.8)
+        the array is held in a memory mapped temporary file instead.
+
+        :param array: array to copy into shared memory
+        :type array: numpy.array
 
-        :returns tmp_path: Temporary directory path
-        :rtype tmp_path: pathlib.Path
     """
-    # clustid numbers
-    clustids = peaklist.CLUSTID.unique()
-    # make n_cpu lists of clusters
-    clustids = chunks(clustids, n_cpu)
-    for i in range(n_cpu):
-        # get sub dataframe containing ith clustid list
-        split_peaks = peaklist[peaklist.CLUSTID.isin(clustids[i])]
-        # save sub dataframe
-        split_peaks.to_csv(tmp_path / f"peaks_{i}.csv", index=False)
-    return tmp_path
+
+    def __init__(self, array: np.array):
+        array = np.asarray(array)
+        size = max(array.nbytes, 1)
+        if shared_memory is None:
+            fd, self._name = tempfile.mkstemp(prefix="peakipy_shared_")
+            os.ftruncate(fd, size)
+            os.close(fd)
+            self._shm = None
+            self._buffer = np.memmap(self._name, dtype=np.uint8, mode="r+")
+        else:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self._name = self._shm.name
+            self._buffer = self._shm.buf
+        self._shape = array.shape
+        self._dtype = array.dtype
+        self._array = np.ndarray(self._shape, dtype=self._dtype, buffer=self._buffer)
+        self._array[:] = array
+        self._array.flags.writeable = False
+
+    @classmethod
+    def attach(cls, name: str, shape: tuple, dtype: str):
+        """ Attach to an existing shared memory block (or temporary file) """
+        shared = cls.__new__(cls)
+        shared._name = name
+        if shared_memory is None:
+            shared._shm = None
+            shared._buffer = np.memmap(name, dtype=np.uint8, mode="r")
+        else:
+            shared._shm = shared_memory.SharedMemory(name=name)
+            shared._buffer = shared._shm.buf
+        shared._shape = shape
+        shared._dtype = np.dtype(dtype)
+        shared._array = np.ndarray(shape, dtype=shared._dtype, buffer=shared._buffer)
+        shared._array.flags.writeable = False
+        return shared
+
+    def __reduce__(self):
+        return (
+            SharedArray.attach,
+            (self._name, self._shape, self._dtype.str),
+        )
+
+    @property
+    def array(self):
+        return self._array
+
+    def unlink(self):
+        """ Release the shared memory block """
+        self._array = None
+        self._buffer = None
+        if self._shm is None:
+            os.remove(self._name)
+        else:
+            self._shm.close()
+            self._shm.unlink()
 
 
 class FitPeaksInput:
-    """ input data for the fit_peaks function """
+    """ input data for the fit_peaks function
+
+        data and summed_planes can be given as :class:`SharedArray` to avoid
+        copying the spectrum into each worker process. data can also be
+        memory mapped :class:`peakipy.core.Planes` which workers reopen from
+        the file.
+
+    """
 
-    def __init__(self, args: dict, data: np.array, config: dict, plane_numbers: list):
+    def __init__(
+        self,
+        args: dict,
+        data: np.array,
+        config: dict,
+        plane_numbers: list,
+        summed_planes: np.array = None,
+    ):
 
         self._data = data
         self._args = args
         self._config = config
         self._plane_numbers = plane_numbers
+        self._summed_planes = summed_planes
 
     @property
     def data(self):
+        if isinstance(self._data, SharedArray):
+            return self._data.array
         return self._data
 
+    @property
+    def summed_planes(self):
+        if self._summed_planes is None:
+            self._summed_planes = self.data.sum(axis=0)
+        if isinstance(self._summed_planes, SharedArray):
+            return self._summed_planes.array
+        return self._summed_planes
+
     @property
     def args(self):
         return self._args
@@ -189,12 +394,16 @@ class FitPeaksInput:
 
 
 class FitPeaksResult:
-    """ Result of fitting a set of peaks """
+    """ Result of fitting a set of peaks
+
+        plots holds a FitPlot of each cluster to be plotted (see --plot)
+    """
 
-    def __init__(self, df: pd.DataFrame, log: str):
+    def __init__(self, df: pd.DataFrame, log: str, plots=None):
 
         self._df = df
         self._log = log
+        self._plots = [] if plots is None else plots
 
     @property
     def df(self):
@@ -204,6 +413,720 @@ class FitPeaksResult:
     def log(self):
         return self._log
 
+    @property
+    def plots(self):
+        return self._plots
+
+
+class ResultWriter:
+    """ Write fit results to the output as they arrive
+
+        CSV (.csv) and tab separated (.tab) results are appended to
+        <output>.part and flushed after each batch so that finished clusters
+        can be inspected (and are kept) during long runs. Parquet (.parquet)
+        results are appended as row groups of about row_group_size rows. The
+        file is renamed to <output> when the writer is closed. Other formats
+        (see :func:`peakipy.core.write_table`) can only be written once all
+        results are in.
+
+        :param output: output path
+        :type output: pathlib.Path
+        :param row_group_size: rows per parquet row group
+        :type row_group_size: int
+
+    """
+
+    def __init__(self, output, row_group_size=65536):
+        self.output = Path(output)
+        self.part = self.output.with_name(self.output.name + ".part")
+        self.suffix = self.output.suffix
+        self.sep = {".csv": ",", ".tab": "\t"}.get(self.suffix)
+        self.row_group_size = row_group_size
+        self._columns = None
+        self._frames = []
+        self._rows = 0
+        self._parquet_writer = None
+        if self.sep is not None:
+            self._file = open(self.part, "w")
+        elif self.suffix == ".parquet":
+            self._pyarrow = import_optional("pyarrow", self.suffix)
+            import_optional("pyarrow.parquet", self.suffix)
+        elif table_formats.get(self.suffix) is not None:
+            # fail before fitting rather than when the results are written
+            import_optional(table_formats[self.suffix], self.suffix)
+
+    def write(self, df: pd.DataFrame):
+        """ Write batch of results """
+        if self.sep is None:
+            self._frames.append(df)
+            self._rows += len(df)
+            if self.suffix == ".parquet" and self._rows >= self.row_group_size:
+                self._write_row_group()
+            return
+        header = self._columns is None
+        if header:
+            self._columns = list(df.columns)
+        df.to_csv(
+            self._file,
+            sep=self.sep,
+            float_format="%.4f",
+            index=False,
+            header=header,
+            columns=self._columns,
+        )
+        self._file.flush()
+
+    def _write_row_group(self):
+        pa = self._pyarrow
+        df = categorize(pd.concat(self._frames, ignore_index=True))
+        if self._parquet_writer is None:
+            schema = pa.Table.from_pandas(df, preserve_index=False).schema
+            # strings of all row groups share one dictionary type
+            schema = pa.schema(
+                [
+                    pa.field(f.name, pa.dictionary(pa.int32(), pa.string()))
+                    if pa.types.is_dictionary(f.type)
+                    else f
+                    for f in schema
+                ],
+                metadata=schema.metadata,
+            )
+            self._parquet_writer = pa.parquet.ParquetWriter(self.part, schema)
+        table = pa.Table.from_pandas(
+            df, schema=self._parquet_writer.schema, preserve_index=False
+        )
+        self._parquet_writer.write_table(table)
+        self._frames = []
+        self._rows = 0
+
+    def close(self):
+        """ Finish writing output """
+        if self.sep is not None:
+            self._file.close()
+            os.replace(self.part, self.output)
+        elif self.suffix == ".parquet" and (self._frames or self._parquet_writer):
+            if self._frames:
+                self._write_row_group()
+            self._parquet_writer.close()
+            os.replace(self.part, self.output)
+        else:
+            df = pd.concat(self._frames, ignore_index=True) if self._frames else None
+            write_table(pd.DataFrame(df), self.output)
+
+    def abort(self):
+        """ Stop writing without renaming <output>.part to <output>
+
+            Results that were already written are kept in <output>.part.
+        """
+        if self.sep is not None:
+            self._file.close()
+        elif self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+
+class Journal:
+    """ Record of finished clusters used to resume interrupted fits
+
+        The first record holds a key identifying the inputs of the run
+        (peaklist, data and fit settings) and each following record the
+        results of a batch of finished clusters. Records are length prefixed
+        pickles that are flushed to disk as they are appended, so at most a
+        partially written last record is lost (and ignored) after a crash.
+
+        :param path: journal file
+        :type path: pathlib.Path
+        :param key: hash of the inputs of the run
+        :type key: str
+
+    """
+
+    def __init__(self, path, key: str):
+        self.path = Path(path)
+        self.key = key
+        self._file = None
+
+    @staticmethod
+    def _records(f):
+        """ Read records until the end of the file or a truncated record """
+        while True:
+            size = f.read(8)
+            if len(size) < 8:
+                return
+            data = f.read(int.from_bytes(size, "little"))
+            try:
+                record = pickle.loads(data)
+            except Exception:
+                return
+            yield f.tell(), record
+
+    def _append(self, record):
+        data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.write(len(data).to_bytes(8, "little") + data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def resume(self):
+        """ Load results from the journal and continue appending to it
+
+            :returns: results of finished clusters or None if the journal is
+                      missing or was written for different inputs
+            :rtype: list
+        """
+        results = []
+        end = 0
+        try:
+            with open(self.path, "rb") as f:
+                for offset, record in self._records(f):
+                    if end == 0 and record != self.key:
+                        return None
+                    if end > 0:
+                        results.append(record)
+                    end = offset
+        except FileNotFoundError:
+            return None
+        if end == 0:
+            return None
+        self._file = open(self.path, "r+b")
+        # drop partially written record
+        self._file.truncate(end)
+        self._file.seek(end)
+        return results
+
+    def start(self):
+        """ Start a new journal """
+        self._file = open(self.path, "wb")
+        self._append(self.key)
+
+    def append(self, result: FitPeaksResult):
+        """ Record result of finished clusters (without plots) """
+        self._append(FitPeaksResult(df=result.df, log=result.log))
+
+    def close(self):
+        """ Close journal, keeping it to resume from (see --resume) """
+        self._file.close()
+
+    def remove(self):
+        """ Close and delete journal once the output is complete """
+        self._file.close()
+        self.path.unlink()
+
+
+class PlotRenderer:
+    """ Render plots of the fits in a separate pool of processes
+
+        Plots are submitted as FitPlot objects as soon as their clusters are
+        fitted and saved as <plot_path>/<CLUSTID>.png with the Agg backend, so
+        fitting does not wait for plotting.
+
+        :param plot_path: directory to save the plots in
+        :type plot_path: pathlib.Path
+        :param style: 3d or 2d (see :meth:`peakipy.core.FitPlot.draw`)
+        :type style: str
+        :param n_workers: number of rendering processes
+        :type n_workers: int
+
+    """
+
+    def __init__(self, plot_path, style="3d", n_workers=1):
+        self.plot_path = Path(plot_path)
+        self.style = style
+        # spawned so that no state (e.g. threads) of the fitting process is inherited
+        self._executor = ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=get_context("spawn")
+        )
+        self._futures = []
+        self.n_plots = 0
+
+    def submit(self, plots):
+        """ Queue plots for rendering """
+        for plot in plots:
+            self._futures.append(
+                self._executor.submit(plot.render, self.plot_path, self.style)
+            )
+            self.n_plots += 1
+        # raise errors of finished plots early
+        pending = []
+        for future in self._futures:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self._futures = pending
+
+    def close(self):
+        """ Wait for all plots to be rendered """
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._executor.shutdown()
+
+
+# peaklist and fit input of the current worker process (see init_worker)
+_worker_peaks = None
+_worker_input = None
+
+
+def init_worker(peaks: pd.DataFrame, fit_input: FitPeaksInput):
+    """ Pool initializer storing the peaklist and fit input in each worker
+
+        :param peaks: peaklist for all clusters to be fitted
+        :type peaks: pd.DataFrame
+        :param fit_input: fit input with data held in shared memory
+        :type fit_input: FitPeaksInput
+
+    """
+    global _worker_peaks, _worker_input
+    _worker_peaks = peaks
+    _worker_input = fit_input
+
+
+def fit_clusters(clustids):
+    """ Fit clusters in a worker process set up with :func:`init_worker`
+
+        :param clustids: CLUSTID of each cluster to fit
+        :type clustids: list
+
+        :returns: fitted results and log
+        :rtype: FitPeaksResult
+    """
+    peaks = _worker_peaks[_worker_peaks.CLUSTID.isin(clustids)]
+    return fit_peaks(peaks, _worker_input)
+
+
+def iter_pool(peaks: pd.DataFrame, fit_input: FitPeaksInput, tasks, n_workers):
+    """ Fit tasks in a pool of worker processes
+
+        The data is shared with the workers through shared memory (or
+        reopened from the file by each worker if it is memory mapped) and the
+        results of each task are yielded as soon as it is finished.
+
+        :param peaks: peaklist for all clusters to be fitted
+        :type peaks: pd.DataFrame
+        :param fit_input: fit input
+        :type fit_input: FitPeaksInput
+        :param tasks: list of CLUSTID lists (see :func:`schedule_clusters`)
+        :type tasks: list
+        :param n_workers: number of worker processes
+        :type n_workers: int
+
+        :returns: generator of fitted results for each task
+        :rtype: FitPeaksResult
+    """
+    if isinstance(fit_input.data, Planes) and fit_input.data.mapped:
+        shared_data = fit_input.data
+    else:
+        shared_data = SharedArray(np.asarray(fit_input.data))
+    shared_summed_planes = SharedArray(fit_input.summed_planes)
+    shared_input = FitPeaksInput(
+        fit_input.args,
+        shared_data,
+        fit_input.config,
+        fit_input.plane_numbers,
+        shared_summed_planes,
+    )
+    try:
+        with Pool(
+            processes=n_workers,
+            initializer=init_worker,
+            initargs=(peaks, shared_input),
+        ) as pool:
+            yield from pool.imap_unordered(fit_clusters, tasks)
+    finally:
+        if isinstance(shared_data, SharedArray):
+            shared_data.unlink()
+        shared_summed_planes.unlink()
+
+
+class SpoolError(Exception):
+    """ Fitting a task failed in a spool worker (the message holds its traceback) """
+
+
+class Spool:
+    """ Queue of fitting tasks in a directory on a shared filesystem
+
+        The coordinator (``peakipy fit --spool=<dir>``) saves the data as .npy
+        files along with the peaklist and fit settings and writes one file per
+        task to todo/. Workers (``peakipy worker <dir>``) claim a task by
+        renaming it into claimed/ (only one rename can succeed), fit it against
+        a memmap of the data and write the result to done/ (or the traceback
+        to failed/).
+
+        Claims are leases: the worker touches its claim file while fitting
+        (see :meth:`hold`) and the coordinator moves claims that have not
+        been touched for lease seconds, or whose worker process on this host
+        has died, back to todo/ (see :meth:`requeue`).
+
+        :param path: spool directory
+        :type path: str or pathlib.Path
+        :param lease: seconds after which a claim that is not renewed expires
+                      (the coordinator's lease is passed on to the workers)
+        :type lease: float
+
+    """
+
+    def __init__(self, path, lease=60.0):
+        self.path = Path(path)
+        self.lease = lease
+        self._collected = set()
+        self.todo = self.path / "todo"
+        self.claimed = self.path / "claimed"
+        self.done = self.path / "done"
+        self.failed = self.path / "failed"
+
+    @staticmethod
+    def _write(path, value):
+        """ Pickle value so that it appears atomically at path """
+        tmp_path = path.with_name(f".{path.name}.{socket.gethostname()}.{os.getpid()}")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def clear(self):
+        """ Remove all files of the current run """
+        for directory in (self.todo, self.claimed, self.done, self.failed):
+            shutil.rmtree(directory, ignore_errors=True)
+        for name in ("run", "input.pkl", "data.npy", "summed_planes.npy"):
+            try:
+                (self.path / name).unlink()
+            except FileNotFoundError:
+                pass
+
+    def open(self, peaks: pd.DataFrame, fit_input: FitPeaksInput, tasks: list):
+        """ Queue tasks for a new run
+
+            :param peaks: peaklist for all clusters to be fitted
+            :type peaks: pd.DataFrame
+            :param fit_input: fit input
+            :type fit_input: FitPeaksInput
+            :param tasks: list of CLUSTID lists (see :func:`schedule_clusters`)
+            :type tasks: list
+
+        """
+        self.clear()
+        self._collected = set()
+        for directory in (self.todo, self.claimed, self.done, self.failed):
+            directory.mkdir(parents=True, exist_ok=True)
+        # written plane by plane so the data is never held in memory at once
+        data = np.lib.format.open_memmap(
+            self.path / "data.npy",
+            mode="w+",
+            dtype=fit_input.data.dtype,
+            shape=fit_input.data.shape,
+        )
+        for num, plane in enumerate(fit_input.data):
+            data[num] = plane
+        data.flush()
+        del data
+        np.save(self.path / "summed_planes.npy", fit_input.summed_planes)
+        run_id = uuid.uuid4().hex
+        self._write(
+            self.path / "input.pkl",
+            {
+                "run_id": run_id,
+                "peaks": peaks,
+                "args": fit_input.args,
+                "config": fit_input.config,
+                "plane_numbers": fit_input.plane_numbers,
+                "lease": self.lease,
+            },
+        )
+        for num, clustids in enumerate(tasks):
+            self._write(self.todo / f"{num:06d}.pkl", (run_id, num, list(clustids)))
+        # written last so workers know the run is complete
+        (self.path / "run").write_text(run_id)
+
+    def close(self):
+        """ Remove the files of the current run """
+        self.clear()
+
+    def load_input(self):
+        """ Load the peaklist and fit input with the data memory mapped
+
+            :returns: run id, peaklist and fit input
+            :rtype: tuple
+        """
+        inputs = self._read(self.path / "input.pkl")
+        self.lease = inputs["lease"]
+        fit_input = FitPeaksInput(
+            inputs["args"],
+            np.load(self.path / "data.npy", mmap_mode="r"),
+            inputs["config"],
+            inputs["plane_numbers"],
+            np.load(self.path / "summed_planes.npy", mmap_mode="r"),
+        )
+        return inputs["run_id"], inputs["peaks"], fit_input
+
+    def claim(self):
+        """ Claim the next task
+
+            :returns: path of claimed task and (run id, task number, CLUSTIDs)
+                      or None if there are no tasks left
+            :rtype: tuple
+        """
+        for path in sorted(self.todo.glob("*.pkl")):
+            claimed = self.claimed / f"{path.stem}.{socket.gethostname()}.{os.getpid()}"
+            try:
+                os.rename(path, claimed)
+                # the lease starts now rather than when the task was queued
+                os.utime(claimed)
+                return claimed, self._read(claimed)
+            except OSError:
+                # claimed by another worker (or requeued before the lease started)
+                continue
+        return None
+
+    @contextmanager
+    def hold(self, claimed):
+        """ Renew the lease of a claim while the task is being fitted """
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.lease / 4):
+                try:
+                    os.utime(claimed)
+                except FileNotFoundError:
+                    # requeued or finished
+                    return
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def requeue(self):
+        """ Move expired claims and claims of dead workers back to todo/
+
+            :returns: number of requeued tasks
+            :rtype: int
+        """
+        n_requeued = 0
+        host = socket.gethostname()
+        now = time.time()
+        for path in self.claimed.iterdir():
+            # claims are named <task>.<host>.<pid> (host names may contain dots)
+            name, _, pid = path.name.rpartition(".")
+            stem, _, claim_host = name.partition(".")
+            try:
+                expired = now - path.stat().st_mtime > self.lease
+            except FileNotFoundError:
+                continue
+            if not expired and claim_host == host:
+                expired = not pid_alive(int(pid))
+            if expired:
+                try:
+                    os.rename(path, self.todo / f"{stem}.pkl")
+                except OSError:
+                    # finished in the meantime
+                    continue
+                n_requeued += 1
+        return n_requeued
+
+    @staticmethod
+    def _release(claimed):
+        try:
+            claimed.unlink()
+        except FileNotFoundError:
+            # the claim expired and was requeued
+            pass
+
+    def finish(self, claimed, num, result: FitPeaksResult):
+        """ Save result of a claimed task """
+        self._write(self.done / f"{num:06d}.pkl", result)
+        self._release(claimed)
+
+    def fail(self, claimed, num, error: str):
+        """ Save traceback of a failed task """
+        (self.failed / f"{num:06d}.txt").write_text(error)
+        self._release(claimed)
+
+    def run_id(self):
+        """ Id of the current run or None if no run is queued """
+        try:
+            return (self.path / "run").read_text()
+        except FileNotFoundError:
+            return None
+
+    def pending(self):
+        """ True if there are unclaimed tasks """
+        return any(self.todo.glob("*.pkl"))
+
+    def failures(self):
+        """ Tracebacks of failed tasks """
+        return [path.read_text() for path in sorted(self.failed.glob("*.txt"))]
+
+    def collect(self):
+        """ Load and remove the results of finished tasks
+
+            Results of requeued tasks that were finished more than once are
+            only yielded once.
+
+            :returns: generator of results
+            :rtype: FitPeaksResult
+        """
+        for path in sorted(self.done.glob("*.pkl")):
+            result = self._read(path)
+            path.unlink()
+            if path.stem in self._collected:
+                continue
+            self._collected.add(path.stem)
+            yield result
+
+
+def pid_alive(pid):
+    """ Whether a process with this pid is running on this host
+
+        Always True where this can not be checked (i.e. not on POSIX)
+    """
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def fit_task(spool: Spool, task, inputs=None):
+    """ Fit a claimed task and save the result (or traceback) to the spool
+
+        :param spool: spool the task was claimed from
+        :type spool: Spool
+        :param task: claimed task returned by :meth:`Spool.claim`
+        :type task: tuple
+        :param inputs: inputs of the previous task (see :meth:`Spool.load_input`)
+        :type inputs: tuple
+
+        :returns: inputs of this task to reuse for the next one
+        :rtype: tuple
+    """
+    claimed, (run_id, num, clustids) = task
+    if inputs is None or inputs[0] != run_id:
+        inputs = spool.load_input()
+    if inputs[0] != run_id:
+        # task left over from a replaced run
+        claimed.unlink()
+        return inputs
+    _, peaks, fit_input = inputs
+    try:
+        with spool.hold(claimed):
+            result = fit_peaks(peaks[peaks.CLUSTID.isin(clustids)], fit_input)
+    except Exception:
+        spool.fail(claimed, num, traceback.format_exc())
+    else:
+        spool.finish(claimed, num, result)
+    return inputs
+
+
+def work_spool(spool: Spool, once: bool = False, poll: float = 1.0):
+    """ Fit tasks queued in a spool
+
+        :param spool: spool to take tasks from
+        :type spool: Spool
+        :param once: return once all tasks of the current (or next) run have been
+                     claimed instead of waiting for new runs
+        :type once: bool
+        :param poll: seconds to wait between checks for new tasks
+        :type poll: float
+
+        :returns: number of tasks fitted
+        :rtype: int
+    """
+    n_fitted = 0
+    inputs = None
+    seen_run = False
+    while True:
+        current_run = spool.run_id()
+        seen_run = seen_run or current_run is not None
+        task = spool.claim()
+        if task is None:
+            # a run that was seen is either finished or has no tasks left
+            if once and seen_run and (current_run is None or not spool.pending()):
+                return n_fitted
+            time.sleep(poll)
+            continue
+        inputs = fit_task(spool, task, inputs)
+        n_fitted += 1
+
+
+def iter_spool(spool: Spool, peaks: pd.DataFrame, fit_input: FitPeaksInput, tasks):
+    """ Queue tasks in a spool, help fit them and yield results as they finish
+
+        :param spool: spool shared with ``peakipy worker`` processes
+        :type spool: Spool
+        :param peaks: peaklist for all clusters to be fitted
+        :type peaks: pd.DataFrame
+        :param fit_input: fit input
+        :type fit_input: FitPeaksInput
+        :param tasks: list of CLUSTID lists (see :func:`schedule_clusters`)
+        :type tasks: list
+
+        :returns: generator of fitted results for each task
+        :rtype: FitPeaksResult
+
+        :raises SpoolError: if a task failed
+    """
+    spool.open(peaks, fit_input, tasks)
+    n_collected = 0
+    inputs = None
+    try:
+        while n_collected < len(tasks):
+            failed = spool.failures()
+            if failed:
+                raise SpoolError("Fitting failed in spool worker:\n" + failed[0])
+            for result in spool.collect():
+                n_collected += 1
+                yield result
+            # the coordinator also fits tasks so a run completes even without workers
+            task = spool.claim()
+            if task is not None:
+                inputs = fit_task(spool, task, inputs)
+            elif n_collected < len(tasks):
+                # put tasks of dead workers back in the queue
+                if spool.requeue():
+                    print(Fore.YELLOW + "Requeued tasks of unresponsive spool workers")
+                else:
+                    time.sleep(0.1)
+    finally:
+        spool.close()
+
+
+def fit_settings(fit_input: FitPeaksInput):
+    """ Everything other than the peaks and data that changes the fit results
+
+        :param fit_input: fit input
+        :type fit_input: FitPeaksInput
+
+        :returns: list of settings
+        :rtype: list
+    """
+    decay = fit_input.args.get("--decay", "None")
+    return [
+        fit_input.args.get("lineshape"),
+        fit_input.args.get("to_fix"),
+        fit_input.args.get("xy_bounds"),
+        fit_input.args.get("noise"),
+        fit_input.plane_numbers,
+        fit_input.args.get("--global"),
+        decay,
+        fit_input.args.get("vclist_data") if decay == "exp" else None,
+        fit_input.args.get("--engine", "lmfit"),
+        fit_input.args.get("--nnls"),
+        fit_input.config.get("fit_method", "leastsq"),
+        fit_input.config.get("least_squares"),
+        fit_input.config.get("voigt_terms", 16),
+    ]
+
 
 def fit_peaks(peaks: pd.DataFrame, fit_input: FitPeaksInput):
     """ Fit set of peak clusters to lineshape model
@@ -217,19 +1140,54 @@ def fit_peaks(peaks: pd.DataFrame, fit_input: FitPeaksInput):
         :returns: Data structure containing pd.DataFrame with the fitted results and a log
         :rtype: FitPeaksResult
     """
+    results = list(iter_fit_peaks(peaks, fit_input))
+    if not results:
+        return FitPeaksResult(df=pd.DataFrame(), log="")
+    df = pd.concat([i.df for i in results], ignore_index=True)
+    return FitPeaksResult(
+        df=df,
+        log="".join(i.log for i in results),
+        plots=[plot for i in results for plot in i.plots],
+    )
+
+
+def iter_fit_peaks(peaks: pd.DataFrame, fit_input: FitPeaksInput):
+    """ Fit set of peak clusters to lineshape model one cluster at a time
+
+        :param peaks: peaklist with generated by peakipy read or edit
+        :type peaks: pd.DataFrame
+
+        :param fit_input: Data structure containing input parameters (args, config and NMR data)
+        :type fit_input: FitPeaksInput
+
+        :returns: generator of fitted results and log for each cluster
+        :rtype: FitPeaksResult
+    """
     # sum planes for initial fit
-    summed_planes = fit_input.data.sum(axis=0)
+    summed_planes = fit_input.summed_planes
 
     # group peaks based on CLUSTID
     groups = peaks.groupby("CLUSTID")
     # setup arguments
     to_fix = fit_input.args.get("to_fix")
-    noise = fit_input.args.get("noise")
+    # noise of each plane (the planes are weighted by 1/noise)
+    noise = np.asarray(fit_input.args.get("noise"), dtype=float)
+    # noise of the sum of the planes
+    summed_noise = np.sqrt(np.sum(noise ** 2))
     verb = fit_input.args.get("verb")
     lineshape = fit_input.args.get("lineshape")
     xy_bounds = fit_input.args.get("xy_bounds")
     vclist = fit_input.args.get("vclist")
+    vclist_data = fit_input.args.get("vclist_data")
+    decay = fit_input.args.get("--decay", "None")
     uc_dics = fit_input.args.get("uc_dics")
+    plot_path = fit_input.args.get("plot")
+    # plots are shown as the clusters are fitted or else passed on for rendering
+    show = fit_input.args.get("--show") and fit_input.args.get("--nomp")
+    plot_flagged = fit_input.args.get("--plot_flagged")
+    plots = {}
+    # number of terms in voigt approximation (set here for spawned workers)
+    set_voigt_accuracy(fit_input.config.get("voigt_terms", 16))
 
     # for saving data, currently not using errs for center and sigma
     amps = []
@@ -261,6 +1219,13 @@ def fit_peaks(peaks: pd.DataFrame, fit_input: FitPeaksInput):
     else:
         fractions = []
 
+    if decay == "exp":
+        # decay model parameters from global fits
+        amp0s = []
+        amp0_errs = []
+        rates = []
+        rate_errs = []
+
     # lists for saving data
     names = []
     assign = []
@@ -277,146 +1242,11 @@ def fit_peaks(peaks: pd.DataFrame, fit_input: FitPeaksInput):
     redchis = []
     aics = []
     res_sum = []
+    # fit quality of each plane and of the summed planes
+    quality_columns = {k: [] for k in qc_columns}
+    summed_quality_columns = {k: [] for k in qc_columns}
 
-    # iterate over groups of peaks
-    out_str = ""
-    for name, group in groups:
-        #  max cluster size
-        len_group = len(group)
-        if len_group <= fit_input.args.get("max_cluster_size"):
-            if len_group == 1:
-                peak_str = "peak"
-            else:
-                peak_str = "peaks"
-
-            out_str += f"""
-
-            ####################################
-            Fitting cluster of {len_group} {peak_str}
-            ####################################
-            """
-            # fits sum of all planes first
-            fit_result = fit_first_plane(
-                group,
-                summed_planes,
-                # norm(summed_planes),
-                uc_dics,
-                lineshape=lineshape,
-                xy_bounds=xy_bounds,
-                verbose=verb,
-                noise=noise,
-                fit_method=fit_input.config.get("fit_method", "leastsq"),
-            )
-            fit_result.plot(
-                plot_path=fit_input.args.get("plot"),
-                show=fit_input.args.get("--show"),
-                nomp=fit_input.args.get("--nomp"),
-            )
-            # jack_knife_result = fit_result.jackknife()
-            # print("JackKnife", jack_knife_result.mean, jack_knife_result.std)
-            first = fit_result.out
-            mask = fit_result.mask
-            #            log.write(
-            out_str += fit_result.fit_str
-            out_str += f"""
-        ------------------------------------
-                   Summed planes
-        ------------------------------------
-        {first.fit_report()}
-                        """
-            #            )
-            # fix sigma center and fraction parameters
-            # could add an option to select params to fix
-            if len(to_fix) == 0 or to_fix == "None":
-                float_str = "Floating all parameters"
-                if verb:
-                    print(float_str)
-                pass
-            else:
-                to_fix = to_fix
-                float_str = f"Fixing parameters: {to_fix}"
-                if verb:
-                    print(float_str)
-                fix_params(first.params, to_fix)
-            out_str += float_str + "\n"
-
-            for num, d in enumerate(fit_input.data):
-                plane_number = fit_input.plane_numbers[num]
-                first.fit(
-                    data=d[mask],
-                    params=first.params,
-                    weights=1.0 / np.array([noise] * len(np.ravel(d[mask]))),
-                )
-                fit_report = first.fit_report()
-                # log.write(
-                out_str += f"""
-        ------------------------------------
-                     Plane = {num+1}
-        ------------------------------------
-        {fit_report}
-                        """
-                #               )
-                if verb:
-                    print(fit_report)
-
-                amp, amp_err, name = get_params(first.params, "amplitude")
-                cen_x, cen_x_err, cx_name = get_params(first.params, "center_x")
-                cen_y, cen_y_err, cy_name = get_params(first.params, "center_y")
-                sig_x, sig_x_err, sx_name = get_params(first.params, "sigma_x")
-                sig_y, sig_y_err, sy_name = get_params(first.params, "sigma_y")
-                # currently chi square is calculated for all peaks in cluster (not individual peaks)
-                # chi2 - residual sum of squares
-                chisqrs.extend([first.chisqr for _ in sy_name])
-                # reduced chi2
-                redchis.extend([first.redchi for _ in sy_name])
-                # Akaike Information criterion
-                aics.extend([first.aic for _ in sy_name])
-                # residual sum of squares
-                res_sum.extend([np.sum(first.residual) for _ in sy_name])
-
-                # deal with lineshape specific parameters
-                if lineshape == "PV_PV":
-                    frac_x, frac_err_x, name = get_params(first.params, "fraction_x")
-                    frac_y, frac_err_y, name = get_params(first.params, "fraction_y")
-                    fractions_x.extend(frac_x)
-                    fractions_y.extend(frac_y)
-                elif lineshape == "V":
-                    frac, frac_err, name = get_params(first.params, "fraction")
-                    gam_x, gam_x_err, gx_name = get_params(first.params, "gamma_x")
-                    gam_y, gam_y_err, gy_name = get_params(first.params, "gamma_y")
-                    gamma_xs.extend(gam_x)
-                    gamma_ys.extend(gam_y)
-                    fractions.extend(frac)
-                else:
-                    frac, frac_err, name = get_params(first.params, "fraction")
-                    fractions.extend(frac)
-
-                # extend lists with fit data
-                amps.extend(amp)
-                amp_errs.extend(amp_err)
-                center_xs.extend(cen_x)
-                init_center_xs.extend(group.X_AXISf)
-                # center_x_errs.extend(cen_x_err)
-                center_ys.extend(cen_y)
-                init_center_ys.extend(group.Y_AXISf)
-                # center_y_errs.extend(cen_y_err)
-                sigma_xs.extend(sig_x)
-                # sigma_x_errs.extend(sig_x_err)
-                sigma_ys.extend(sig_y)
-                # sigma_y_errs.extend(sig_y_err)
-                # add plane number, this should map to vclist
-                planes.extend([plane_number for _ in amp])
-                lineshapes.extend([lineshape for _ in amp])
-                #  get prefix for fit
-                names.extend([first.model.prefix] * len(name))
-                assign.extend(group["ASS"])
-                clustids.extend(group["CLUSTID"])
-                memcnts.extend(group["MEMCNT"])
-                x_radii.extend(group["X_RADIUS"])
-                y_radii.extend(group["Y_RADIUS"])
-                x_radii_ppm.extend(group["X_RADIUS_PPM"])
-                y_radii_ppm.extend(group["Y_RADIUS_PPM"])
-
+    # result columns (the lists are filled in place)
     df_dic = {
         "fit_prefix": names,
         "assignment": assign,
@@ -446,9 +1276,9 @@ def fit_peaks(peaks: pd.DataFrame, fit_input: FitPeaksInput):
         "chisqr": chisqrs,
         "redchi": redchis,
         "residual_sum": res_sum,
-        # "slope": slopes,
-        # "intercept": intercepts
     }
+    df_dic.update(quality_columns)
+    df_dic.update({f"summed_{k}": v for k, v in summed_quality_columns.items()})
 
     # lineshape specific
     if lineshape == "PV_PV":
@@ -460,16 +1290,507 @@ def fit_peaks(peaks: pd.DataFrame, fit_input: FitPeaksInput):
     if lineshape == "V":
         df_dic["gamma_x"] = gamma_xs
         df_dic["gamma_y"] = gamma_ys
-    #  make dataframe
-    df = pd.DataFrame(df_dic)
-    # Fill nan values
-    df.fillna(value=np.nan, inplace=True)
-    # vclist
-    if vclist:
-        vclist_data = fit_input.args.get("vclist_data")
-        df["vclist"] = df.plane.apply(lambda x: vclist_data[x])
-    #  output data
-    return FitPeaksResult(df=df, log=out_str)
+
+    if decay == "exp":
+        df_dic["amp0"] = amp0s
+        df_dic["amp0_err"] = amp0_errs
+        df_dic["rate"] = rates
+        df_dic["rate_err"] = rate_errs
+
+    def save_results(
+        params,
+        group,
+        plane_number,
+        chisqr,
+        redchi,
+        aic,
+        residual_sum,
+        prefix,
+        quality,
+        summed_quality,
+    ):
+        """ Append fitted parameters and statistics of one plane to the result lists
+
+            quality and summed_quality are the fit_quality of the plane and of
+            the summed planes
+        """
+        amp, amp_err, name = get_params(params, "amplitude")
+        cen_x, cen_x_err, cx_name = get_params(params, "center_x")
+        cen_y, cen_y_err, cy_name = get_params(params, "center_y")
+        sig_x, sig_x_err, sx_name = get_params(params, "sigma_x")
+        sig_y, sig_y_err, sy_name = get_params(params, "sigma_y")
+        # currently chi square is calculated for all peaks in cluster (not individual peaks)
+        # chi2 - residual sum of squares
+        chisqrs.extend([chisqr for _ in sy_name])
+        # reduced chi2
+        redchis.extend([redchi for _ in sy_name])
+        # Akaike Information criterion
+        aics.extend([aic for _ in sy_name])
+        # residual sum of squares
+        res_sum.extend([residual_sum for _ in sy_name])
+        for k in qc_columns:
+            quality_columns[k].extend([quality[k] for _ in sy_name])
+            summed_quality_columns[k].extend([summed_quality[k] for _ in sy_name])
+
+        # deal with lineshape specific parameters
+        if lineshape == "PV_PV":
+            frac_x, frac_err_x, name = get_params(params, "fraction_x")
+            frac_y, frac_err_y, name = get_params(params, "fraction_y")
+            fractions_x.extend(frac_x)
+            fractions_y.extend(frac_y)
+        elif lineshape == "V":
+            frac, frac_err, name = get_params(params, "fraction")
+            gam_x, gam_x_err, gx_name = get_params(params, "gamma_x")
+            gam_y, gam_y_err, gy_name = get_params(params, "gamma_y")
+            gamma_xs.extend(gam_x)
+            gamma_ys.extend(gam_y)
+            fractions.extend(frac)
+        else:
+            frac, frac_err, name = get_params(params, "fraction")
+            fractions.extend(frac)
+
+        # extend lists with fit data
+        amps.extend(amp)
+        amp_errs.extend(amp_err)
+        center_xs.extend(cen_x)
+        init_center_xs.extend(group.X_AXISf)
+        # center_x_errs.extend(cen_x_err)
+        center_ys.extend(cen_y)
+        init_center_ys.extend(group.Y_AXISf)
+        # center_y_errs.extend(cen_y_err)
+        sigma_xs.extend(sig_x)
+        # sigma_x_errs.extend(sig_x_err)
+        sigma_ys.extend(sig_y)
+        # sigma_y_errs.extend(sig_y_err)
+        # add plane number, this should map to vclist
+        planes.extend([plane_number for _ in amp])
+        lineshapes.extend([lineshape for _ in amp])
+        #  get prefix for fit
+        names.extend([prefix] * len(name))
+        assign.extend(group["ASS"])
+        clustids.extend(group["CLUSTID"])
+        memcnts.extend(group["MEMCNT"])
+        x_radii.extend(group["X_RADIUS"])
+        y_radii.extend(group["Y_RADIUS"])
+        x_radii_ppm.extend(group["X_RADIUS_PPM"])
+        y_radii_ppm.extend(group["Y_RADIUS_PPM"])
+
+    def save_amplitude_fit(
+        amp_fit,
+        params,
+        group,
+        title,
+        prefix,
+        plane_numbers,
+        start,
+        quality,
+        summed_quality,
+    ):
+        """ Save results of planes from an AmplitudeFitResult and return the log
+
+            start is the position of the first of plane_numbers in all fitted planes
+            and quality has one value of each fit_quality column per plane
+        """
+        log_str = ""
+        amp_names = [k for k in params if k.endswith("amplitude")]
+        for num, plane_number in enumerate(plane_numbers):
+            for k, amp, amp_err in zip(
+                amp_names, amp_fit.amplitudes[num], amp_fit.stderr[num]
+            ):
+                params[k].value = amp
+                params[k].stderr = amp_err
+            fit_report = f"""
+    [[{title}]]
+        chi-square         = {amp_fit.chisqr[num]:.5e}
+        reduced chi-square = {amp_fit.redchi[num]:.5e}
+        Akaike info crit   = {amp_fit.aic[num]:.5f}
+{lmfit_fit_report(params)}"""
+            log_str += f"""
+        ------------------------------------
+                     Plane = {start+num+1}
+        ------------------------------------
+        {fit_report}
+                        """
+            if verb:
+                print(fit_report)
+
+            save_results(
+                params,
+                group,
+                plane_number,
+                chisqr=amp_fit.chisqr[num],
+                redchi=amp_fit.redchi[num],
+                aic=amp_fit.aic[num],
+                residual_sum=amp_fit.residual_sum[num],
+                prefix=prefix,
+                quality={k: v[num] for k, v in quality.items()},
+                summed_quality=summed_quality,
+            )
+        if decay == "exp":
+            # one value per peak repeated for each plane
+            n_planes = len(plane_numbers)
+            amp0s.extend(np.tile(amp_fit.amp0, n_planes))
+            amp0_errs.extend(np.tile(amp_fit.amp0_err, n_planes))
+            rates.extend(np.tile(amp_fit.rates, n_planes))
+            rate_errs.extend(np.tile(amp_fit.rate_err, n_planes))
+        return log_str
+
+    def fit_summed_planes(name, group):
+        """ Fit the sum of all planes of a cluster and return the result and log """
+        len_group = len(group)
+        log_str = ""
+        if len_group == 1:
+            peak_str = "peak"
+        else:
+            peak_str = "peaks"
+
+        log_str += f"""
+
+        ####################################
+        Fitting cluster of {len_group} {peak_str}
+        ####################################
+        """
+        # fits sum of all planes first
+        fit_result = fit_first_plane(
+            group,
+            summed_planes,
+            # norm(summed_planes),
+            uc_dics,
+            lineshape=lineshape,
+            xy_bounds=xy_bounds,
+            verbose=verb,
+            noise=summed_noise,
+            fit_method=fit_input.config.get("fit_method", "leastsq"),
+            parallel=fit_input.args.get("parallel", False),
+            engine=fit_input.args.get("--engine", "lmfit"),
+            least_squares_kws=fit_input.config.get("least_squares"),
+        )
+        if plot_path is not None and (fit_result.needs_checking or not plot_flagged):
+            if show:
+                fit_result.plot(plot_path=plot_path, show=True, nomp=True)
+            else:
+                plots[name] = fit_result.plot_data()
+        # jack_knife_result = fit_result.jackknife()
+        # print("JackKnife", jack_knife_result.mean, jack_knife_result.std)
+        first = fit_result.out
+        #            log.write(
+        log_str += fit_result.fit_str
+        log_str += f"""
+    ------------------------------------
+               Summed planes
+    ------------------------------------
+    {first.fit_report()}
+                    """
+        #            )
+        return fit_result, log_str
+
+    def fix_shapes(params):
+        """ Fix the parameters given by --fix and return the log """
+        # fix sigma center and fraction parameters
+        # could add an option to select params to fix
+        if len(to_fix) == 0 or to_fix == "None":
+            float_str = "Floating all parameters"
+            if verb:
+                print(float_str)
+            pass
+        else:
+            float_str = f"Fixing parameters: {to_fix}"
+            if verb:
+                print(float_str)
+            fix_params(params, to_fix)
+        return float_str + "\n"
+
+    def fit_planes(fit_result, group, data, plane_numbers, start=0):
+        """ Fit planes of a cluster starting from the summed plane fit and return the log
+
+            :param data: planes to fit (e.g. a block of planes)
+            :param plane_numbers: plane number of each of the planes in data
+            :param start: position of the first plane of data in all fitted planes
+        """
+        first = fit_result.out
+        window = fit_result.window
+        mask = fit_result.mask
+        if only_amplitudes_vary(first.params):
+            # shapes are fixed so fit amplitudes of all planes in one go
+            plane_data = np.array([d[window][mask] for d in data])
+            block_noise = noise[start : start + len(plane_data)]
+            basis = first.model.amplitude_basis(first.params, fit_result.XY_slices)
+            amp_fit = fit_amplitudes(
+                basis,
+                plane_data,
+                np.ones(mask.sum()),
+                nnls=fit_input.args.get("--nnls", False),
+                plane_weights=1.0 / block_noise,
+            )
+            return save_amplitude_fit(
+                amp_fit,
+                first.params.copy(),
+                group,
+                "Linear amplitude fit",
+                first.model.prefix,
+                plane_numbers,
+                start,
+                quality=fit_quality(
+                    plane_data, amp_fit.amplitudes @ basis.T, block_noise
+                ),
+                summed_quality=fit_result.quality,
+            )
+
+        log_str = ""
+        for num, d in enumerate(data):
+            plane_number = plane_numbers[num]
+            peak_slices = d[window][mask]
+            first.fit(
+                data=peak_slices,
+                params=first.params,
+                weights=np.full(len(peak_slices), 1.0 / noise[start + num]),
+            )
+            fit_report = first.fit_report()
+            # log.write(
+            log_str += f"""
+    ------------------------------------
+                 Plane = {start+num+1}
+    ------------------------------------
+    {fit_report}
+                    """
+            #               )
+            if verb:
+                print(fit_report)
+
+            save_results(
+                first.params,
+                group,
+                plane_number,
+                chisqr=first.chisqr,
+                redchi=first.redchi,
+                aic=first.aic,
+                residual_sum=np.sum(first.residual),
+                prefix=first.model.prefix,
+                quality=fit_quality(
+                    peak_slices,
+                    first.model.eval(XY=fit_result.XY_slices, params=first.params),
+                    noise[start + num],
+                ),
+                summed_quality=fit_result.quality,
+            )
+
+        return log_str
+
+    def fit_cluster(name, group):
+        """ Fit summed and individual planes of a cluster and return the log """
+        fit_result, log_str = fit_summed_planes(name, group)
+        first = fit_result.out
+        if fit_input.args.get("--global"):
+            # refine shared shapes against all planes at once (--fix is ignored)
+            window = fit_result.window
+            mask = fit_result.mask
+            plane_data = np.array([d[window][mask] for d in fit_input.data])
+            if decay == "exp":
+                decay_times = vclist_data[fit_input.plane_numbers]
+            else:
+                decay_times = None
+            global_fit = fit_global(
+                first.model,
+                first.params,
+                fit_result.XY_slices,
+                plane_data,
+                np.ones(mask.sum()),
+                decay_times=decay_times,
+                plane_weights=1.0 / noise,
+            )
+            log_str += f"""
+Global fit of {len(plane_data)} planes: {global_fit.message} ({global_fit.nfev} evaluations)
+            """
+            if not global_fit.success:
+                print(Fore.RED + f"Global fit failed for cluster {name}")
+            log_str += save_amplitude_fit(
+                global_fit,
+                global_fit.params,
+                group,
+                "Global fit",
+                first.model.prefix,
+                fit_input.plane_numbers,
+                0,
+                quality=fit_quality(
+                    plane_data,
+                    global_fit.amplitudes
+                    @ first.model.amplitude_basis(
+                        global_fit.params, fit_result.XY_slices
+                    ).T,
+                    noise,
+                ),
+                summed_quality=fit_result.quality,
+            )
+            return log_str
+
+        log_str += fix_shapes(first.params)
+        log_str += fit_planes(
+            fit_result, group, fit_input.data, fit_input.plane_numbers
+        )
+        return log_str
+
+    def fit_clusters_in_blocks(clusters, block_size):
+        """ Fit clusters reading the planes one block at a time
+
+            The summed planes of every cluster are fitted first and then each
+            block of planes is read, fitted for all clusters and discarded.
+
+            :param clusters: (name, group) of each cluster to fit
+            :param block_size: number of planes in each block
+
+            :returns: log of each cluster
+            :rtype: list
+        """
+        fitted = []
+        for name, group in clusters:
+            fit_result, log_str = fit_summed_planes(name, group)
+            log_str += fix_shapes(fit_result.out.params)
+            fitted.append([fit_result, group, log_str])
+        n_planes = len(fit_input.plane_numbers)
+        for start in range(0, n_planes, block_size):
+            stop = min(start + block_size, n_planes)
+            block = np.asarray(fit_input.data[start:stop])
+            if verb:
+                print(f"Fitting planes {start+1} to {stop} of {n_planes}")
+            for cluster in fitted:
+                fit_result, group, _ = cluster
+                cluster[2] += fit_planes(
+                    fit_result,
+                    group,
+                    block,
+                    fit_input.plane_numbers[start:stop],
+                    start,
+                )
+            del block
+        return [log_str for _, _, log_str in fitted]
+
+    max_cluster_size = fit_input.args.get("max_cluster_size")
+    # clusters are only cached when the data can be identified without reading it
+    if fit_input.args.get("--no-cache") or not fit_input.args.get("data_signature"):
+        cache = None
+    else:
+        cache = FitCache(
+            fit_input.config.get("cache_dir", ".peakipy_cache"),
+            max_size=fit_input.config.get("cache_size", 512) * 1024 ** 2,
+        )
+    settings = fit_settings(fit_input)
+    # clusters are always refitted when plotting
+    read_cache = cache is not None and fit_input.args.get("plot") is None
+
+    def make_dataframe():
+        df = pd.DataFrame(df_dic)
+        # Fill nan values
+        df.fillna(value=np.nan, inplace=True)
+        # vclist
+        if vclist:
+            df["vclist"] = df.plane.apply(lambda x: vclist_data[x])
+        return df
+
+    def cache_key(group):
+        if cache is None:
+            return None
+        return cache.key(
+            group,
+            fit_input.args["data_signature"],
+            cluster_window(group, fit_input.data.shape[-2:]),
+            *settings,
+        )
+
+    #  max cluster size
+    clusters = [
+        (name, group) for name, group in groups if len(group) <= max_cluster_size
+    ]
+    keys = {name: cache_key(group) for name, group in clusters}
+    block_size = fit_input.args.get("block_size")
+    if block_size is not None:
+        # look up cached clusters first so the planes are only streamed once
+        cached_results = {
+            name: cache.get(keys[name]) if read_cache else None for name, _ in clusters
+        }
+        to_fit = [
+            (name, group) for name, group in clusters if cached_results[name] is None
+        ]
+        block_logs = dict(
+            zip(
+                [name for name, _ in to_fit],
+                fit_clusters_in_blocks(to_fit, block_size),
+            )
+        )
+        # rows of all clusters for the first block then the next block etc.
+        block_rows = pd.DataFrame(df_dic)
+        for column in df_dic.values():
+            column.clear()
+
+    # iterate over groups of peaks
+    for name, group in clusters:
+        key = keys[name]
+        if block_size is None:
+            cached = cache.get(key) if read_cache else None
+        else:
+            cached = cached_results[name]
+        if cached is None:
+            if block_size is None:
+                log_str = fit_cluster(name, group)
+            else:
+                log_str = block_logs[name]
+                rows = block_rows[block_rows.clustid == name]
+                for k, v in df_dic.items():
+                    v.extend(rows[k].tolist())
+            if cache is not None:
+                cache.put(key, (df_dic, log_str))
+        else:
+            rows, log_str = cached
+            for k, v in rows.items():
+                df_dic[k].extend(v)
+            log_str = f"\n    Cluster {name} unchanged, using cached results\n{log_str}"
+            if verb:
+                print(f"Using cached results for cluster {name}")
+        yield FitPeaksResult(
+            df=make_dataframe(),
+            log=log_str,
+            plots=[plots.pop(name)] if name in plots else [],
+        )
+        # start next cluster with empty result columns
+        for column in df_dic.values():
+            column.clear()
+
+    if cache is not None:
+        cache.evict()
+
+
+def calculate_lineshape_parameters(df: pd.DataFrame, lineshape: str, peakipy_data):
+    """ Add peak heights, volumes, linewidths (FWHM) and values in ppm/Hz to fit results
+
+        :param df: fit results
+        :type df: pd.DataFrame
+        :param lineshape: lineshape that was fitted
+        :type lineshape: str
+        :param peakipy_data: data used for the fit (for unit conversions)
+        :type peakipy_data: LoadData
+
+        :returns: fit results with additional columns
+        :rtype: pd.DataFrame
+    """
+    shape = lineshapes[lineshape]
+    df["height"] = shape.height(df)
+    df["height_err"] = shape.height(df, amplitude="amp_err")
+    df["volume"] = shape.volume(df)
+    df["volume_err"] = shape.volume(df, amplitude="amp_err")
+    for column, fwhm in shape.fwhm(df).items():
+        df[column] = fwhm
+    #  convert values to ppm
+    axis_f2, axis_f1 = peakipy_data.axis_f2, peakipy_data.axis_f1
+    df["center_x_ppm"] = axis_f2.ppm(df.center_x)
+    df["center_y_ppm"] = axis_f1.ppm(df.center_y)
+    df["init_center_x_ppm"] = axis_f2.ppm(df.init_center_x)
+    df["init_center_y_ppm"] = axis_f1.ppm(df.init_center_y)
+    df["sigma_x_ppm"] = df.sigma_x * peakipy_data.ppm_per_pt_f2
+    df["sigma_y_ppm"] = df.sigma_y * peakipy_data.ppm_per_pt_f1
+    df["fwhm_x_ppm"] = df.fwhm_x * peakipy_data.ppm_per_pt_f2
+    df["fwhm_y_ppm"] = df.fwhm_y * peakipy_data.ppm_per_pt_f1
+    df["fwhm_x_hz"] = df.fwhm_x * peakipy_data.hz_per_pt_f2
+    df["fwhm_y_hz"] = df.fwhm_y * peakipy_data.hz_per_pt_f1
+    return df
 
 
 def check_input(args):
@@ -487,9 +1808,8 @@ def check_input(args):
                 error=Fore.RED + f"🤔 {args['<peaklist>']} should exist and be readable",
             ),
             "<data>": And(
-                os.path.exists,
                 # Use(
-                ng.pipe.read,
+                read_pipe,
                 error=Fore.RED
                 + f"🤔 {args['<data>']} should be NMRPipe format 2D or 3D cube",
                 # ),
@@ -551,7 +1871,31 @@ def check_input(args):
                     ),
                 ),
             ),
+            "--engine": Or(
+                "lmfit",
+                "direct",
+                error=Fore.RED + "🤔 --engine must be either lmfit or direct",
+            ),
+            "--decay": Or(
+                "None", "exp", error=Fore.RED + "🤔 --decay must be either None or exp",
+            ),
             "--plot": Or("None", Use(lambda f: Path(f))),
+            "--plot_style": Or(
+                "3d", "2d", error=Fore.RED + "🤔 --plot_style must be either 3d or 2d",
+            ),
+            "--plot_workers": And(
+                Use(int),
+                lambda n: 0 < n,
+                error=Fore.RED + "🤔 --plot_workers must be an integer greater than 0",
+            ),
+            "--block_size": Or(
+                "None",
+                And(
+                    Use(int),
+                    lambda n: 0 < n,
+                    error=Fore.RED + "🤔 --block_size must be an integer greater than 0",
+                ),
+            ),
             "--xy_bounds": Or(
                 "None",
                 Use(
@@ -612,9 +1956,14 @@ def main(arguments):
     # get dims from command line input
     # read NMR data
     args, config = read_config(args)
+    set_voigt_accuracy(config.get("voigt_terms", 16))
     dims = args.get("--dims")
     data = args.get("<data>")
-    peakipy_data = LoadData(peaklist, data, dims=dims)
+    try:
+        peakipy_data = LoadData(peaklist, data, dims=dims)
+    except ImportError as e:
+        print(Fore.RED + f"🤔 {e}")
+        exit()
 
     # only include peaks with 'include'
     if "include" in peakipy_data.df.columns:
@@ -663,14 +2012,40 @@ def main(arguments):
         vclist = False
     args["vclist"] = vclist
 
+    if args.get("--decay") != "None" and not (vclist and args.get("--global")):
+        print(Fore.RED + "🤔 --decay can only be used with --global and --vclist")
+        exit()
+
+    # stream planes in blocks
+    block_size = args.get("--block_size")
+    if block_size == "None":
+        block_size = None
+    elif args.get("--global"):
+        print(Fore.RED + "🤔 --block_size can not be used with --global")
+        exit()
+    args["block_size"] = block_size
+
     # plot results or not
     plot = args.get("--plot")
     if plot == "None":
         plot = None
-        log_file = open(tmp_path / log_path, "w")
     else:
-        log_file = open(tmp_path / log_path, "w")
         plot.mkdir(parents=True, exist_ok=True)
+        if args.get("--show") and not args.get("--nomp"):
+            print(
+                Fore.RED
+                + "Cannot use interactive matplotlib in multiprocess mode. Use --nomp flag."
+            )
+    # fit reports are saved next to the output (e.g. fits.csv -> fits.log)
+    log_file = open(Path(args["<output>"]).with_suffix(".log"), "w")
+
+    # directory for intermediate files (only if requested)
+    workspace = args.get("--workspace")
+    if workspace == "None":
+        workspace = None
+    else:
+        workspace = make_workspace(workspace)
+        print(Fore.YELLOW + f"Saving intermediate files to {workspace}")
 
     args["plot"] = plot
 
@@ -684,52 +2059,32 @@ def main(arguments):
         )
         exit()
 
-    plane_numbers = np.arange(peakipy_data.data.shape[peakipy_data.dims[0]])
     # only fit specified planes
     if args.get("--plane", [-1]) != [-1]:
         _inds = args.get("--plane")
-        inds = [i for i in _inds]
-        data_inds = [
-            (i in inds) for i in range(peakipy_data.data.shape[peakipy_data.dims[0]])
-        ]
-        plane_numbers = np.arange(peakipy_data.data.shape[peakipy_data.dims[0]])[
-            data_inds
-        ]
-        peakipy_data.data = peakipy_data.data[data_inds]
+        # selecting planes does not read or copy any data
+        peakipy_data.data = peakipy_data.data[np.isin(peakipy_data.data.planes, _inds)]
         print(
             Fore.YELLOW + f"Using only planes {_inds} data now has the following shape",
             peakipy_data.data.shape,
         )
-        if peakipy_data.data.shape[peakipy_data.dims[0]] == 0:
+        if peakipy_data.data.shape[0] == 0:
             print(Fore.RED + "You have excluded all the data!", peakipy_data.data.shape)
             exit()
 
     # do not fit these planes
     if args.get("--exclude_plane", [-1]) != [-1]:
         _inds = args.get("--exclude_plane")
-        inds = [i for i in _inds]
-        data_inds = [
-            (i not in inds)
-            for i in range(peakipy_data.data.shape[peakipy_data.dims[0]])
-        ]
-        plane_numbers = np.arange(peakipy_data.data.shape[peakipy_data.dims[0]])[
-            data_inds
-        ]
-        peakipy_data.data = peakipy_data.data[data_inds]
+        peakipy_data.data = peakipy_data.data[~np.isin(peakipy_data.data.planes, _inds)]
         print(
             Fore.YELLOW + f"Excluding planes {_inds} data now has the following shape",
             peakipy_data.data.shape,
         )
-        if peakipy_data.data.shape[peakipy_data.dims[0]] == 0:
+        if peakipy_data.data.shape[0] == 0:
             print(Fore.RED + "You have excluded all the data!", peakipy_data.data.shape)
             exit()
 
-    # setting noise for calculation of chi square
-    if not args.get("noise"):
-        noise = abs(threshold_otsu(peakipy_data.data))
-
-    args["noise"] = noise
-    # print(noise)
+    plane_numbers = peakipy_data.data.planes
 
     xy_bounds = args.get("--xy_bounds")
 
@@ -747,191 +2102,154 @@ def main(arguments):
     peakipy_data.df["YW"] = peakipy_data.df.YW_HZ * peakipy_data.pt_per_hz_f1
 
     # convert peak positions from ppm to points in case they were adjusted running edit.py
-    peakipy_data.df["X_AXIS"] = peakipy_data.df.X_PPM.apply(
-        lambda x: peakipy_data.uc_f2(x, "PPM")
-    )
-    peakipy_data.df["Y_AXIS"] = peakipy_data.df.Y_PPM.apply(
-        lambda x: peakipy_data.uc_f1(x, "PPM")
-    )
-    peakipy_data.df["X_AXISf"] = peakipy_data.df.X_PPM.apply(
-        lambda x: peakipy_data.uc_f2.f(x, "PPM")
-    )
-    peakipy_data.df["Y_AXISf"] = peakipy_data.df.Y_PPM.apply(
-        lambda x: peakipy_data.uc_f1.f(x, "PPM")
-    )
-    # start fitting data
-    # prepare data for multiprocessing
-    if (peakipy_data.df.CLUSTID.nunique() >= n_cpu) and not args.get("--nomp"):
-        print(Fore.GREEN + "Using multiprocessing")
-        # split peak lists
-        tmp_dir = split_peaklist(peakipy_data.df, n_cpu)
-        peaklists = [
-            pd.read_csv(tmp_dir / Path(f"peaks_{i}.csv")) for i in range(n_cpu)
-        ]
-        args_list = [
-            FitPeaksInput(args, peakipy_data.data, config, plane_numbers)
-            for _ in range(n_cpu)
-        ]
-        with Pool(processes=n_cpu) as pool:
-            # result = pool.map(fit_peaks, peaklists)
-            result = pool.starmap(fit_peaks, zip(peaklists, args_list))
-            df = pd.concat([i.df for i in result], ignore_index=True)
-            for num, i in enumerate(result):
-                i.df.to_csv(tmp_dir / Path(f"peaks_{num}_fit.csv"), index=False)
-                log_file.write(i.log + "\n")
+    peakipy_data.df["X_AXIS"] = peakipy_data.axis_f2.index(peakipy_data.df.X_PPM)
+    peakipy_data.df["Y_AXIS"] = peakipy_data.axis_f1.index(peakipy_data.df.Y_PPM)
+    peakipy_data.df["X_AXISf"] = peakipy_data.axis_f2.pts(peakipy_data.df.X_PPM)
+    peakipy_data.df["Y_AXISf"] = peakipy_data.axis_f1.pts(peakipy_data.df.Y_PPM)
+
+    # noise of each plane for weighting the fits (and calculation of chi square)
+    if args.get("noise"):
+        # set in peakipy.config
+        noise = np.full(len(plane_numbers), args["noise"])
     else:
-        print(Fore.GREEN + "Not using multiprocessing")
-        result = fit_peaks(
-            peakipy_data.df,
-            FitPeaksInput(args, peakipy_data.data, config, plane_numbers),
+        # estimates are cached next to the fit results unless --no-cache is given
+        if args.get("--no-cache"):
+            noise_cache = None
+        else:
+            noise_cache = Path(config.get("cache_dir", ".peakipy_cache")) / "noise.json"
+        noise = plane_noise(
+            peakipy_data.data, peakipy_data.df, data, dims=dims, cache_path=noise_cache,
         )
-        df = result.df
-        log_file.write(result.log)
+    if verb:
+        print("Noise of each plane", noise)
+    args["noise"] = noise
 
-    # finished fitting
+    # the data is identified by its files and header rather than hashed in full
+    args["data_signature"] = hash_inputs(
+        data_signature(data), dims, peakipy_data.data.shape, peakipy_data.dic
+    )
 
-    # close log file
-    log_file.close()
+    # start fitting data
+    fit_input = FitPeaksInput(args, peakipy_data.data, config, plane_numbers)
     output = Path(args["<output>"])
-    suffix = output.suffix
-    #  convert sigmas to fwhm
-    if args["lineshape"] == "V":
-        # calculate peak height
-        df["height"] = df.apply(
-            lambda x: voigt2d(
-                XY=[0, 0],
-                center_x=0.0,
-                center_y=0.0,
-                sigma_x=x.sigma_x,
-                sigma_y=x.sigma_y,
-                gamma_x=x.gamma_x,
-                gamma_y=x.gamma_y,
-                amplitude=x.amp,
-            ),
-            axis=1,
-        )
-        df["height_err"] = df.apply(lambda x: x.amp_err * (x.height / x.amp), axis=1)
-        df["fwhm_g_x"] = df.sigma_x.apply(
-            lambda x: 2.0 * x * np.sqrt(2.0 * np.log(2.0))
-        )  # fwhm of gaussian
-        df["fwhm_g_y"] = df.sigma_y.apply(
-            lambda x: 2.0 * x * np.sqrt(2.0 * np.log(2.0))
-        )
-        df["fwhm_l_x"] = df.gamma_x.apply(lambda x: 2.0 * x)  # fwhm of lorentzian
-        df["fwhm_l_y"] = df.gamma_y.apply(lambda x: 2.0 * x)
-        df["fwhm_x"] = df.apply(
-            lambda x: 0.5346 * x.fwhm_l_x
-            + np.sqrt(0.2166 * x.fwhm_l_x ** 2.0 + x.fwhm_g_x ** 2.0),
-            axis=1,
-        )
-        df["fwhm_y"] = df.apply(
-            lambda x: 0.5346 * x.fwhm_l_y
-            + np.sqrt(0.2166 * x.fwhm_l_y ** 2.0 + x.fwhm_g_y ** 2.0),
-            axis=1,
-        )
-        # df["fwhm_y"] = df.apply(lambda x: x.gamma_y + np.sqrt(x.gamma_y**2.0 + 4 * x.sigma_y**2.0 * 2.0 * np.log(2.)), axis=1)
-        # df["fwhm_x"] = df.apply(lambda x: x.gamma_x + np.sqrt(x.gamma_x**2.0 + 4 * x.sigma_x**2.0 * 2.0 * np.log(2.)), axis=1)
-        # df["fwhm_y"] = df.apply(lambda x: x.gamma_y + np.sqrt(x.gamma_y**2.0 + 4 * x.sigma_y**2.0 * 2.0 * np.log(2.)), axis=1)
-
-    if args["lineshape"] == "PV":
-        # calculate peak height
-        df["height"] = df.apply(
-            lambda x: pvoigt2d(
-                XY=[0, 0],
-                center_x=0.0,
-                center_y=0.0,
-                sigma_x=x.sigma_x,
-                sigma_y=x.sigma_y,
-                amplitude=x.amp,
-                fraction=x.fraction,
-            ),
-            axis=1,
+    # results are written as each cluster (or batch of clusters) is finished
+    try:
+        writer = ResultWriter(output)
+    except ImportError as e:
+        log_file.close()
+        print(Fore.RED + f"🤔 {e}")
+        exit()
+    # finished clusters are journaled so that an interrupted run can be resumed
+    journal = Journal(
+        output.with_name(output.name + ".journal"),
+        hash_inputs(peakipy_data.df, args["data_signature"], *fit_settings(fit_input)),
+    )
+    finished = journal.resume() if args.get("--resume") else None
+    if finished is None:
+        if args.get("--resume"):
+            print(
+                Fore.YELLOW
+                + f"No journal matching these inputs found at {journal.path}, fitting all clusters"
+            )
+        finished = []
+        journal.start()
+    else:
+        finished_clustids = set()
+        for result in finished:
+            finished_clustids.update(result.df.clustid)
+        print(
+            Fore.GREEN
+            + f"Resuming from {journal.path} ({len(finished_clustids)} clusters already fitted)"
         )
-        df["height_err"] = df.apply(lambda x: x.amp_err * (x.height / x.amp), axis=1)
-        df["fwhm_x"] = df.sigma_x.apply(lambda x: x * 2.0)
-        df["fwhm_y"] = df.sigma_y.apply(lambda x: x * 2.0)
-
-    elif args["lineshape"] == "G":
-        df["height"] = df.apply(
-            lambda x: pvoigt2d(
-                XY=[0, 0],
-                center_x=0.0,
-                center_y=0.0,
-                sigma_x=x.sigma_x,
-                sigma_y=x.sigma_y,
-                amplitude=x.amp,
-                fraction=0.0,  # gaussian
-            ),
-            axis=1,
+        peakipy_data.df = peakipy_data.df[
+            ~peakipy_data.df.CLUSTID.isin(finished_clustids)
+        ]
+
+    # prepare data for multiprocessing
+    n_clusters = peakipy_data.df.CLUSTID.nunique()
+    spool = args.get("--spool")
+    if spool != "None":
+        print(Fore.GREEN + f"Fitting clusters queued in {spool}")
+        # one task per cluster except for small clusters which are batched
+        tasks = schedule_clusters(
+            peakipy_data.df, len(plane_numbers), n_clusters, batches_per_worker=1
         )
-        df["height_err"] = df.apply(lambda x: x.amp_err * (x.height / x.amp), axis=1)
-        df["fwhm_x"] = df.sigma_x.apply(lambda x: x * 2.0)
-        df["fwhm_y"] = df.sigma_y.apply(lambda x: x * 2.0)
-
-    elif args["lineshape"] == "L":
-        df["height"] = df.apply(
-            lambda x: pvoigt2d(
-                XY=[0, 0],
-                center_x=0.0,
-                center_y=0.0,
-                sigma_x=x.sigma_x,
-                sigma_y=x.sigma_y,
-                amplitude=x.amp,
-                fraction=1.0,  # lorentzian
-            ),
-            axis=1,
+        results = iter_spool(
+            Spool(spool, lease=config.get("spool_lease", 60.0)),
+            peakipy_data.df,
+            fit_input,
+            tasks,
         )
-        df["height_err"] = df.apply(lambda x: x.amp_err * (x.height / x.amp), axis=1)
-        df["fwhm_x"] = df.sigma_x.apply(lambda x: x * 2.0)
-        df["fwhm_y"] = df.sigma_y.apply(lambda x: x * 2.0)
-
-    elif args["lineshape"] == "PV_PV":
-        # calculate peak height
-        df["height"] = df.apply(
-            lambda x: pv_pv(
-                XY=[0, 0],
-                center_x=0.0,
-                center_y=0.0,
-                sigma_x=x.sigma_x,
-                sigma_y=x.sigma_y,
-                amplitude=x.amp,
-                fraction_x=x.fraction_x,
-                fraction_y=x.fraction_y,
-            ),
-            axis=1,
+    elif n_cpu > 1 and n_clusters > 1 and not args.get("--nomp"):
+        print(Fore.GREEN + "Using multiprocessing")
+        n_workers = min(n_cpu, n_clusters)
+        # largest clusters first so that no worker is left with a big cluster at the end
+        # (one task per worker when streaming blocks so each worker reads the planes once)
+        tasks = schedule_clusters(
+            peakipy_data.df,
+            len(plane_numbers),
+            n_workers,
+            batches_per_worker=1 if block_size else 4,
         )
-        df["height_err"] = df.apply(lambda x: x.amp_err * (x.height / x.amp), axis=1)
-        df["fwhm_x"] = df.sigma_x.apply(lambda x: x * 2.0)
-        df["fwhm_y"] = df.sigma_y.apply(lambda x: x * 2.0)
-
+        # workers attach to the spectrum in shared memory and only receive the
+        # CLUSTIDs of the clusters they should fit
+        results = iter_pool(peakipy_data.df, fit_input, tasks, n_workers)
     else:
-        df["fwhm_x"] = df.sigma_x.apply(lambda x: x * 2.0)
-        df["fwhm_y"] = df.sigma_y.apply(lambda x: x * 2.0)
-    #  convert values to ppm
-    df["center_x_ppm"] = df.center_x.apply(lambda x: peakipy_data.uc_f2.ppm(x))
-    df["center_y_ppm"] = df.center_y.apply(lambda x: peakipy_data.uc_f1.ppm(x))
-    df["init_center_x_ppm"] = df.init_center_x.apply(
-        lambda x: peakipy_data.uc_f2.ppm(x)
-    )
-    df["init_center_y_ppm"] = df.init_center_y.apply(
-        lambda x: peakipy_data.uc_f1.ppm(x)
-    )
-    df["sigma_x_ppm"] = df.sigma_x.apply(lambda x: x * peakipy_data.ppm_per_pt_f2)
-    df["sigma_y_ppm"] = df.sigma_y.apply(lambda x: x * peakipy_data.ppm_per_pt_f1)
-    df["fwhm_x_ppm"] = df.fwhm_x.apply(lambda x: x * peakipy_data.ppm_per_pt_f2)
-    df["fwhm_y_ppm"] = df.fwhm_y.apply(lambda x: x * peakipy_data.ppm_per_pt_f1)
-    df["fwhm_x_hz"] = df.fwhm_x.apply(lambda x: x * peakipy_data.hz_per_pt_f2)
-    df["fwhm_y_hz"] = df.fwhm_y.apply(lambda x: x * peakipy_data.hz_per_pt_f1)
-
-    # save data
-    if suffix == ".csv":
-        df.to_csv(output, float_format="%.4f", index=False)
-
-    elif suffix == ".tab":
-        df.to_csv(output, sep="\t", float_format="%.4f", index=False)
+        print(Fore.GREEN + "Not using multiprocessing")
+        # use multithreaded cluster kernels instead
+        args["parallel"] = True
+        results = iter_fit_peaks(peakipy_data.df, fit_input)
 
+    # plots are rendered by separate processes while fitting
+    if plot is not None and not (args.get("--show") and args.get("--nomp")):
+        renderer = PlotRenderer(plot, args["--plot_style"], args["--plot_workers"])
     else:
-        df.to_pickle(output)
+        renderer = None
+
+    for result in finished:
+        log_file.write(result.log + "\n")
+        writer.write(
+            calculate_lineshape_parameters(result.df, args["lineshape"], peakipy_data)
+        )
+    try:
+        for num, result in enumerate(results):
+            log_file.write(result.log + "\n")
+            if renderer is not None:
+                renderer.submit(result.plots)
+            if len(result.df) == 0:
+                continue
+            journal.append(result)
+            if workspace is not None:
+                peaks = peakipy_data.df[peakipy_data.df.CLUSTID.isin(result.df.clustid)]
+                peaks.to_csv(workspace / f"peaks_{num}.csv", index=False)
+                result.df.to_csv(workspace / f"peaks_{num}_fit.csv", index=False)
+            writer.write(
+                calculate_lineshape_parameters(
+                    result.df, args["lineshape"], peakipy_data
+                )
+            )
+    except SpoolError as e:
+        # keep the finished clusters so that the run can be resumed
+        writer.abort()
+        journal.close()
+        if renderer is not None:
+            renderer.close()
+        log_file.close()
+        print(Fore.RED + str(e))
+        print(
+            Fore.RED
+            + f"Finished clusters are kept in {journal.path}, use --resume to continue"
+        )
+        exit()
+    # finished fitting
+    writer.close()
+    if renderer is not None:
+        if renderer.n_plots:
+            print(Fore.GREEN + f"Rendering {renderer.n_plots} plots in {plot}")
+        renderer.close()
+    journal.remove()
+    # close log file
+    log_file.close()
 
     print(
         """
@@ -9,6 +9,7 @@ peakipy commands are:
    read     Read peaklist and generate initial peak clusters 
    edit     Interactively edit fit parameters
    fit      Fit peaks
+   worker   Fit clusters queued by fit --spool (e.g. on other hosts)
    check    Check individual fits and generate plots
    spec     Plot spectra and make overlays
 
@@ -37,6 +38,11 @@ def main(argv):
 
         fit.main(argv)
 
+    elif args["<command>"] == "worker":
+        import peakipy.commandline.worker as worker
+
+        worker.main(argv)
+
     elif args["<command>"] == "edit":
         import peakipy.commandline.edit as edit
 
@@ -6,12 +6,14 @@
 
     Arguments:
         <peaklist>                Analysis2/Sparky/NMRPipe peak list (see below)
-        <data>                    2D or pseudo3D NMRPipe data
+        <data>                    2D or pseudo3D NMRPipe data (single file, filename template
+                                  e.g. planes/test%03d.ft2 or directory of planes)
 
         --a2                      Analysis peaklist as input (tab delimited)
         --sparky                  Sparky peaklist as input
         --pipe                    NMRPipe peaklist as input
-        --peakipy                 peakipy peaklist.csv or .tab (originally output from peakipy read or edit)
+        --peakipy                 peakipy peaklist (.csv, .tab, .parquet, .feather, .h5, .npz or .pkl
+                                  originally output from peakipy read or edit)
 
     Options:
         -h --help                 Show this screen
@@ -39,7 +41,8 @@
         --posF1=<column_name>     Name of column in Analysis2 peak list containing F1 (i.e. Y_PPM)
                                   peak positions [default: "Position F2"]
 
-        --outfmt=<csv/pkl>        Format of output peaklist [default: csv]
+        --outfmt=<fmt>            Format of output peaklist (csv, tab, parquet, feather, h5, npz or pkl)
+                                  [default: csv]
 
         --show                    Show the clusters on the spectrum color coded using matplotlib
 
@@ -96,10 +99,9 @@ from pathlib import Path
 
 from docopt import docopt
 from schema import And, Or, Use, Schema, SchemaError
-import nmrglue as ng
 from colorama import Fore, init
 
-from peakipy.core import Peaklist, run_log, LoadData
+from peakipy.core import Peaklist, run_log, LoadData, write_table, read_pipe
 
 # colorama
 init(autoreset=True)
@@ -115,8 +117,7 @@ def check_args(args):
                 error=f"🤔 {args['<peaklist>']} should exist and be readable",
             ),
             "<data>": And(
-                os.path.exists,
-                ng.pipe.read,
+                read_pipe,
                 error=f"🤔 {args['<data>']} should be NMRPipe format 2D or 3D cube",
             ),
             "--thres": Or("None", Use(float)),
@@ -136,7 +137,16 @@ def check_args(args):
             ),
             "--posF1": Use(str),  # check whether in dic
             "--posF2": Use(str),  # check whether in dic
-            "--outfmt": Or("csv", error="Currently must be csv"),
+            "--outfmt": Or(
+                "csv",
+                "tab",
+                "parquet",
+                "feather",
+                "h5",
+                "npz",
+                "pkl",
+                error="--outfmt must be csv, tab, parquet, feather, h5, npz or pkl",
+            ),
             object: object,
         },
         # ignore_extra_keys=True,
@@ -210,7 +220,10 @@ def main(argv):
 
     elif args.get("--peakipy"):
         # read in a peakipy .csv file
-        peaks = LoadData(filename, pipe_ft_file, fmt="peakipy", dims=dims)
+        try:
+            peaks = LoadData(filename, pipe_ft_file, fmt="peakipy", dims=dims)
+        except ImportError as e:
+            exit(Fore.RED + f"🤔 {e}")
         cluster = False
 
     peaks.update_df()
@@ -235,12 +248,11 @@ def main(argv):
         # don't overwrite the old .csv file
         outname = outname + "_new"
 
-    if outfmt == "csv":
-        outname = outname + ".csv"
-        data.to_csv(outname, float_format="%.4f", index=False)
-    else:
-        outname = outname + ".pkl"
-        data.to_pickle(outname)
+    outname = outname + f".{outfmt}"
+    try:
+        write_table(data, outname)
+    except ImportError as e:
+        exit(Fore.RED + f"🤔 {e}")
 
     # write config file
     config_path = Path("peakipy.config")
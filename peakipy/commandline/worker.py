@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Fit clusters queued by peakipy fit --spool=<spool>
+
+    Usage:
+        worker <spool> [options]
+
+    Arguments:
+        <spool>                                     spool directory passed to peakipy fit --spool
+                                                    (must be on a filesystem shared with the host
+                                                    running peakipy fit)
+
+    Options:
+        -h --help                                   Show this page
+        -v --version                                Show version
+
+        --poll=<seconds>                            How often to check the spool for new tasks [default: 1.0]
+
+        --once                                      Exit once all tasks of the current (or next) run have
+                                                    been claimed instead of waiting for new runs
+
+
+    peakipy - deconvolute overlapping NMR peaks
+    Copyright (C) 2019  Jacob Peter Brady
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import sys
+
+from docopt import docopt
+from colorama import Fore, init
+from schema import Schema, And, Use, SchemaError
+
+from peakipy.commandline.fit import Spool, work_spool
+
+# colorama
+init(autoreset=True)
+
+
+def check_input(args):
+    """ Validate commandline input
+
+        :param args: docopt argument dictionary
+        :type args: dict
+
+    """
+    schema = Schema(
+        {
+            "--poll": And(
+                Use(float),
+                lambda n: 0 < n,
+                error=Fore.RED + "🤔 --poll must be a number of seconds greater than 0",
+            ),
+            object: object,
+        }
+    )
+    try:
+        return schema.validate(args)
+    except SchemaError as e:
+        exit(e)
+
+
+def main(arguments):
+    args = check_input(docopt(__doc__, argv=arguments))
+    spool = Spool(args["<spool>"])
+    print(Fore.GREEN + f"Waiting for tasks in {spool.path}")
+    n_fitted = work_spool(spool, once=args["--once"], poll=args["--poll"])
+    print(Fore.GREEN + f"Fitted {n_fitted} tasks")
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    main(arguments=argv)
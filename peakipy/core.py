@@ -20,10 +20,17 @@
 """
 
 
+import os
 import sys
 import json
+import pickle
+import hashlib
+import importlib
+import re
 from datetime import datetime
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import nmrglue as ng
@@ -32,21 +39,22 @@ import pandas as pd
 import textwrap
 from colorama import Fore, init
 
-from numba import jit
+from numba import jit, prange
 from numpy import sqrt, log, pi, exp, finfo
 from tabulate import tabulate
 
 from lmfit import Model
+from lmfit import fit_report as lmfit_fit_report
 from lmfit.model import ModelResult
-from lmfit.models import LinearModel
-from scipy.special import wofz
 
 from matplotlib import cm
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib.widgets import Button
 
 from bokeh.palettes import Category20
-from scipy import ndimage
+from scipy import ndimage, optimize
 from skimage.morphology import square, binary_closing, disk, rectangle
 from skimage.filters import threshold_otsu
 
@@ -107,6 +115,92 @@ def lorentzian(x, center=0.0, sigma=1.0):
     )
 
 
+def weideman_coefficients(n_terms=16):
+    """ Coefficients of Weideman's rational approximation to the Faddeeva function
+
+        Weideman, J.A.C. (1994) Computation of the complex error function.
+        SIAM J. Numer. Anal. 31(5), 1497-1518
+
+        :param n_terms: number of terms in the approximation
+        :type n_terms: int
+
+        :returns: array containing L followed by the n_terms polynomial coefficients
+        :rtype: numpy.array
+
+    """
+    M = 2 * n_terms
+    k = np.arange(-M + 1, M)
+    L = sqrt(n_terms / sqrt(2.0))
+    t = L * np.tan(k * π / M / 2.0)
+    f = np.concatenate(([0.0], exp(-(t ** 2)) * (L ** 2 + t ** 2)))
+    a = np.real(np.fft.fft(np.fft.fftshift(f))) / (2 * M)
+    return np.concatenate(([L], a[n_terms:0:-1]))
+
+
+# number of terms used for the voigt profile (see set_voigt_accuracy)
+voigt_terms = 16
+voigt_coefficients = weideman_coefficients(voigt_terms)
+
+
+def set_voigt_accuracy(n_terms=16):
+    """ Set the number of terms used to approximate the Voigt profile
+
+        More terms give a more accurate profile at a slightly higher cost.
+        Approximate maximum errors relative to peak height are 1e-4 for 8 terms,
+        1e-7 for 16 terms (default), 1e-10 for 24 terms and 1e-14 for 32 terms.
+
+        :param n_terms: number of terms in the rational approximation
+        :type n_terms: int
+
+    """
+    global voigt_terms, voigt_coefficients
+    voigt_terms = int(n_terms)
+    voigt_coefficients = weideman_coefficients(voigt_terms)
+
+
+@jit(nopython=True)
+def faddeeva(z, coefficients):
+    """ Faddeeva function w(z) for Im(z) >= 0 using Weideman's approximation
+
+        :param z: complex argument
+        :type z: complex or numpy.array
+        :param coefficients: output of :func:`weideman_coefficients`
+        :type coefficients: numpy.array
+
+        :returns: w(z)
+        :rtype: complex or numpy.array
+
+    """
+    L = coefficients[0]
+    denom = L - 1j * z
+    Z = (L + 1j * z) / denom
+    # Horner evaluation of the polynomial in Z
+    p = coefficients[1] + 0.0 * Z
+    for c in coefficients[2:]:
+        p = p * Z + c
+    return 2.0 * p / denom ** 2 + (1.0 / sqrt(π)) / denom
+
+
+@jit(nopython=True)
+def _voigt(x, center, sigma, gamma, coefficients):
+    z = (x - center + 1j * gamma) / max(tiny, (sigma * sqrt(2.0)))
+    return faddeeva(z, coefficients).real / max(tiny, (sigma * sqrt(2.0 * π)))
+
+
+@jit(nopython=True)
+def _voigt_jac(x, center, sigma, gamma, coefficients):
+    s2 = max(tiny, (sigma * sqrt(2.0)))
+    norm = max(tiny, (sigma * sqrt(2.0 * π)))
+    z = (x - center + 1j * gamma) / s2
+    w = faddeeva(z, coefficients)
+    dw = -2.0 * z * w + 2j / sqrt(π)
+    v = w.real / norm
+    d_center = (dw * (-1.0 / s2)).real / norm
+    d_gamma = (dw * (1j / s2)).real / norm
+    d_sigma = (dw * (-z / max(tiny, sigma))).real / norm - v / max(tiny, sigma)
+    return v, d_center, d_sigma, d_gamma
+
+
 def voigt(x, center=0.0, sigma=1.0, gamma=None):
     """Return a 1-dimensional Voigt function.
 
@@ -121,6 +215,8 @@ def voigt(x, center=0.0, sigma=1.0, gamma=None):
 
     .. _Voigt: https://en.wikipedia.org/wiki/Voigt_profile
 
+    The Faddeeva function is evaluated with a compiled rational approximation
+    (see :func:`faddeeva`) whose accuracy is set by :func:`set_voigt_accuracy`.
 
     :param x: x values
     :type x: numpy array 1d
@@ -138,8 +234,40 @@ def voigt(x, center=0.0, sigma=1.0, gamma=None):
     if gamma is None:
         gamma = sigma
 
-    z = (x - center + 1j * gamma) / max(tiny, (sigma * sqrt(2.0)))
-    return wofz(z).real / max(tiny, (sigma * sqrt(2.0 * π)))
+    return _voigt(x, center, sigma, gamma, voigt_coefficients)
+
+
+def voigt_jac(x, center=0.0, sigma=1.0, gamma=None):
+    r""" 1-dimensional Voigt function and its partial derivatives
+
+        Uses :math:`w'(z) = -2zw(z) + 2i/\sqrt{\pi}` for the derivative of the Faddeeva function.
+        If gamma is None then gamma = sigma (as in :func:`voigt`) and the sigma derivative
+        includes the contribution from gamma.
+
+        :param x: x values
+        :type x: numpy array 1d
+        :param center: center of lineshape in points
+        :type center: float
+        :param sigma: sigma of gaussian
+        :type sigma: float
+        :param gamma: gamma of lorentzian
+        :type gamma: float
+
+        :returns: voigt, d/dcenter, d/dsigma, d/dgamma
+        :rtype: tuple of numpy.array
+
+    """
+    tied = gamma is None
+    if tied:
+        gamma = sigma
+
+    v, d_center, d_sigma, d_gamma = _voigt_jac(
+        x, center, sigma, gamma, voigt_coefficients
+    )
+    if tied:
+        d_sigma = d_sigma + d_gamma
+        d_gamma = np.zeros_like(v)
+    return v, d_center, d_sigma, d_gamma
 
 
 @jit(nopython=True)
@@ -173,6 +301,187 @@ def pseudo_voigt(x, center=0.0, sigma=1.0, fraction=0.5):
     return pv
 
 
+@jit(nopython=True)
+def gaussian_jac(x, center=0.0, sigma=1.0):
+    """ 1-dimensional Gaussian function and its partial derivatives
+
+        :param x: x
+        :param center: center
+        :param sigma: sigma
+        :type x: numpy.array
+        :type center: float
+        :type sigma: float
+
+        :return: gaussian, d/dcenter, d/dsigma
+        :rtype: tuple of numpy.array
+
+    """
+    g = gaussian(x, center, sigma)
+    dx = 1.0 * x - center
+    d_center = g * dx / max(tiny, sigma ** 2)
+    d_sigma = g * (dx ** 2 / max(tiny, sigma ** 3) - 1.0 / max(tiny, sigma))
+    return g, d_center, d_sigma
+
+
+@jit(nopython=True)
+def lorentzian_jac(x, center=0.0, sigma=1.0):
+    """ 1-dimensional Lorentzian function and its partial derivatives
+
+        :param x: x
+        :param center: center
+        :param sigma: sigma
+        :type x: numpy.array
+        :type center: float
+        :type sigma: float
+
+        :return: lorentzian, d/dcenter, d/dsigma
+        :rtype: tuple of numpy.array
+
+    """
+    l = lorentzian(x, center, sigma)
+    u = (1.0 * x - center) / max(tiny, sigma)
+    d_center = l * 2.0 * u / (max(tiny, sigma) * (1.0 + u ** 2))
+    d_sigma = l * (2.0 * u ** 2 / (1.0 + u ** 2) - 1.0) / max(tiny, sigma)
+    return l, d_center, d_sigma
+
+
+@jit(nopython=True)
+def pseudo_voigt_jac(x, center=0.0, sigma=1.0, fraction=0.5):
+    """ 1-dimensional Pseudo-voigt function and its partial derivatives
+
+        :param x: data
+        :type x: numpy.array
+        :param center: center of peak
+        :type center: float
+        :param sigma: sigma of lineshape
+        :type sigma: float
+        :param fraction: fraction of lorentzian lineshape (between 0 and 1)
+        :type fraction: float
+
+        :return: pseudo-voigt, d/dcenter, d/dsigma, d/dfraction
+        :rtype: tuple of numpy.array
+
+    """
+    sigma_scale = 1.0 / sqrt(2 * log2)
+    g, g_center, g_sigma = gaussian_jac(x, center, sigma * sigma_scale)
+    l, l_center, l_sigma = lorentzian_jac(x, center, sigma)
+    pv = (1 - fraction) * g + fraction * l
+    d_center = (1 - fraction) * g_center + fraction * l_center
+    d_sigma = (1 - fraction) * g_sigma * sigma_scale + fraction * l_sigma
+    d_fraction = l - g
+    return pv, d_center, d_sigma, d_fraction
+
+
+class GridXY:
+    """ Separable X and Y coordinates for evaluating 2D lineshapes
+
+        All 2D lineshapes are a product of an x profile and a y profile so the
+        1D profiles only need to be calculated once on the unique x and y
+        coordinates of a spectrum (or window of a spectrum). They are then
+        either combined as an outer product with shape (len(y), len(x)) or,
+        if x_index and y_index are given, only the selected pixels are gathered
+        (e.g. the pixels of a fit mask).
+
+        Unpacks like an [X, Y] pair (i.e. ``x, y = XY``) so it can be passed as
+        XY to any of the 2D lineshape functions.
+
+        :param x: unique x coordinates (points)
+        :type x: numpy.array
+
+        :param y: unique y coordinates (points)
+        :type y: numpy.array
+
+        :param x_index: index into x for each selected pixel
+        :type x_index: numpy.array
+
+        :param y_index: index into y for each selected pixel
+        :type y_index: numpy.array
+
+    """
+
+    def __init__(self, x, y, x_index=None, y_index=None):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.x_index = x_index
+        self.y_index = y_index
+
+    @classmethod
+    def from_mask(cls, mask, x0=0, y0=0):
+        """ Make GridXY for the selected pixels of a boolean mask
+
+            Pixels are in the same (row major) order as data[mask]
+
+            :param mask: 2D boolean mask
+            :type mask: numpy.array
+
+            :param x0: x coordinate of first column of mask
+            :type x0: int
+
+            :param y0: y coordinate of first row of mask
+            :type y0: int
+
+            :returns: GridXY
+            :rtype: GridXY
+        """
+        y_index, x_index = [np.ascontiguousarray(i) for i in np.nonzero(mask)]
+        n_y, n_x = mask.shape
+        return cls(np.arange(x0, x0 + n_x), np.arange(y0, y0 + n_y), x_index, y_index)
+
+    def __iter__(self):
+        yield self.x
+        yield self.y
+
+    def __len__(self):
+        return 2
+
+    @property
+    def points(self):
+        """ Explicit [X, Y] coordinates of every pixel
+
+            :returns: array with shape (2, n_pixels) for gathered pixels or (2, len(y), len(x)) for full grid
+            :rtype: numpy.array
+        """
+        if self.x_index is None:
+            return np.array(np.meshgrid(self.x, self.y))
+        return np.array([self.x[self.x_index], self.y[self.y_index]])
+
+    def combine(self, f_x, f_y):
+        """ Combine 1D profiles evaluated on x and y into 2D values
+
+            :param f_x: profile evaluated on x
+            :type f_x: numpy.array
+
+            :param f_y: profile evaluated on y
+            :type f_y: numpy.array
+
+            :returns: gathered pixel values or outer product with shape (len(y), len(x))
+            :rtype: numpy.array
+        """
+        if self.x_index is None:
+            return np.outer(f_y, f_x)
+        return f_x[self.x_index] * f_y[self.y_index]
+
+
+def outer_xy(XY, f_x, f_y):
+    """ Combine x and y profiles of a 2D lineshape
+
+        :param XY: [X, Y] coordinates or GridXY that the profiles were evaluated on
+        :type XY: numpy.array or GridXY
+
+        :param f_x: profile evaluated on X
+        :type f_x: numpy.array
+
+        :param f_y: profile evaluated on Y
+        :type f_y: numpy.array
+
+        :returns: pointwise product of profiles (or separable combination for GridXY)
+        :rtype: numpy.array
+    """
+    if isinstance(XY, GridXY):
+        return XY.combine(f_x, f_y)
+    return f_x * f_y
+
+
 # @jit(nopython=True)
 def pvoigt2d(
     XY,
@@ -187,8 +496,8 @@ def pvoigt2d(
 
         :math:`(1-fraction) G(x,center,\sigma_{gx}) + (fraction) L(x, center, \sigma_x) * (1-fraction) G(y,center,\sigma_{gy}) + (fraction) L(y, center, \sigma_y)`
 
-        :param XY: meshgrid of X and Y coordinates [X,Y] each with shape Z
-        :type XY: numpy.array
+        :param XY: meshgrid of X and Y coordinates [X,Y] each with shape Z or GridXY
+        :type XY: numpy.array or GridXY
 
         :param amplitude: amplitude of peak
         :type amplitude: float
@@ -227,7 +536,7 @@ def pvoigt2d(
     # pv_y = (1 - fraction) * gaussian(y, center_y, sigma_gy) + fraction * lorentzian(
     #    y, center_y, sigma_y
     # )
-    return amplitude * pv_x * pv_y
+    return amplitude * outer_xy(XY, pv_x, pv_y)
 
 
 # @jit(nopython=True)
@@ -245,7 +554,7 @@ def pv_l(
         Arguments
         =========
 
-            -- XY: meshgrid of X and Y coordinates [X,Y] each with shape Z
+            -- XY: meshgrid of X and Y coordinates [X,Y] each with shape Z or GridXY
             -- amplitude: peak amplitude (gaussian and lorentzian)
             -- center_x: position of peak in x
             -- center_y: position of peak in y
@@ -263,7 +572,7 @@ def pv_l(
     x, y = XY
     pv_x = pseudo_voigt(x, center_x, sigma_x, fraction)
     pv_y = pseudo_voigt(y, center_y, sigma_y, 1.0)  # lorentzian
-    return amplitude * pv_x * pv_y
+    return amplitude * outer_xy(XY, pv_x, pv_y)
 
 
 # @jit(nopython=True)
@@ -281,7 +590,7 @@ def pv_g(
         Arguments
         ---------
 
-            -- XY: meshgrid of X and Y coordinates [X,Y] each with shape Z
+            -- XY: meshgrid of X and Y coordinates [X,Y] each with shape Z or GridXY
             -- amplitude: peak amplitude (gaussian and lorentzian)
             -- center_x: position of peak in x
             -- center_y: position of peak in y
@@ -298,7 +607,7 @@ def pv_g(
     x, y = XY
     pv_x = pseudo_voigt(x, center_x, sigma_x, fraction)
     pv_y = pseudo_voigt(y, center_y, sigma_y, 0.0)  # gaussian
-    return amplitude * pv_x * pv_y
+    return amplitude * outer_xy(XY, pv_x, pv_y)
 
 
 # @jit(nopython=True)
@@ -318,7 +627,7 @@ def pv_pv(
         Arguments
         =========
 
-            -- XY: meshgrid of X and Y coordinates [X,Y] each with shape Z
+            -- XY: meshgrid of X and Y coordinates [X,Y] each with shape Z or GridXY
             -- amplitude: peak amplitude (gaussian and lorentzian)
             -- center_x: position of peak in x
             -- center_y: position of peak in y
@@ -337,7 +646,7 @@ def pv_pv(
     x, y = XY
     pv_x = pseudo_voigt(x, center_x, sigma_x, fraction_x)
     pv_y = pseudo_voigt(y, center_y, sigma_y, fraction_y)
-    return amplitude * pv_x * pv_y
+    return amplitude * outer_xy(XY, pv_x, pv_y)
 
 
 # @jit(nopython=True)
@@ -355,7 +664,7 @@ def gaussian_lorentzian(
         Arguments
         =========
 
-            -- XY: meshgrid of X and Y coordinates [X,Y] each with shape Z
+            -- XY: meshgrid of X and Y coordinates [X,Y] each with shape Z or GridXY
             -- amplitude: peak amplitude (gaussian and lorentzian)
             -- center_x: position of peak in x
             -- center_y: position of peak in y
@@ -372,7 +681,7 @@ def gaussian_lorentzian(
     x, y = XY
     pv_x = pseudo_voigt(x, center_x, sigma_x, 0.0)  # gaussian
     pv_y = pseudo_voigt(y, center_y, sigma_y, 1.0)  # lorentzian
-    return amplitude * pv_x * pv_y
+    return amplitude * outer_xy(XY, pv_x, pv_y)
 
 
 def voigt2d(
@@ -386,13 +695,813 @@ def voigt2d(
     gamma_y=1.0,
     fraction=0.5,
 ):
-    fraction = 0.5
-    gamma_x = None
-    gamma_y = None
+    """ 2D Voigt model
+
+        :param XY: meshgrid of X and Y coordinates [X,Y] each with shape Z
+        :type XY: numpy.array or GridXY
+
+        :param amplitude: amplitude of peak
+        :type amplitude: float
+
+        :param center_x: center of peak in x
+        :type center_x: float
+
+        :param center_y: center of peak in y
+        :type center_y: float
+
+        :param sigma_x: gaussian sigma in x
+        :type sigma_x: float
+
+        :param sigma_y: gaussian sigma in y
+        :type sigma_y: float
+
+        :param gamma_x: lorentzian gamma in x
+        :type gamma_x: float
+
+        :param gamma_y: lorentzian gamma in y
+        :type gamma_y: float
+
+        :param fraction: not used (kept so that V fits report the same columns)
+        :type fraction: float
+
+        :returns: flattened array of Z values (use Z.reshape(X.shape) for recovery)
+        :rtype: numpy.array
+
+    """
     x, y = XY
     voigt_x = voigt(x, center_x, sigma_x, gamma_x)
     voigt_y = voigt(y, center_y, sigma_y, gamma_y)
-    return amplitude * voigt_x * voigt_y
+    return amplitude * outer_xy(XY, voigt_x, voigt_y)
+
+
+def _pv_product_jac(
+    XY, amplitude, center_x, center_y, sigma_x, sigma_y, fraction_x, fraction_y
+):
+    """ Partial derivatives of amplitude * pseudo_voigt(x) * pseudo_voigt(y)
+
+        :returns: dict of derivatives keyed by amplitude, center_x, center_y,
+                  sigma_x, sigma_y, fraction_x and fraction_y
+        :rtype: dict
+
+    """
+    x, y = XY
+    pv_x, d_cx, d_sx, d_fx = pseudo_voigt_jac(x, center_x, sigma_x, fraction_x)
+    pv_y, d_cy, d_sy, d_fy = pseudo_voigt_jac(y, center_y, sigma_y, fraction_y)
+    return {
+        "amplitude": outer_xy(XY, pv_x, pv_y),
+        "center_x": amplitude * outer_xy(XY, d_cx, pv_y),
+        "center_y": amplitude * outer_xy(XY, pv_x, d_cy),
+        "sigma_x": amplitude * outer_xy(XY, d_sx, pv_y),
+        "sigma_y": amplitude * outer_xy(XY, pv_x, d_sy),
+        "fraction_x": amplitude * outer_xy(XY, d_fx, pv_y),
+        "fraction_y": amplitude * outer_xy(XY, pv_x, d_fy),
+    }
+
+
+def pvoigt2d_jac(
+    XY,
+    amplitude=1.0,
+    center_x=0.5,
+    center_y=0.5,
+    sigma_x=1.0,
+    sigma_y=1.0,
+    fraction=0.5,
+):
+    """ Partial derivatives of :func:`pvoigt2d` with respect to each parameter
+
+        :return: dict of flattened arrays keyed by parameter name
+        :rtype: dict
+
+    """
+    jac = _pv_product_jac(
+        XY, amplitude, center_x, center_y, sigma_x, sigma_y, fraction, fraction
+    )
+    jac["fraction"] = jac.pop("fraction_x") + jac.pop("fraction_y")
+    return jac
+
+
+def pv_l_jac(
+    XY,
+    amplitude=1.0,
+    center_x=0.5,
+    center_y=0.5,
+    sigma_x=1.0,
+    sigma_y=1.0,
+    fraction=0.5,
+):
+    """ Partial derivatives of :func:`pv_l` with respect to each parameter
+
+        :return: dict of flattened arrays keyed by parameter name
+        :rtype: dict
+
+    """
+    jac = _pv_product_jac(
+        XY, amplitude, center_x, center_y, sigma_x, sigma_y, fraction, 1.0
+    )
+    jac["fraction"] = jac.pop("fraction_x")
+    del jac["fraction_y"]
+    return jac
+
+
+def pv_g_jac(
+    XY,
+    amplitude=1.0,
+    center_x=0.5,
+    center_y=0.5,
+    sigma_x=1.0,
+    sigma_y=1.0,
+    fraction=0.5,
+):
+    """ Partial derivatives of :func:`pv_g` with respect to each parameter
+
+        :return: dict of flattened arrays keyed by parameter name
+        :rtype: dict
+
+    """
+    jac = _pv_product_jac(
+        XY, amplitude, center_x, center_y, sigma_x, sigma_y, fraction, 0.0
+    )
+    jac["fraction"] = jac.pop("fraction_x")
+    del jac["fraction_y"]
+    return jac
+
+
+def pv_pv_jac(
+    XY,
+    amplitude=1.0,
+    center_x=0.5,
+    center_y=0.5,
+    sigma_x=1.0,
+    sigma_y=1.0,
+    fraction_x=0.5,
+    fraction_y=0.5,
+):
+    """ Partial derivatives of :func:`pv_pv` with respect to each parameter
+
+        :return: dict of flattened arrays keyed by parameter name
+        :rtype: dict
+
+    """
+    return _pv_product_jac(
+        XY, amplitude, center_x, center_y, sigma_x, sigma_y, fraction_x, fraction_y
+    )
+
+
+def gaussian_lorentzian_jac(
+    XY,
+    amplitude=1.0,
+    center_x=0.5,
+    center_y=0.5,
+    sigma_x=1.0,
+    sigma_y=1.0,
+    fraction=0.5,
+):
+    """ Partial derivatives of :func:`gaussian_lorentzian` with respect to each parameter
+
+        fraction is not used by this lineshape so its derivative is zero
+
+        :return: dict of flattened arrays keyed by parameter name
+        :rtype: dict
+
+    """
+    jac = _pv_product_jac(XY, amplitude, center_x, center_y, sigma_x, sigma_y, 0.0, 1.0)
+    del jac["fraction_x"], jac["fraction_y"]
+    jac["fraction"] = np.zeros_like(jac["amplitude"])
+    return jac
+
+
+def voigt2d_jac(
+    XY,
+    amplitude=1.0,
+    center_x=0.5,
+    center_y=0.5,
+    sigma_x=1.0,
+    sigma_y=1.0,
+    gamma_x=1.0,
+    gamma_y=1.0,
+    fraction=0.5,
+):
+    """ Partial derivatives of :func:`voigt2d` with respect to each parameter
+
+        fraction is not used by this lineshape so its derivative is zero
+
+        :return: dict of flattened arrays keyed by parameter name
+        :rtype: dict
+
+    """
+    x, y = XY
+    v_x, d_cx, d_sx, d_gx = voigt_jac(x, center_x, sigma_x, gamma_x)
+    v_y, d_cy, d_sy, d_gy = voigt_jac(y, center_y, sigma_y, gamma_y)
+    v_xy = outer_xy(XY, v_x, v_y)
+    return {
+        "amplitude": v_xy,
+        "center_x": amplitude * outer_xy(XY, d_cx, v_y),
+        "center_y": amplitude * outer_xy(XY, v_x, d_cy),
+        "sigma_x": amplitude * outer_xy(XY, d_sx, v_y),
+        "sigma_y": amplitude * outer_xy(XY, v_x, d_sy),
+        "gamma_x": amplitude * outer_xy(XY, d_gx, v_y),
+        "gamma_y": amplitude * outer_xy(XY, v_x, d_gy),
+        "fraction": np.zeros_like(v_xy),
+    }
+
+
+# analytic Jacobians of the 2D lineshape models used in fitting
+lineshape_jacobians = {
+    pvoigt2d: pvoigt2d_jac,
+    pv_l: pv_l_jac,
+    pv_g: pv_g_jac,
+    pv_pv: pv_pv_jac,
+    gaussian_lorentzian: gaussian_lorentzian_jac,
+    voigt2d: voigt2d_jac,
+}
+
+
+def _lmfit_residual_sign():
+    """ Sign of the lmfit Model residual relative to the model function
+
+        lmfit < 1.0 defines the residual as (model - data) * weights
+        whereas later versions use (data - model) * weights.
+
+        :returns: 1.0 or -1.0
+        :rtype: float
+
+    """
+
+    def line(x, slope=1.0):
+        return slope * x
+
+    mod = Model(line)
+    residual = mod._residual(
+        mod.make_params(slope=1.0), np.zeros(1), None, x=np.ones(1)
+    )
+    return float(np.sign(residual[0]))
+
+
+residual_sign = _lmfit_residual_sign()
+
+
+def make_jacobian(mod, col_deriv=True):
+    """ Make an analytic Jacobian function for an lmfit (composite) model
+
+        The returned function has the call signature expected by lmfit for
+        the Dfun (leastsq) or jac (least_squares) fit keywords and returns
+        the derivatives of the weighted residual with respect to all
+        varying parameters.
+
+        :param mod: lmfit Model or CompositeModel of lineshapes in lineshape_jacobians
+        :type mod: lmfit.Model
+
+        :param col_deriv: if True return shape (n_varying, n_points) otherwise (n_points, n_varying)
+        :type col_deriv: bool
+
+        :returns: jacobian function or None if a component has no analytic Jacobian
+        :rtype: function
+
+    """
+    components = []
+    for component in mod.components:
+        jac_func = lineshape_jacobians.get(component.func)
+        if jac_func is None:
+            return None
+        components.append((component.prefix, jac_func, component.param_names))
+
+    def jacobian(params, data=None, weights=None, XY=None, **kwargs):
+        columns = {}
+        for prefix, jac_func, param_names in components:
+            func_args = {
+                name[len(prefix) :]: params[name].value for name in param_names
+            }
+            for name, column in jac_func(XY, **func_args).items():
+                columns[prefix + name] = column
+
+        jac = np.array(
+            [columns[name] for name, par in params.items() if par.vary], dtype=float,
+        )
+        jac *= residual_sign
+        if weights is not None:
+            jac *= weights
+        if col_deriv:
+            return jac
+        return jac.T
+
+    return jacobian
+
+
+def jacobian_fit_kws(mod, fit_method="leastsq"):
+    """ lmfit fit keywords for using the analytic Jacobian of mod
+
+        :param mod: lmfit model
+        :type mod: lmfit.Model
+
+        :param fit_method: lmfit fitting method
+        :type fit_method: str
+
+        :returns: fit_kws for lmfit.Model.fit (empty if no analytic Jacobian is available)
+        :rtype: dict
+
+    """
+    if fit_method == "leastsq":
+        jacobian = make_jacobian(mod, col_deriv=True)
+        if jacobian is not None:
+            return {"Dfun": jacobian, "col_deriv": True}
+
+    elif fit_method == "least_squares":
+        jacobian = make_jacobian(mod, col_deriv=False)
+        if jacobian is not None:
+            return {"jac": jacobian}
+
+    return {}
+
+
+@jit(nopython=True)
+def pseudo_voigt_profiles(x, y, params, coefficients):
+    """ Evaluate x and y pseudo-voigt profiles of every peak in a cluster
+
+        :param params: array with shape (n_peaks, 7) containing amplitude, center_x, center_y, sigma_x, sigma_y, fraction_x and fraction_y of each peak
+        :type params: numpy.array
+        :param coefficients: not used
+        :type coefficients: numpy.array
+
+        :returns: amplitude scaled x profiles and y profiles
+        :rtype: tuple of numpy.array
+
+    """
+    n_peaks = params.shape[0]
+    profiles_x = np.empty((n_peaks, x.shape[0]))
+    profiles_y = np.empty((n_peaks, y.shape[0]))
+    for p in range(n_peaks):
+        # amplitude is folded into the x profile
+        profiles_x[p] = params[p, 0] * pseudo_voigt(
+            x, params[p, 1], params[p, 3], params[p, 5]
+        )
+        profiles_y[p] = pseudo_voigt(y, params[p, 2], params[p, 4], params[p, 6])
+    return profiles_x, profiles_y
+
+
+@jit(nopython=True)
+def voigt_profiles(x, y, params, coefficients):
+    """ Evaluate x and y voigt profiles of every peak in a cluster
+
+        :param params: array with shape (n_peaks, 7) containing amplitude, center_x, center_y, sigma_x, sigma_y, gamma_x and gamma_y of each peak
+        :type params: numpy.array
+        :param coefficients: output of :func:`weideman_coefficients`
+        :type coefficients: numpy.array
+
+        :returns: amplitude scaled x profiles and y profiles
+        :rtype: tuple of numpy.array
+
+    """
+    n_peaks = params.shape[0]
+    profiles_x = np.empty((n_peaks, x.shape[0]))
+    profiles_y = np.empty((n_peaks, y.shape[0]))
+    for p in range(n_peaks):
+        profiles_x[p] = params[p, 0] * _voigt(
+            x, params[p, 1], params[p, 3], params[p, 5], coefficients
+        )
+        profiles_y[p] = _voigt(
+            y, params[p, 2], params[p, 4], params[p, 6], coefficients
+        )
+    return profiles_x, profiles_y
+
+
+def make_cluster_kernels(profiles, parallel=False):
+    """ Compile model and residual kernels for a cluster profile function
+
+        The kernels evaluate the x and y profiles of all peaks once and then sum
+        their products in a single pass over the pixels.
+
+        model(x, y, x_index, y_index, params, coefficients, out)
+
+        residual(x, y, x_index, y_index, params, coefficients, data, weights, sign, out)
+        which writes sign * (model - data) * weights into out
+
+        where x and y are the unique coordinates, x_index and y_index index into
+        x and y for each pixel, params has shape (n_peaks, 7) and out is a
+        preallocated array with one value per pixel.
+
+        :param profiles: jitted function returning x and y profiles (e.g. :func:`pseudo_voigt_profiles`)
+        :type profiles: function
+        :param parallel: compile multithreaded kernels
+        :type parallel: bool
+
+        :returns: model and residual kernels
+        :rtype: tuple
+
+    """
+
+    def model(x, y, x_index, y_index, params, coefficients, out):
+        profiles_x, profiles_y = profiles(x, y, params, coefficients)
+        n_peaks = params.shape[0]
+        for k in prange(x_index.shape[0]):
+            total = 0.0
+            for p in range(n_peaks):
+                total += profiles_x[p, x_index[k]] * profiles_y[p, y_index[k]]
+            out[k] = total
+
+    def residual(
+        x, y, x_index, y_index, params, coefficients, data, weights, sign, out
+    ):
+        profiles_x, profiles_y = profiles(x, y, params, coefficients)
+        n_peaks = params.shape[0]
+        for k in prange(x_index.shape[0]):
+            total = 0.0
+            for p in range(n_peaks):
+                total += profiles_x[p, x_index[k]] * profiles_y[p, y_index[k]]
+            out[k] = sign * (total - data[k]) * weights[k]
+
+    return (
+        jit(nopython=True, parallel=parallel)(model),
+        jit(nopython=True, parallel=parallel)(residual),
+    )
+
+
+# model and residual kernels keyed by profile function
+# with multithreaded versions for large windows when not using multiprocessing
+cluster_kernels = {
+    profiles: {
+        False: make_cluster_kernels(profiles),
+        True: make_cluster_kernels(profiles, parallel=True),
+    }
+    for profiles in [pseudo_voigt_profiles, voigt_profiles]
+}
+# minimum number of pixels for which the multithreaded kernels are used
+parallel_min_pixels = 20000
+
+# profile function and parameter layout of the cluster kernel for each 2D lineshape
+# (amplitude, center_x, center_y, sigma_x, sigma_y, fraction_x/gamma_x, fraction_y/gamma_y)
+# strings are parameter names and floats are fixed values
+cluster_kernel_layouts = {
+    pvoigt2d: (
+        pseudo_voigt_profiles,
+        (
+            "amplitude",
+            "center_x",
+            "center_y",
+            "sigma_x",
+            "sigma_y",
+            "fraction",
+            "fraction",
+        ),
+    ),
+    pv_l: (
+        pseudo_voigt_profiles,
+        ("amplitude", "center_x", "center_y", "sigma_x", "sigma_y", "fraction", 1.0),
+    ),
+    pv_g: (
+        pseudo_voigt_profiles,
+        ("amplitude", "center_x", "center_y", "sigma_x", "sigma_y", "fraction", 0.0),
+    ),
+    pv_pv: (
+        pseudo_voigt_profiles,
+        (
+            "amplitude",
+            "center_x",
+            "center_y",
+            "sigma_x",
+            "sigma_y",
+            "fraction_x",
+            "fraction_y",
+        ),
+    ),
+    gaussian_lorentzian: (
+        pseudo_voigt_profiles,
+        ("amplitude", "center_x", "center_y", "sigma_x", "sigma_y", 0.0, 1.0),
+    ),
+    voigt2d: (
+        voigt_profiles,
+        (
+            "amplitude",
+            "center_x",
+            "center_y",
+            "sigma_x",
+            "sigma_y",
+            "gamma_x",
+            "gamma_y",
+        ),
+    ),
+}
+
+
+class Lineshape:
+    """ Vectorized quantities derived from fitted parameters of a 2D lineshape
+
+        All methods take a DataFrame of fit results (one row per peak and plane
+        with amp, sigma_x, sigma_y, fraction/gamma columns etc.) and return
+        arrays so that derived columns are calculated for every row at once.
+        The x and y profiles of each lineshape are taken from
+        :data:`cluster_kernel_layouts`.
+
+        :param model: 2D lineshape function used for fitting
+        :type model: function
+
+    """
+
+    def __init__(self, model):
+        self.model = model
+        profiles, layout = cluster_kernel_layouts[model]
+        self.voigt = profiles is voigt_profiles
+        # fraction (pseudo-voigt) or gamma (voigt) of each dimension
+        self.shape_x, self.shape_y = layout[5:]
+
+    @property
+    def columns(self):
+        """ Fit result columns passed (in order, after XY) to the model """
+        shapes = [i for i in (self.shape_x, self.shape_y) if isinstance(i, str)]
+        return ["amp", "center_x", "center_y", "sigma_x", "sigma_y"] + list(
+            dict.fromkeys(shapes)
+        )
+
+    @staticmethod
+    def _column(df, spec):
+        if isinstance(spec, str):
+            return df[spec].to_numpy(dtype=float)
+        return np.full(len(df), spec)
+
+    def _peak_value(self, sigma, shape):
+        """ Value of a normalised 1D profile at its center """
+        if self.voigt:
+            s2 = np.maximum(tiny, sigma * sqrt(2.0))
+            norm = np.maximum(tiny, sigma * sqrt(2.0 * π))
+            w = faddeeva(1j * shape / s2, voigt_coefficients)
+            return w.real / norm
+        sigma_g = sigma / sqrt(2 * log2)
+        return (1 - shape) / np.maximum(tiny, sqrt(2 * π) * sigma_g) + shape / (
+            np.maximum(tiny, π * sigma)
+        )
+
+    def height(self, df, amplitude="amp"):
+        """ Peak heights
+
+            :param df: fit results
+            :type df: pandas.DataFrame
+            :param amplitude: column to scale by (e.g. amp_err for errors)
+            :type amplitude: str
+
+            :returns: heights
+            :rtype: numpy.array
+        """
+        peak_x = self._peak_value(
+            df.sigma_x.to_numpy(dtype=float), self._column(df, self.shape_x)
+        )
+        peak_y = self._peak_value(
+            df.sigma_y.to_numpy(dtype=float), self._column(df, self.shape_y)
+        )
+        return df[amplitude].to_numpy(dtype=float) * peak_x * peak_y
+
+    def volume(self, df, amplitude="amp"):
+        """ Peak volumes (the profiles are normalised so this is the amplitude)
+
+            :param df: fit results
+            :type df: pandas.DataFrame
+            :param amplitude: column to scale by (e.g. amp_err for errors)
+            :type amplitude: str
+
+            :returns: volumes
+            :rtype: numpy.array
+        """
+        return df[amplitude].to_numpy(dtype=float).copy()
+
+    def fwhm(self, df):
+        """ Full widths at half maximum in points
+
+            :param df: fit results
+            :type df: pandas.DataFrame
+
+            :returns: fwhm_x and fwhm_y (and gaussian and lorentzian components
+                      fwhm_g_x, fwhm_l_x, fwhm_g_y and fwhm_l_y for voigt)
+            :rtype: dict of numpy.array
+        """
+        fwhm = {}
+        for dim, shape in (("x", self.shape_x), ("y", self.shape_y)):
+            sigma = df[f"sigma_{dim}"].to_numpy(dtype=float)
+            if self.voigt:
+                # Olivero and Longbothum (1977) approximation
+                fwhm_g = 2.0 * sigma * sqrt(2.0 * log2)
+                fwhm_l = 2.0 * self._column(df, shape)
+                fwhm[f"fwhm_g_{dim}"] = fwhm_g
+                fwhm[f"fwhm_l_{dim}"] = fwhm_l
+                fwhm[f"fwhm_{dim}"] = 0.5346 * fwhm_l + sqrt(
+                    0.2166 * fwhm_l ** 2.0 + fwhm_g ** 2.0
+                )
+            else:
+                # sigma is the half width of both gaussian and lorentzian components
+                fwhm[f"fwhm_{dim}"] = 2.0 * sigma
+        return fwhm
+
+    def simulate(self, df, x, y):
+        """ Simulate each peak on a grid
+
+            The x and y profiles of all rows are evaluated in one call and
+            multiplied out, so only the grid of interest (e.g. the bounding box
+            of a cluster) has to be simulated.
+
+            :param df: fit results
+            :type df: pandas.DataFrame
+            :param x: x coordinates (points) of the grid columns
+            :type x: numpy.array
+            :param y: y coordinates (points) of the grid rows
+            :type y: numpy.array
+
+            :returns: simulated peaks with shape (len(df), len(y), len(x))
+            :rtype: numpy.array
+        """
+        params = np.column_stack(
+            [
+                df.amp.to_numpy(dtype=float),
+                df.center_x.to_numpy(dtype=float),
+                df.center_y.to_numpy(dtype=float),
+                df.sigma_x.to_numpy(dtype=float),
+                df.sigma_y.to_numpy(dtype=float),
+                self._column(df, self.shape_x),
+                self._column(df, self.shape_y),
+            ]
+        )
+        profiles, _ = cluster_kernel_layouts[self.model]
+        profiles_x, profiles_y = profiles(
+            np.asarray(x, dtype=float),
+            np.asarray(y, dtype=float),
+            params,
+            voigt_coefficients,
+        )
+        return profiles_y[:, :, np.newaxis] * profiles_x[:, np.newaxis, :]
+
+
+# lineshapes by the names used for --lineshape and in the lineshape column of fit results
+lineshapes = {
+    "PV": Lineshape(pvoigt2d),
+    "G": Lineshape(pvoigt2d),
+    "L": Lineshape(pvoigt2d),
+    "PV_PV": Lineshape(pv_pv),
+    "PV_L": Lineshape(pv_l),
+    "PV_G": Lineshape(pv_g),
+    "G_L": Lineshape(gaussian_lorentzian),
+    "V": Lineshape(voigt2d),
+}
+
+
+def kernel_coords(XY):
+    """ Convert XY to the separable coordinates used by the cluster kernels
+
+        :param XY: [X, Y] coordinates or GridXY
+        :type XY: numpy.array or GridXY
+
+        :returns: x, y, x_index, y_index and shape of the evaluated model
+        :rtype: tuple
+    """
+    if isinstance(XY, GridXY):
+        if XY.x_index is None:
+            n_x, n_y = len(XY.x), len(XY.y)
+            x_index = np.tile(np.arange(n_x), n_y)
+            y_index = np.repeat(np.arange(n_y), n_x)
+            return XY.x, XY.y, x_index, y_index, (n_y, n_x)
+        return XY.x, XY.y, XY.x_index, XY.y_index, XY.x_index.shape
+
+    X, Y = XY
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    index = np.arange(X.size)
+    return X.ravel(), Y.ravel(), index, index, X.shape
+
+
+class ClusterModel(Model):
+    """ lmfit Model of a cluster of peaks evaluated by a single compiled kernel
+
+        Parameter names and bookkeeping are the same as for the composite model
+        built by adding one lmfit.Model per peak (i.e. prefix + parameter name)
+        but evaluation and residual calculation for all peaks are done in one
+        call to a numba kernel that writes into a single output array. Lineshapes
+        without a kernel layout fall back to summing the individual peak models.
+
+        :param func: 2D lineshape function
+        :type func: function
+
+        :param prefixes: lmfit prefix for each peak in the cluster
+        :type prefixes: list
+
+        :param parallel: use multithreaded kernel for large windows
+        :type parallel: bool
+
+    """
+
+    def __init__(self, func, prefixes, parallel=False, **kws):
+        self.peak_models = [Model(func, prefix=prefix) for prefix in prefixes]
+        self.parallel = parallel
+        if len(prefixes) == 1:
+            prefix = prefixes[0]
+        else:
+            prefix = ""
+        Model.__init__(self, func, prefix=prefix, **kws)
+        layout = cluster_kernel_layouts.get(func)
+        if layout is None:
+            self._profiles = None
+            self._layout = None
+        else:
+            self._profiles, layout = layout
+            self._layout = [
+                [p.prefix + i if type(i) == str else float(i) for i in layout]
+                for p in self.peak_models
+            ]
+
+    @property
+    def param_names(self):
+        """ Return parameter names of all peaks in cluster """
+        return [name for mod in self.peak_models for name in mod.param_names]
+
+    @property
+    def components(self):
+        """ Return the individual peak models """
+        return self.peak_models
+
+    def _reprstring(self, long=False):
+        return " + ".join(mod._reprstring(long=long) for mod in self.peak_models)
+
+    def eval_components(self, params=None, **kwargs):
+        """ Return dictionary of name, results for each peak """
+        out = {}
+        for mod in self.peak_models:
+            out.update(mod.eval_components(params=params, **kwargs))
+        return out
+
+    def amplitude_basis(self, params, XY):
+        """ Unit amplitude profile of each peak (one column per peak)
+
+            :param params: lmfit parameters
+            :type params: lmfit.Parameters
+            :param XY: coordinates at which to evaluate the profiles
+            :type XY: numpy.array or GridXY
+
+            :returns: array with shape (n_pixels, n_peaks)
+            :rtype: numpy.array
+
+        """
+        columns = []
+        for mod in self.peak_models:
+            kws = {
+                name[len(mod.prefix) :]: params[name].value for name in mod.param_names
+            }
+            kws["amplitude"] = 1.0
+            columns.append(np.ravel(mod.func(XY, **kws)))
+        return np.column_stack(columns)
+
+    def kernel_params(self, params):
+        """ Pack lmfit parameters into the (n_peaks, 7) kernel parameter array """
+        return np.array(
+            [
+                [params[i].value if type(i) == str else i for i in peak]
+                for peak in self._layout
+            ],
+            dtype=float,
+        )
+
+    def _kernels(self, n_pixels):
+        parallel = self.parallel and n_pixels >= parallel_min_pixels
+        return cluster_kernels[self._profiles][parallel]
+
+    def eval(self, params=None, **kwargs):
+        """ Evaluate the summed model of all peaks in the cluster """
+        if params is None:
+            params = self.make_params()
+        if self._layout is None:
+            return sum(mod.eval(params=params, **kwargs) for mod in self.peak_models)
+
+        x, y, x_index, y_index, shape = kernel_coords(kwargs["XY"])
+        out = np.empty(len(x_index))
+        model_kernel, _ = self._kernels(len(x_index))
+        model_kernel(
+            x, y, x_index, y_index, self.kernel_params(params), voigt_coefficients, out,
+        )
+        return out.reshape(shape)
+
+    def _residual(self, params, data, weights, **kwargs):
+        """ Weighted residual with the same sign convention as lmfit.Model """
+        if self._layout is None:
+            return Model._residual(self, params, data, weights, **kwargs)
+
+        x, y, x_index, y_index, shape = kernel_coords(kwargs["XY"])
+        data = np.asarray(data, dtype=float).ravel()
+        if weights is None:
+            weights = np.ones_like(data)
+        else:
+            weights = np.asarray(weights, dtype=float).ravel()
+        out = np.empty(len(x_index))
+        _, residual_kernel = self._kernels(len(x_index))
+        residual_kernel(
+            x,
+            y,
+            x_index,
+            y_index,
+            self.kernel_params(params),
+            voigt_coefficients,
+            data,
+            weights,
+            residual_sign,
+            out,
+        )
+        if self.nan_policy == "raise" and not np.all(np.isfinite(out)):
+            raise ValueError(
+                "The model function generated NaN values and the fit aborted!"
+            )
+        return out
 
 
 def make_mask(data, c_x, c_y, r_x, r_y):
@@ -427,6 +1536,156 @@ def make_mask(data, c_x, c_y, r_x, r_y):
     return mask
 
 
+def peak_free_mask(shape, peaks):
+    """ Mask of the pixels outside the fitting masks of all peaks
+
+        :param shape: shape of a plane (f1, f2)
+        :type shape: tuple
+        :param peaks: peaklist with X_AXISf, Y_AXISf, X_RADIUS and Y_RADIUS columns (in points)
+        :type peaks: pd.DataFrame
+
+        :returns: boolean mask which is False within the elliptical mask of any peak
+        :rtype: numpy.array
+    """
+    mask = np.ones(shape, dtype=bool)
+    columns = ["X_AXISf", "Y_AXISf", "X_RADIUS", "Y_RADIUS"]
+    for c_x, c_y, r_x, r_y in peaks[columns].itertuples(index=False):
+        # only the bounding box of each ellipse is updated
+        min_y, max_y = max(0, int(c_y - r_y)), max(0, int(c_y + r_y) + 2)
+        min_x, max_x = max(0, int(c_x - r_x)), max(0, int(c_x + r_x) + 2)
+        box = mask[min_y:max_y, min_x:max_x]
+        box &= ~make_mask(box, c_x - min_x, c_y - min_y, r_x, r_y)
+    return mask
+
+
+def estimate_noise(
+    data, mask=None, max_points=65536, clip=3.0, iterations=5, block_size=64, seed=0
+):
+    """ Noise level (standard deviation) of each plane
+
+        A robust estimate from the median absolute deviation (MAD, scaled by
+        1.4826 to give the standard deviation of Gaussian noise) of a random
+        subsample of the pixels where mask is True. Pixels further than clip
+        standard deviations from the median (i.e. signals outside the mask)
+        are excluded and the MAD is recalculated up to iterations times. The
+        same pixels are used in every plane and the planes are processed
+        block_size at a time.
+
+        :param data: planes with shape (n_planes, f1, f2)
+        :type data: numpy.array or Planes
+        :param mask: pixels to use, e.g. from :func:`peak_free_mask` (default all)
+        :type mask: numpy.array
+        :param max_points: maximum number of pixels sampled from each plane
+        :type max_points: int
+        :param clip: outlier threshold in standard deviations
+        :type clip: float
+        :param iterations: maximum number of clipping iterations
+        :type iterations: int
+        :param block_size: number of planes processed at once
+        :type block_size: int
+        :param seed: seed for selecting the random pixels
+        :type seed: int
+
+        :returns: noise of each plane
+        :rtype: numpy.array
+    """
+    shape = data.shape[1:]
+    if mask is None or not mask.any():
+        mask = np.ones(shape, dtype=bool)
+    pixels = np.flatnonzero(mask)
+    if len(pixels) > max_points:
+        rng = np.random.RandomState(seed)
+        pixels = np.sort(rng.choice(pixels, max_points, replace=False))
+    rows, cols = np.unravel_index(pixels, shape)
+
+    noise = np.empty(len(data))
+    for start in range(0, len(data), block_size):
+        samples = np.array(
+            [plane[rows, cols] for plane in data[start : start + block_size]],
+            dtype=float,
+        )
+        for _ in range(iterations):
+            median = np.nanmedian(samples, axis=1, keepdims=True)
+            deviation = np.abs(samples - median)
+            sigma = 1.4826 * np.nanmedian(deviation, axis=1, keepdims=True)
+            outliers = deviation > clip * sigma
+            if not outliers.any():
+                break
+            samples[outliers] = np.nan
+        noise[start : start + len(samples)] = sigma.ravel()
+
+    # planes without noise (e.g. all zeros) would get infinite weights
+    valid = noise > 0
+    noise[~valid] = np.median(noise[valid]) if valid.any() else 1.0
+    return noise
+
+
+def data_signature(path):
+    """ Path, number of files, total size and latest modification time of NMRPipe data """
+    files = pipe_plane_files(str(path)) or [str(path)]
+    stats = [os.stat(f) for f in files]
+    return [
+        str(Path(files[0]).resolve()),
+        len(files),
+        sum(stat.st_size for stat in stats),
+        max(stat.st_mtime for stat in stats),
+    ]
+
+
+def plane_noise(data, peaks, data_path, dims=None, cache_path=None):
+    """ Noise of each plane estimated away from the peaks (see :func:`estimate_noise`)
+
+        The values can be cached in a JSON file together with a key made from
+        the :func:`data_signature` of the data, the dims and the peak positions
+        and radii that define the mask, so they are only estimated again for
+        new planes or if the data or peaks change.
+
+        :param data: planes to estimate the noise of
+        :type data: Planes
+        :param peaks: peaklist with X_AXISf, Y_AXISf, X_RADIUS and Y_RADIUS columns
+        :type peaks: pd.DataFrame
+        :param data_path: path of the NMRPipe data
+        :type data_path: str
+        :param dims: dimension order of the data
+        :type dims: list
+        :param cache_path: JSON file to cache the estimates in (not cached if None)
+        :type cache_path: str or pathlib.Path
+
+        :returns: noise of each plane
+        :rtype: numpy.array
+    """
+    mask_columns = ["X_AXISf", "Y_AXISf", "X_RADIUS", "Y_RADIUS"]
+    key = hash_inputs(
+        data_signature(data_path),
+        dims,
+        peaks[mask_columns].astype(float).reset_index(drop=True),
+    )
+    cached = {}
+    if cache_path is not None:
+        cache_path = Path(cache_path)
+        try:
+            with open(cache_path) as f:
+                estimate = json.load(f)
+            if estimate.get("key") == key:
+                cached = estimate.get("noise", {})
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            pass
+
+    missing = [num for num, plane in enumerate(data.planes) if str(plane) not in cached]
+    if missing:
+        mask = peak_free_mask(data.shape[1:], peaks)
+        for num, value in zip(missing, estimate_noise(data[missing], mask)):
+            cached[str(data.planes[num])] = float(value)
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_name(f".{cache_path.name}.{os.getpid()}")
+            with open(tmp_path, "w") as f:
+                json.dump({"key": key, "noise": cached}, f)
+            os.replace(tmp_path, cache_path)
+
+    return np.array([cached[str(plane)] for plane in data.planes])
+
+
 def rmsd(residuals):
     return np.sqrt(np.sum(residuals ** 2.0) / len(residuals))
 
@@ -551,7 +1810,7 @@ def to_prefix(x):
     return prefix + "_"
 
 
-def make_models(model, peaks, data, lineshape="PV", xy_bounds=None):
+def make_models(model, peaks, data, lineshape="PV", xy_bounds=None, parallel=False):
     """ Make composite models for multiple peaks
 
         :param model: lineshape function
@@ -569,30 +1828,21 @@ def make_models(model, peaks, data, lineshape="PV", xy_bounds=None):
         :param xy_bounds: bounds for peak centers (+/-x, +/-y)
         :type xy_bounds: tuple
 
-        :return mod: Composite lmfit model containing all peaks
-        :rtype mod: lmfit.CompositeModel
+        :param parallel: use multithreaded cluster kernel for large windows
+        :type parallel: bool
+
+        :return mod: lmfit model containing all peaks
+        :rtype mod: ClusterModel
 
         :return p_guess: params for composite model with starting values
         :rtype p_guess: lmfit.Parameters
 
     """
-    if len(peaks) == 1:
-        # make model for first peak
-        mod = Model(model, prefix="%s" % to_prefix(peaks.ASS.iloc[0]))
-        # add parameters
-        param_dict = make_param_dict(peaks, data, lineshape=lineshape)
-        p_guess = mod.make_params(**param_dict)
-
-    elif len(peaks) > 1:
-        # make model for first peak
-        first_peak, *remaining_peaks = peaks.iterrows()
-        mod = Model(model, prefix="%s" % to_prefix(first_peak[1].ASS))
-        for index, peak in remaining_peaks:
-            mod += Model(model, prefix="%s" % to_prefix(peak.ASS))
-
-        param_dict = make_param_dict(peaks, data, lineshape=lineshape)
-        p_guess = mod.make_params(**param_dict)
-        # add Peak params to p_guess
+    # one model for all peaks in cluster evaluated by a single compiled kernel
+    mod = ClusterModel(model, [to_prefix(ass) for ass in peaks.ASS], parallel=parallel)
+    # add parameters
+    param_dict = make_param_dict(peaks, data, lineshape=lineshape)
+    p_guess = mod.make_params(**param_dict)
 
     update_params(p_guess, param_dict, lineshape=lineshape, xy_bounds=xy_bounds)
 
@@ -663,6 +1913,9 @@ def update_params(params, param_dict, lineshape="PV", xy_bounds=None):
                 params[k].vary = False
             elif lineshape == "L":
                 params[k].vary = False
+            # fraction is not used by the voigt lineshape
+            elif lineshape == "V":
+                params[k].vary = False
 
     # return params
 
@@ -678,6 +1931,380 @@ def run_log(log_name="run_log.txt"):
         log.write(f"# Script run on {time_stamp}:\n{run_args}\n")
 
 
+# typed binary table formats and the optional package needed to read/write them
+table_formats = {
+    ".parquet": "pyarrow",
+    ".feather": "pyarrow",
+    ".h5": "tables",
+    ".hdf5": "tables",
+    ".npz": None,
+}
+# key of table in HDF5 files
+hdf_key = "peakipy"
+
+
+def import_optional(module, suffix):
+    """ Import optional dependency needed for a file format
+
+        :param module: name of module
+        :type module: str
+        :param suffix: file suffix that needs the module
+        :type suffix: str
+
+        :returns: module
+
+        :raises ImportError: with a hint on installing the module if it is missing
+    """
+    try:
+        return importlib.import_module(module)
+    except ImportError as e:
+        raise ImportError(
+            f"{suffix} files need the {module} package (pip install {module})"
+        ) from e
+
+
+def categorize(df):
+    """ Convert string columns (e.g. assignment, lineshape) to categoricals
+
+        :param df: table
+        :type df: pandas.DataFrame
+
+        :returns: table with categorical string columns
+        :rtype: pandas.DataFrame
+    """
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].astype("category")
+    return df
+
+
+def write_table(df, path, float_format="%.4f"):
+    """ Save table in a format chosen by the file suffix
+
+        .csv and .tab are written as text with float_format, .parquet,
+        .feather, .h5/.hdf5 and .npz keep the full precision and store
+        string columns as categoricals. Any other suffix gives a pickle.
+
+        :param df: table to save
+        :type df: pandas.DataFrame
+        :param path: output path
+        :type path: str or pathlib.Path
+        :param float_format: format of floats in text files
+        :type float_format: str
+
+    """
+    path = Path(path)
+    suffix = path.suffix
+    if suffix == ".csv":
+        df.to_csv(path, float_format=float_format, index=False)
+    elif suffix == ".tab":
+        df.to_csv(path, sep="\t", float_format=float_format, index=False)
+    elif suffix not in table_formats:
+        df.to_pickle(path)
+    else:
+        if table_formats[suffix] is not None:
+            import_optional(table_formats[suffix], suffix)
+        df = categorize(df).reset_index(drop=True)
+        if suffix == ".parquet":
+            df.to_parquet(path, index=False)
+        elif suffix == ".feather":
+            df.to_feather(path)
+        elif suffix in (".h5", ".hdf5"):
+            df.to_hdf(path, key=hdf_key, mode="w", format="table", data_columns=True)
+        else:
+            arrays = {}
+            for column in df.columns:
+                values = df[column]
+                if values.dtype.name == "category":
+                    # codes plus unique values (-1 codes are missing values)
+                    arrays[column] = values.cat.codes.values
+                    arrays[f"{column}.categories"] = values.cat.categories.astype(
+                        str
+                    ).values.astype(str)
+                else:
+                    arrays[column] = values.values
+            # column order (column names could contain any character)
+            arrays[".columns"] = np.array(df.columns, dtype=str)
+            np.savez(path, **arrays)
+
+
+def read_table(path, columns=None, categories=False):
+    """ Load table saved by :func:`write_table`
+
+        :param path: path to table
+        :type path: str or pathlib.Path
+        :param columns: only load these columns (missing columns are ignored)
+        :type columns: list
+        :param categories: keep categorical string columns rather than
+                           converting them back to strings
+        :type categories: bool
+
+        :returns: table
+        :rtype: pandas.DataFrame
+    """
+    path = Path(path)
+    suffix = path.suffix
+    wanted = None if columns is None else set(columns)
+    if suffix in (".csv", ".tab"):
+        df = pd.read_csv(
+            path,
+            sep="\t" if suffix == ".tab" else ",",
+            usecols=None if wanted is None else lambda c: c in wanted,
+        )
+    elif suffix not in table_formats:
+        df = pd.read_pickle(path)
+        if wanted is not None:
+            df = df[[c for c in df.columns if c in wanted]]
+    elif suffix in (".parquet", ".feather"):
+        pyarrow = import_optional("pyarrow", suffix)
+        if wanted is not None:
+            # only read the schema to find which of the columns exist
+            if suffix == ".parquet":
+                schema = importlib.import_module("pyarrow.parquet").read_schema(path)
+            else:
+                schema = pyarrow.ipc.open_file(path).schema
+            wanted = [c for c in schema.names if c in wanted]
+        if suffix == ".parquet":
+            df = pd.read_parquet(path, columns=wanted)
+        else:
+            df = pd.read_feather(path, columns=wanted)
+    elif suffix in (".h5", ".hdf5"):
+        import_optional("tables", suffix)
+        df = pd.read_hdf(path, key=hdf_key)
+        if wanted is not None:
+            df = df[[c for c in df.columns if c in wanted]]
+    else:
+        with np.load(path) as npz:
+            names = [c for c in npz[".columns"] if wanted is None or c in wanted]
+            df = pd.DataFrame(
+                {
+                    c: pd.Categorical.from_codes(npz[c], npz[f"{c}.categories"])
+                    if f"{c}.categories" in npz.files
+                    else npz[c]
+                    for c in names
+                }
+            )
+    if not categories:
+        for column in df.columns:
+            if df[column].dtype.name == "category":
+                df[column] = df[column].astype(object)
+    return df
+
+
+def cluster_window(group, shape):
+    """ Bounding box of a cluster of peaks including their fitting radii
+
+        :param group: peaks in cluster
+        :type group: pandas.DataFrame
+        :param shape: shape of spectrum (only last two dimensions are used)
+        :type shape: tuple
+
+        :returns: min_x, max_x, min_y, max_y in points (clipped to the spectrum)
+        :rtype: tuple
+
+    """
+    x_radius = group.X_RADIUS.max()
+    y_radius = group.Y_RADIUS.max()
+
+    max_x, min_x = (
+        int(np.ceil(max(group.X_AXISf) + x_radius + 1)),
+        int(np.floor(min(group.X_AXISf) - x_radius)),
+    )
+    max_y, min_y = (
+        int(np.ceil(max(group.Y_AXISf) + y_radius + 1)),
+        int(np.floor(min(group.Y_AXISf) - y_radius)),
+    )
+
+    #  deal with peaks on the edge of spectrum
+    if min_y < 0:
+        min_y = 0
+
+    if min_x < 0:
+        min_x = 0
+
+    if max_y > shape[-2]:
+        max_y = shape[-2]
+
+    if max_x > shape[-1]:
+        max_x = shape[-1]
+
+    return min_x, max_x, min_y, max_y
+
+
+class DirectFitResult:
+    """ Result of fitting a ClusterModel with :func:`fit_direct`
+
+        Provides the attributes and methods of lmfit.model.ModelResult used by
+        peakipy (params, chisqr, redchi, aic, residual, nfev, success, fit and
+        fit_report) without the lmfit minimizer overhead.
+
+    """
+
+    def __init__(self, model, params, XY, weights=None, **least_squares_kws):
+        self.model = model
+        self.params = params
+        self.XY = XY
+        self.weights = weights
+        self.least_squares_kws = least_squares_kws
+        self.data = None
+        self.residual = None
+        self.chisqr = None
+        self.redchi = None
+        self.aic = None
+        self.nfev = 0
+        self.success = False
+        self.message = ""
+
+    def fit(self, data=None, params=None, weights=None):
+        """ (Re)fit the model to data updating this result
+
+            :param data: masked data
+            :type data: numpy.array
+            :param params: starting parameters (default: current parameters)
+            :type params: lmfit.Parameters
+            :param weights: weight for each data point
+            :type weights: numpy.array
+
+        """
+        if data is not None:
+            self.data = np.asarray(data, dtype=float).ravel()
+        if params is not None:
+            self.params = params
+        if weights is not None:
+            self.weights = np.asarray(weights, dtype=float).ravel()
+        if self.weights is None:
+            self.weights = np.ones_like(self.data)
+
+        params = self.params
+        names = list(params)
+        vary = [k for k in names if params[k].vary and params[k].expr is None]
+        values = np.array([params[k].value for k in names], dtype=float)
+        vary_index = np.array([names.index(k) for k in vary], dtype=int)
+        lower = np.array([params[k].min for k in vary], dtype=float)
+        upper = np.array([params[k].max for k in vary], dtype=float)
+        x0 = np.clip(values[vary_index], lower, upper)
+
+        mod = self.model
+        data, weights, XY = self.data, self.weights, self.XY
+        x, y, x_index, y_index, shape = kernel_coords(XY)
+        out = np.empty(len(x_index))
+        _, residual_kernel = mod._kernels(len(x_index))
+        # position in values of each kernel parameter (-1 for fixed values)
+        layout = [
+            [names.index(i) if type(i) == str else -1 for i in peak]
+            for peak in mod._layout
+        ]
+        layout = np.array(layout, dtype=int)
+        constants = np.array(
+            [[0.0 if type(i) == str else i for i in peak] for peak in mod._layout]
+        )
+        # analytic jacobian of each peak
+        components = [
+            (
+                lineshape_jacobians[c.func],
+                c.prefix,
+                [(name[len(c.prefix) :], names.index(name)) for name in c.param_names],
+            )
+            for c in mod.components
+        ]
+        vary_position = {i: j for j, i in enumerate(vary_index)}
+
+        def residual(p):
+            values[vary_index] = p
+            kernel_params = np.where(layout >= 0, values[layout], constants)
+            residual_kernel(
+                x,
+                y,
+                x_index,
+                y_index,
+                kernel_params,
+                voigt_coefficients,
+                data,
+                weights,
+                1.0,
+                out,
+            )
+            return out.copy()
+
+        def jacobian(p):
+            values[vary_index] = p
+            jac = np.zeros((len(data), len(p)))
+            for jac_func, prefix, args in components:
+                func_args = {root: values[i] for root, i in args}
+                columns = jac_func(XY, **func_args)
+                for root, i in args:
+                    j = vary_position.get(i)
+                    if j is not None:
+                        jac[:, j] = columns[root]
+            return jac * weights[:, np.newaxis]
+
+        kws = dict(method="trf", x_scale="jac")
+        kws.update(self.least_squares_kws)
+        if len(x0) > 0:
+            result = optimize.least_squares(
+                residual, x0, jac=jacobian, bounds=(lower, upper), **kws
+            )
+            p, self.nfev = result.x, result.nfev
+            self.success, self.message = result.success, result.message
+        else:
+            p, self.nfev, self.success, self.message = x0, 1, True, "No parameters vary"
+
+        self.residual = residual_sign * residual(p)
+        chisqr, redchi, aic, _ = plane_statistics(self.residual[:, np.newaxis], len(p))
+        self.chisqr, self.redchi, self.aic = chisqr[0], redchi[0], aic[0]
+        if len(p) > 0:
+            jac = jacobian(p)
+            errors = sqrt(_diag_inv(jac.T @ jac) * self.redchi)
+        else:
+            errors = []
+        for k, value in zip(names, values):
+            params[k].value = value
+        for k, err in zip(vary, errors):
+            params[k].stderr = err
+        return self
+
+    def fit_report(self):
+        """ Short report of the fit statistics and parameters """
+        return f"""[[Fit Statistics]]
+    # fitting method   = least_squares (direct)
+    # function evals   = {self.nfev}
+    # data points      = {len(self.residual)}
+    chi-square         = {self.chisqr:.5e}
+    reduced chi-square = {self.redchi:.5e}
+    Akaike info crit   = {self.aic:.5f}
+{lmfit_fit_report(self.params)}"""
+
+
+def fit_direct(mod, data, params, XY, weights=None, **least_squares_kws):
+    """ Fit a ClusterModel with scipy.optimize.least_squares on the compiled residual
+
+        Parameters are mapped to a flat vector with bounds taken from the lmfit
+        parameters and the analytic Jacobian is used. By default the trust region
+        reflective method is used with x_scale="jac". As for
+        lmfit.model.ModelResult.fit the parameters are updated in place.
+
+        :param mod: cluster model
+        :type mod: ClusterModel
+        :param data: masked data
+        :type data: numpy.array
+        :param params: starting parameters
+        :type params: lmfit.Parameters
+        :param XY: coordinates of masked data
+        :type XY: GridXY
+        :param weights: weight for each data point
+        :type weights: numpy.array
+        :param least_squares_kws: keyword arguments for scipy.optimize.least_squares (e.g. ftol, xtol, gtol, max_nfev)
+        :type least_squares_kws: dict
+
+        :returns: fit result
+        :rtype: DirectFitResult
+
+    """
+    result = DirectFitResult(mod, params, XY, **least_squares_kws)
+    return result.fit(data=data, weights=weights)
+
+
 def fit_first_plane(
     group,
     data,
@@ -688,6 +2315,9 @@ def fit_first_plane(
     log=None,
     noise=1.0,
     fit_method="leastsq",
+    parallel=False,
+    engine="lmfit",
+    least_squares_kws=None,
 ):
     """ Deconvolute group of peaks
 
@@ -724,107 +2354,121 @@ def fit_first_plane(
         :param fit_method: method used by lmfit
         :type fit_method: str
 
+        :param parallel: use multithreaded cluster kernel for large windows
+        :type parallel: bool
+
+        :param engine: fit with lmfit or directly with scipy least_squares (lmfit or direct)
+        :type engine: str
+
+        :param least_squares_kws: keyword arguments for scipy.optimize.least_squares when engine is direct
+        :type least_squares_kws: dict
+
         :return: FitResult
         :rtype: FitResult
 
     """
     shape = data.shape
-    mask = np.zeros(shape, dtype=bool)
 
     if (lineshape == "PV") or (lineshape == "G") or (lineshape == "L"):
         mod, p_guess = make_models(
-            pvoigt2d, group, data, lineshape=lineshape, xy_bounds=xy_bounds
+            pvoigt2d,
+            group,
+            data,
+            lineshape=lineshape,
+            xy_bounds=xy_bounds,
+            parallel=parallel,
         )
 
     elif lineshape == "V":
         mod, p_guess = make_models(
-            voigt2d, group, data, lineshape=lineshape, xy_bounds=xy_bounds
+            voigt2d,
+            group,
+            data,
+            lineshape=lineshape,
+            xy_bounds=xy_bounds,
+            parallel=parallel,
         )
 
     elif lineshape == "G_L":
         mod, p_guess = make_models(
-            gaussian_lorentzian, group, data, lineshape="PV", xy_bounds=xy_bounds
+            gaussian_lorentzian,
+            group,
+            data,
+            lineshape="PV",
+            xy_bounds=xy_bounds,
+            parallel=parallel,
         )
 
     elif lineshape == "PV_G":
         mod, p_guess = make_models(
-            pv_g, group, data, lineshape="PV", xy_bounds=xy_bounds
+            pv_g, group, data, lineshape="PV", xy_bounds=xy_bounds, parallel=parallel,
         )
 
     elif lineshape == "PV_L":
         mod, p_guess = make_models(
-            pv_l, group, data, lineshape="PV", xy_bounds=xy_bounds
+            pv_l, group, data, lineshape="PV", xy_bounds=xy_bounds, parallel=parallel,
         )
 
     elif lineshape == "PV_PV":
         mod, p_guess = make_models(
-            pv_pv, group, data, lineshape="PV_PV", xy_bounds=xy_bounds
+            pv_pv,
+            group,
+            data,
+            lineshape="PV_PV",
+            xy_bounds=xy_bounds,
+            parallel=parallel,
         )
 
     # get initial peak centers
     cen_x = [p_guess[k].value for k in p_guess if "center_x" in k]
-    cen_y = [p_guess[k].value for k in p_guess if "center_y" in k]
-
-    for index, peak in group.iterrows():
-        mask += make_mask(
-            data, peak.X_AXISf, peak.Y_AXISf, peak.X_RADIUS, peak.Y_RADIUS
-        )
-
-    x_radius = group.X_RADIUS.max()
-    y_radius = group.Y_RADIUS.max()
-
-    max_x, min_x = (
-        int(np.ceil(max(group.X_AXISf) + x_radius + 1)),
-        int(np.floor(min(group.X_AXISf) - x_radius)),
-    )
-    max_y, min_y = (
-        int(np.ceil(max(group.Y_AXISf) + y_radius + 1)),
-        int(np.floor(min(group.Y_AXISf) - y_radius)),
-    )
-
-    #  deal with peaks on the edge of spectrum
-    if min_y < 0:
-        min_y = 0
-
-    if min_x < 0:
-        min_x = 0
+    cen_y = [p_guess[k].value for k in p_guess if "center_y" in k]
 
-    if max_y > shape[-2]:
-        max_y = shape[-2]
+    min_x, max_x, min_y, max_y = cluster_window(group, shape)
 
-    if max_x > shape[-1]:
-        max_x = shape[-1]
+    # everything below is local to the cluster bounding box
+    window = (slice(min_y, max_y), slice(min_x, max_x))
+    data_window = data[window]
+    mask = np.zeros(data_window.shape, dtype=bool)
+    for index, peak in group.iterrows():
+        mask += make_mask(
+            data_window,
+            peak.X_AXISf - min_x,
+            peak.Y_AXISf - min_y,
+            peak.X_RADIUS,
+            peak.Y_RADIUS,
+        )
 
-    peak_slices = data.copy()[mask]
-    # must be a better way to make the meshgrid
-    x = np.arange(shape[-1])
-    y = np.arange(shape[-2])
-    XY = np.meshgrid(x, y)
-    X, Y = XY
+    peak_slices = data_window[mask]
 
-    XY_slices = np.array([X.copy()[mask], Y.copy()[mask]])
+    # separable coordinates of the masked pixels within the cluster bounding box
+    XY_slices = GridXY.from_mask(mask, x0=min_x, y0=min_y)
     weights = 1.0 / np.array([noise] * len(np.ravel(peak_slices)))
 
-    out = mod.fit(
-        peak_slices, XY=XY_slices, params=p_guess, weights=weights, method=fit_method
-    )
+    if engine == "direct":
+        if least_squares_kws is None:
+            least_squares_kws = {}
+        out = fit_direct(
+            mod, peak_slices, p_guess, XY_slices, weights, **least_squares_kws
+        )
+    else:
+        out = mod.fit(
+            peak_slices,
+            XY=XY_slices,
+            params=p_guess,
+            weights=weights,
+            method=fit_method,
+            fit_kws=jacobian_fit_kws(mod, fit_method),
+        )
 
     if verbose:
         print(out.fit_report())
 
-    z_sim = mod.eval(XY=XY, params=out.params)
-    z_sim[~mask] = np.nan
-    z_plot = data.copy()
-    z_plot[~mask] = np.nan
-    #  also if peak position changed significantly from start then add warning
-
-    _z_plot = z_plot[~np.isnan(z_plot)]
-    _z_sim = z_sim[~np.isnan(z_sim)]
+    # quality of the fit over the masked pixels
+    best_fit = mod.eval(XY=XY_slices, params=out.params)
+    quality = fit_quality(peak_slices, best_fit, noise)
+    slope = quality["slope"]
+    #  also if peak position changed significantly from start then add warning
 
-    linmod = LinearModel()
-    linpars = linmod.guess(_z_sim, x=_z_plot)
-    linfit = linmod.fit(_z_sim, x=_z_plot, params=linpars)
-    slope = linfit.params["slope"].value
     #  number of peaks in cluster
     n_peaks = len(group)
 
@@ -864,11 +2508,9 @@ def fit_first_plane(
         min_y=min_y,
         max_x=max_x,
         max_y=max_y,
-        X=X,
-        Y=Y,
-        Z=z_plot,
-        Z_sim=z_sim,
         peak_slices=peak_slices,
+        best_fit=best_fit,
+        quality=quality,
         XY_slices=XY_slices,
         weights=weights,
         mod=mod,
@@ -876,7 +2518,14 @@ def fit_first_plane(
 
 
 class FitResult:
-    """ Data structure for storing fit results """
+    """ Data structure for storing fit results
+
+        mask, X, Y, Z and Z_sim cover the cluster bounding box only
+        (see :attr:`window` for its position within the spectrum).
+        Z and Z_sim are only filled in from the masked pixels when
+        plotting and are NaN outside of the mask.
+
+    """
 
     def __init__(
         self,
@@ -890,12 +2539,10 @@ class FitResult:
         min_y: float,
         max_x: float,
         max_y: float,
-        X: np.array,
-        Y: np.array,
-        Z: np.array,
-        Z_sim: np.array,
         peak_slices: np.array,
-        XY_slices: np.array,
+        best_fit: np.array,
+        quality: dict,
+        XY_slices: GridXY,
         weights: np.array,
         mod: Model,
     ):
@@ -910,15 +2557,46 @@ class FitResult:
         self.min_y = min_y
         self.max_x = max_x
         self.max_y = max_y
-        self.X = X
-        self.Y = Y
-        self.Z = Z
-        self.Z_sim = Z_sim
         self.peak_slices = peak_slices
+        self.best_fit = best_fit
+        self.quality = quality
         self.XY_slices = XY_slices
         self.weights = weights
         self.mod = mod
 
+    @property
+    def window(self):
+        """ Slices selecting the cluster bounding box from a spectrum plane """
+        return (slice(self.min_y, self.max_y), slice(self.min_x, self.max_x))
+
+    @property
+    def X(self):
+        return np.meshgrid(
+            np.arange(self.min_x, self.max_x), np.arange(self.min_y, self.max_y)
+        )[0]
+
+    @property
+    def Y(self):
+        return np.meshgrid(
+            np.arange(self.min_x, self.max_x), np.arange(self.min_y, self.max_y)
+        )[1]
+
+    def _unmask(self, values):
+        """ Place values of the masked pixels in the bounding box (NaN elsewhere) """
+        z = np.full(self.mask.shape, np.nan)
+        z[self.mask] = values
+        return z
+
+    @property
+    def Z(self):
+        """ Data within the mask """
+        return self._unmask(self.peak_slices)
+
+    @property
+    def Z_sim(self):
+        """ Summed plane fit within the mask """
+        return self._unmask(self.best_fit)
+
     def check_shifts(self):
         """ Calculate difference between initial peak positions 
             and check whether they moved too much from original
@@ -934,8 +2612,7 @@ class FitResult:
         jk_results = []
         for i in range(len(self.peak_slices)):
             peak_slices = np.delete(self.peak_slices, i, None)
-            X = np.delete(self.XY_slices[0], i, None)
-            Y = np.delete(self.XY_slices[1], i, None)
+            X, Y = np.delete(self.XY_slices.points, i, axis=1)
             weights = np.delete(self.weights, i, None)
             jk_results.append(
                 self.mod.fit(
@@ -981,129 +2658,1062 @@ class FitResult:
         # std =  np.std(amps)
         return JackKnifeResult(mean=mean_amps, std=std_amps)
 
+    @property
+    def needs_checking(self):
+        """ True if the slope of simulated vs measured intensities is outside 0.95-1.05 """
+        return not 0.95 <= self.quality["slope"] <= 1.05
+
+    def plot_data(self):
+        """ Data for plotting the fit (see :class:`FitPlot`)
+
+            :rtype: FitPlot
+        """
+        labels = []
+        label_amp = []
+        label_x = []
+        label_y = []
+        for k, v in self.out.params.valuesdict().items():
+            if "amplitude" in k:
+                label_amp.append(v)
+                # get prefix
+                labels.append(" ".join(k.split("_")[:-1]))
+            elif "center_x" in k:
+                label_x.append(self.uc_dics["f2"].ppm(v))
+            elif "center_y" in k:
+                label_y.append(self.uc_dics["f1"].ppm(v))
+        return FitPlot(
+            name=self.group.CLUSTID.iloc[0],
+            x_ppm=self.uc_dics["f2"].ppm(np.arange(self.min_x, self.max_x)),
+            y_ppm=self.uc_dics["f1"].ppm(np.arange(self.min_y, self.max_y)),
+            z=self.Z,
+            z_sim=self.Z_sim,
+            labels=labels,
+            label_x=label_x,
+            label_y=label_y,
+            label_amp=label_amp,
+            chisqr=self.out.chisqr,
+            redchi=self.out.redchi,
+            flagged=self.needs_checking,
+        )
+
     def plot(self, plot_path=None, show=False, nomp=True):
-        """ Matplotlib interactive plot of the fits """
+        """ Matplotlib interactive plot of the fits
+
+            The plot is saved to <plot_path>/<CLUSTID>.png and only shown
+            if show and nomp are True.
+        """
 
         if plot_path != None:
             plot_path = Path(plot_path)
             plot_path.mkdir(parents=True, exist_ok=True)
+            plot = self.plot_data()
+            if not (show and nomp):
+                plot.render(plot_path)
+                return
             # plotting
             fig = plt.figure(figsize=(8, 6))
-            ax = fig.add_subplot(111, projection="3d")
-            # slice out plot area
-            x_plot = self.uc_dics["f2"].ppm(
-                self.X[self.min_y : self.max_y, self.min_x : self.max_x]
-            )
-            y_plot = self.uc_dics["f1"].ppm(
-                self.Y[self.min_y : self.max_y, self.min_x : self.max_x]
-            )
-            z_plot = self.Z[self.min_y : self.max_y, self.min_x : self.max_x]
+            plot.draw(fig)
+            plt.savefig(plot_path / f"{plot.name}.png", dpi=300)
 
-            z_sim = self.Z_sim[self.min_y : self.max_y, self.min_x : self.max_x]
+            def exit_program(event):
+                exit()
 
-            ax.set_title(
-                "$\chi^2$="
-                + f"{self.out.chisqr:.3f}, "
-                + "$\chi_{red}^2$="
-                + f"{self.out.redchi:.4f}"
-            )
+            def next_plot(event):
+                plt.close()
 
-            residual = z_plot - z_sim
-            cset = ax.contourf(
-                x_plot,
-                y_plot,
-                residual,
-                zdir="z",
-                offset=np.nanmin(z_plot) * 1.1,
-                alpha=0.5,
-                cmap=cm.coolwarm,
-            )
-            fig.colorbar(cset, ax=ax, shrink=0.5, format="%.2e")
-            # plot raw data
-            ax.plot_wireframe(x_plot, y_plot, z_plot, color="#03353E", label="data")
+            axexit = plt.axes([0.81, 0.05, 0.1, 0.075])
+            bnexit = Button(axexit, "Exit")
+            bnexit.on_clicked(exit_program)
 
-            ax.set_xlabel("F2 ppm")
-            ax.set_ylabel("F1 ppm")
-            ax.plot_wireframe(
-                x_plot, y_plot, z_sim, color="#C1403D", linestyle="--", label="fit"
-            )
+            axnext = plt.axes([0.71, 0.05, 0.1, 0.075])
+            bnnext = Button(axnext, "Next")
+            bnnext.on_clicked(next_plot)
 
-            # axes will appear inverted
-            ax.view_init(30, 120)
-
-            # Annotate plots
-            labs = []
-            Z_lab = []
-            Y_lab = []
-            X_lab = []
-            for k, v in self.out.params.valuesdict().items():
-                if "amplitude" in k:
-                    Z_lab.append(v)
-                    # get prefix
-                    labs.append(" ".join(k.split("_")[:-1]))
-                elif "center_x" in k:
-                    X_lab.append(self.uc_dics["f2"].ppm(v))
-                elif "center_y" in k:
-                    Y_lab.append(self.uc_dics["f1"].ppm(v))
-            #  this is dumb as !£$@
-            # Z_lab = [
-            #    self.Z[
-            #        int(round(self.uc_dics["f1"](y, "ppm"))),
-            #        int(round(self.uc_dics["f2"](x, "ppm"))),
-            #    ]
-            #    for x, y in zip(X_lab, Y_lab)
-            # ]
-            z_max = np.nanmax(z_plot.ravel())
-            Z_lab = np.array(Z_lab)
-            z_max = z_max * (Z_lab / max(Z_lab))
-            for l, x, y, z in zip(labs, X_lab, Y_lab, z_max):
-                # print(l, x, y, z)
-                # ax.text(x, y, z * 1.2, l, None)
-                z = z * 1.2
-                ax.text(x, y, z, l, None)
-                ax.plot([x, x], [y, y], [0, z], linestyle="dotted", c="k", alpha=0.5)
-
-            # plt.colorbar(contf)
-            plt.legend(bbox_to_anchor=(1.2, 1.1))
-
-            name = self.group.CLUSTID.iloc[0]
-            if show and nomp:
-                plt.savefig(plot_path / f"{name}.png", dpi=300)
-
-                def exit_program(event):
-                    exit()
-
-                def next_plot(event):
-                    plt.close()
-
-                axexit = plt.axes([0.81, 0.05, 0.1, 0.075])
-                bnexit = Button(axexit, "Exit")
-                bnexit.on_clicked(exit_program)
-
-                axnext = plt.axes([0.71, 0.05, 0.1, 0.075])
-                bnnext = Button(axnext, "Next")
-                bnnext.on_clicked(next_plot)
-
-                plt.show()
-            else:
-                print(
-                    Fore.RED
-                    + "Cannot use interactive matplotlib in multiprocess mode. Use --nomp flag."
-                )
-                plt.savefig(plot_path / f"{name}.png", dpi=300)
-            #    print(p_guess)
+            plt.show()
             # close plot
             plt.close()
         else:
             pass
 
 
+class FitPlot:
+    """ Data needed to plot the fit of the summed planes of a cluster
+
+        Only the cluster bounding box is kept so that plots are cheap to send
+        from the processes fitting the clusters to the ones rendering them.
+
+        :param name: CLUSTID of the cluster (the plot is saved as <name>.png)
+        :param x_ppm: F2 ppm of each column of the bounding box
+        :type x_ppm: numpy.array
+        :param y_ppm: F1 ppm of each row of the bounding box
+        :type y_ppm: numpy.array
+        :param z: data within the fitting mask (NaN elsewhere)
+        :type z: numpy.array
+        :param z_sim: fit within the fitting mask (NaN elsewhere)
+        :type z_sim: numpy.array
+        :param labels: peak labels
+        :type labels: list
+        :param label_x: F2 ppm of each peak
+        :type label_x: list
+        :param label_y: F1 ppm of each peak
+        :type label_y: list
+        :param label_amp: amplitude of each peak
+        :type label_amp: list
+        :param chisqr: chi square of the fit
+        :type chisqr: float
+        :param redchi: reduced chi square of the fit
+        :type redchi: float
+        :param flagged: whether the fit needs checking
+        :type flagged: bool
+
+    """
+
+    def __init__(
+        self,
+        name,
+        x_ppm,
+        y_ppm,
+        z,
+        z_sim,
+        labels,
+        label_x,
+        label_y,
+        label_amp,
+        chisqr,
+        redchi,
+        flagged,
+    ):
+        self.name = name
+        self.x_ppm = x_ppm
+        self.y_ppm = y_ppm
+        self.z = z
+        self.z_sim = z_sim
+        self.labels = labels
+        self.label_x = label_x
+        self.label_y = label_y
+        self.label_amp = label_amp
+        self.chisqr = chisqr
+        self.redchi = redchi
+        self.flagged = flagged
+
+    @property
+    def title(self):
+        title = (
+            "$\\chi^2$="
+            + f"{self.chisqr:.3f}, "
+            + "$\\chi_{red}^2$="
+            + f"{self.redchi:.4f}"
+        )
+        if self.flagged:
+            title += " (needs checking)"
+        return title
+
+    def draw(self, fig, style="3d"):
+        """ Draw the plot on a matplotlib figure
+
+            :param fig: figure to draw on
+            :type fig: matplotlib.figure.Figure
+            :param style: 3d (wireframes of data and fit above a contour plot of
+                          the residuals) or 2d (heatmap of the residuals with
+                          contours of data and fit)
+            :type style: str
+
+        """
+        x_plot, y_plot = np.meshgrid(self.x_ppm, self.y_ppm)
+        z_plot = self.z
+        z_sim = self.z_sim
+        residual = z_plot - z_sim
+        if style == "2d":
+            ax = fig.add_subplot(111)
+            ax.set_title(self.title)
+            mesh = ax.pcolormesh(
+                x_plot, y_plot, residual, cmap=cm.coolwarm, shading="nearest"
+            )
+            fig.colorbar(mesh, ax=ax, format="%.2e", label="residual")
+            levels = np.nanmax(z_plot) * np.array([0.1, 0.3, 0.5, 0.7, 0.9])
+            ax.contour(
+                x_plot,
+                y_plot,
+                np.ma.masked_invalid(z_plot),
+                levels=levels,
+                colors="#03353E",
+                linewidths=1,
+            )
+            ax.contour(
+                x_plot,
+                y_plot,
+                np.ma.masked_invalid(z_sim),
+                levels=levels,
+                colors="#C1403D",
+                linestyles="dashed",
+                linewidths=1,
+            )
+            for l, x, y in zip(self.labels, self.label_x, self.label_y):
+                ax.text(x, y, l)
+            ax.set_xlabel("F2 ppm")
+            ax.set_ylabel("F1 ppm")
+            # ppm scales decrease from left to right and bottom to top
+            ax.set_xlim(self.x_ppm.max(), self.x_ppm.min())
+            ax.set_ylim(self.y_ppm.max(), self.y_ppm.min())
+            return ax
+
+        ax = fig.add_subplot(111, projection="3d")
+        ax.set_title(self.title)
+        cset = ax.contourf(
+            x_plot,
+            y_plot,
+            residual,
+            zdir="z",
+            offset=np.nanmin(z_plot) * 1.1,
+            alpha=0.5,
+            cmap=cm.coolwarm,
+        )
+        fig.colorbar(cset, ax=ax, shrink=0.5, format="%.2e")
+        # plot raw data
+        ax.plot_wireframe(x_plot, y_plot, z_plot, color="#03353E", label="data")
+
+        ax.set_xlabel("F2 ppm")
+        ax.set_ylabel("F1 ppm")
+        ax.plot_wireframe(
+            x_plot, y_plot, z_sim, color="#C1403D", linestyle="--", label="fit"
+        )
+
+        # axes will appear inverted
+        ax.view_init(30, 120)
+
+        # Annotate plots
+        z_max = np.nanmax(z_plot.ravel())
+        label_amp = np.array(self.label_amp)
+        z_max = z_max * (label_amp / max(label_amp))
+        for l, x, y, z in zip(self.labels, self.label_x, self.label_y, z_max):
+            z = z * 1.2
+            ax.text(x, y, z, l, None)
+            ax.plot([x, x], [y, y], [0, z], linestyle="dotted", c="k", alpha=0.5)
+
+        ax.legend(bbox_to_anchor=(1.2, 1.1))
+        return ax
+
+    def render(self, plot_path, style="3d", dpi=None):
+        """ Save the plot to <plot_path>/<name>.png with the Agg backend
+
+            This does not use pyplot so plots can be rendered in any process.
+
+            :param plot_path: directory to save the plot in
+            :type plot_path: str or pathlib.Path
+            :param style: 3d or 2d (see :meth:`draw`)
+            :type style: str
+            :param dpi: resolution (300 for 3d and 100 for 2d plots by default)
+            :type dpi: int
+
+        """
+        if dpi is None:
+            dpi = 100 if style == "2d" else 300
+        fig = Figure(figsize=(8, 6))
+        FigureCanvasAgg(fig)
+        self.draw(fig, style)
+        fig.savefig(Path(plot_path) / f"{self.name}.png", dpi=dpi)
+
+
 class JackKnifeResult:
     def __init__(self, mean, std):
         self.mean = mean
         self.std = std
 
 
+def only_amplitudes_vary(params):
+    """ Check whether amplitudes are the only varying parameters
+
+        In this case the model is linear in its parameters and can be fitted
+        with :func:`fit_amplitudes`
+
+        :param params: lmfit parameters
+        :type params: lmfit.Parameters
+
+        :rtype: bool
+
+    """
+    varying = [k for k, p in params.items() if p.vary]
+    return len(varying) > 0 and all(
+        k.endswith("amplitude") and params[k].expr is None for k in varying
+    )
+
+
+class AmplitudeFitResult:
+    """ Result of linear amplitude fits to a stack of planes
+
+        amplitudes and stderr have shape (n_planes, n_peaks) and the
+        statistics (chisqr, redchi, aic, residual_sum) have one value per plane
+        and follow the lmfit definitions.
+
+    """
+
+    def __init__(self, amplitudes, stderr, chisqr, redchi, aic, residual_sum):
+        self.amplitudes = amplitudes
+        self.stderr = stderr
+        self.chisqr = chisqr
+        self.redchi = redchi
+        self.aic = aic
+        self.residual_sum = residual_sum
+
+
+def fit_amplitudes(basis, planes, weights, nnls=False, plane_weights=None):
+    """ Fit peak amplitudes to many planes with fixed peak shapes
+
+        Since the model is linear in the amplitudes all planes are solved as a
+        single weighted least squares problem with multiple right hand sides.
+        Standard errors come from the normal equations
+        :math:`\\sqrt{diag((A^TWA)^{-1}) \\chi^2_{red}}`
+        as estimated by lmfit.
+
+        :param basis: unit amplitude profiles with shape (n_pixels, n_peaks) (see :meth:`ClusterModel.amplitude_basis`)
+        :type basis: numpy.array
+        :param planes: masked data with shape (n_planes, n_pixels)
+        :type planes: numpy.array
+        :param weights: weight for each pixel
+        :type weights: numpy.array
+        :param nnls: constrain amplitudes to be non-negative
+        :type nnls: bool
+        :param plane_weights: weight for each plane (e.g. 1/noise of each plane) multiplying weights
+        :type plane_weights: numpy.array
+
+        :returns: AmplitudeFitResult
+        :rtype: AmplitudeFitResult
+
+    """
+    weights = np.asarray(weights, dtype=float)
+    A = basis * weights[:, np.newaxis]
+    B = planes.T * weights[:, np.newaxis]
+    n_data, n_peaks = A.shape
+    if plane_weights is None:
+        plane_weights = np.ones(len(planes))
+
+    # a constant weight for each plane does not change its amplitudes
+    if nnls:
+        amplitudes = np.column_stack([optimize.nnls(A, b)[0] for b in B.T])
+    else:
+        amplitudes = np.linalg.lstsq(A, B, rcond=None)[0]
+
+    residuals = residual_sign * (A @ amplitudes - B) * plane_weights
+    chisqr, redchi, aic, residual_sum = plane_statistics(residuals, n_peaks)
+    stderr = sqrt(np.outer(redchi / plane_weights ** 2, _diag_inv(A.T @ A)))
+
+    return AmplitudeFitResult(
+        amplitudes=amplitudes.T,
+        stderr=stderr,
+        chisqr=chisqr,
+        redchi=redchi,
+        aic=aic,
+        residual_sum=residual_sum,
+    )
+
+
+def plane_statistics(residuals, n_varys):
+    """ chisqr, redchi, aic and residual sum of each plane (lmfit definitions)
+
+        :param residuals: weighted residuals with shape (n_pixels, n_planes)
+        :type residuals: numpy.array
+        :param n_varys: number of varying parameters per plane
+        :type n_varys: int
+
+        :returns: chisqr, redchi, aic, residual_sum
+        :rtype: tuple of numpy.array
+
+    """
+    n_data = residuals.shape[0]
+    chisqr = np.maximum((residuals ** 2).sum(axis=0), 1e-250 * n_data)
+    redchi = chisqr / max(1, n_data - n_varys)
+    aic = n_data * log(chisqr / n_data) + 2 * n_varys
+    return chisqr, redchi, aic, residuals.sum(axis=0)
+
+
+qc_columns = [
+    "slope",
+    "intercept",
+    "r_squared",
+    "rmsd",
+    "max_residual",
+    "residual_noise",
+]
+
+
+def fit_quality(data, sim, noise=1.0):
+    """ Quality of fits of one or many planes in closed form
+
+        slope and intercept are from a straight line fit of the simulated to
+        the measured intensities (a perfect fit has a slope of 1 and an
+        intercept of 0), r_squared is the coefficient of determination of the
+        fit, rmsd and max_residual are the root mean square and maximum absolute
+        residual and residual_noise is the ratio of rmsd to the noise (close to
+        1 if the residuals are just noise).
+
+        :param data: masked data with shape (n_pixels,) or (n_planes, n_pixels)
+        :type data: numpy.array
+        :param sim: fitted model with the same shape as data
+        :type sim: numpy.array
+        :param noise: noise of the data (or of each plane)
+        :type noise: float or numpy.array
+
+        :returns: dictionary with an array (one value per plane) or float for each of qc_columns
+        :rtype: dict
+
+    """
+    data = np.asarray(data, dtype=float)
+    sim = np.asarray(sim, dtype=float)
+    n_data = data.shape[-1]
+    data_dev = data - data.mean(axis=-1, keepdims=True)
+    sim_mean = sim.mean(axis=-1)
+    residual = data - sim
+    ss_data = (data_dev ** 2).sum(axis=-1)
+    ss_res = (residual ** 2).sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (data_dev * sim).sum(axis=-1) / ss_data
+        rmsd = sqrt(ss_res / n_data)
+        return {
+            "slope": slope,
+            "intercept": sim_mean - slope * data.mean(axis=-1),
+            "r_squared": 1.0 - ss_res / ss_data,
+            "rmsd": rmsd,
+            "max_residual": np.abs(residual).max(axis=-1),
+            "residual_noise": rmsd / noise,
+        }
+
+
+def _diag_inv(a):
+    """ Diagonal of the inverse of a (NaN if singular) """
+    try:
+        return np.diag(np.linalg.inv(a))
+    except np.linalg.LinAlgError:
+        return np.full(len(a), np.nan)
+
+
+class GlobalFitResult(AmplitudeFitResult):
+    """ Result of :func:`fit_global`
+
+        In addition to the per-plane amplitudes and statistics of
+        :class:`AmplitudeFitResult` this stores the refined lmfit parameters
+        (shared shape parameters with standard errors) and, when fitted with a
+        decay model, the initial amplitudes (amp0) and rates of each peak.
+
+    """
+
+    def __init__(
+        self,
+        params,
+        amp0=None,
+        amp0_err=None,
+        rates=None,
+        rate_err=None,
+        nfev=0,
+        success=True,
+        message="",
+        **kws,
+    ):
+        super().__init__(**kws)
+        self.params = params
+        self.amp0 = amp0
+        self.amp0_err = amp0_err
+        self.rates = rates
+        self.rate_err = rate_err
+        self.nfev = nfev
+        self.success = success
+        self.message = message
+
+
+def fit_global(
+    mod, params, XY, planes, weights, decay_times=None, plane_weights=None, **fit_kws
+):
+    """ Fit a cluster to all planes at once with shared peak shapes
+
+        Centers, linewidths and fractions (all varying parameters except the
+        amplitudes) are shared by all planes while each plane has its own
+        amplitudes. If decay_times are given the amplitudes instead follow
+        amp0 * exp(-rate * t) for each peak.
+
+        The amplitudes (or amp0) enter the model linearly and are eliminated by
+        variable projection, so scipy's least_squares only optimises the shared
+        shape parameters (and rates) using the projected block Jacobian built
+        from the analytic lineshape Jacobians.
+
+        :param mod: cluster model
+        :type mod: ClusterModel
+        :param params: starting parameters (e.g. from the summed plane fit)
+        :type params: lmfit.Parameters
+        :param XY: coordinates of the masked pixels
+        :type XY: GridXY
+        :param planes: masked data with shape (n_planes, n_pixels)
+        :type planes: numpy.array
+        :param weights: weight for each pixel
+        :type weights: numpy.array
+        :param decay_times: time (e.g. vclist value) of each plane for the mono-exponential decay model
+        :type decay_times: numpy.array
+        :param plane_weights: weight for each plane (e.g. 1/noise of each plane) multiplying weights
+        :type plane_weights: numpy.array
+        :param fit_kws: keyword arguments passed to scipy.optimize.least_squares
+        :type fit_kws: dict
+
+        :returns: GlobalFitResult
+        :rtype: GlobalFitResult
+
+    """
+    params = params.copy()
+    weights = np.asarray(weights, dtype=float)
+    n_planes, n_data = planes.shape
+    B = planes.T * weights[:, np.newaxis]
+    if plane_weights is None:
+        plane_weights = np.ones(n_planes)
+    W = np.asarray(plane_weights, dtype=float)
+    amp_names = [k for k in params if k.endswith("amplitude")]
+    n_peaks = len(amp_names)
+    shape_names = [
+        k
+        for k in params
+        if params[k].vary and params[k].expr is None and not k.endswith("amplitude")
+    ]
+    n_shape = len(shape_names)
+    # shape parameters belonging to each peak
+    peaks = []
+    for mod_k in mod.components:
+        indices = [
+            (shape_names.index(name), name[len(mod_k.prefix) :])
+            for name in mod_k.param_names
+            if name in shape_names
+        ]
+        peaks.append((mod_k, lineshape_jacobians[mod_k.func], indices))
+
+    def basis(x):
+        """ weighted unit amplitude profiles and their shape derivatives """
+        for name, value in zip(shape_names, x[:n_shape]):
+            params[name].value = value
+        columns = []
+        derivatives = []
+        for k, (mod_k, jac_func, indices) in enumerate(peaks):
+            kws = {
+                name[len(mod_k.prefix) :]: params[name].value
+                for name in mod_k.param_names
+            }
+            kws["amplitude"] = 1.0
+            columns.append(np.ravel(mod_k.func(XY, **kws)) * weights)
+            if indices:
+                jac = jac_func(XY, **kws)
+                for j, root in indices:
+                    derivatives.append((j, k, np.ravel(jac[root]) * weights))
+        return np.column_stack(columns), derivatives
+
+    if decay_times is None:
+        n_linear = n_peaks * n_planes
+
+        def solve(x):
+            A, derivatives = basis(x)
+            Q, _ = np.linalg.qr(A)
+            # the amplitudes of each plane do not depend on its weight
+            C = np.linalg.lstsq(A, B, rcond=None)[0]
+            residuals = (A @ C - B) * W
+            jac = np.empty((n_data * n_planes, len(x)))
+            for j, k, d in derivatives:
+                column = np.outer(d, C[k] * W)
+                jac[:, j] = (column - Q @ (Q.T @ column)).ravel()
+            return residuals, jac, A, C
+
+    else:
+        t = np.asarray(decay_times, dtype=float)
+        n_linear = n_peaks
+
+        def solve(x):
+            A, derivatives = basis(x)
+            decays = exp(-np.outer(x[n_shape:], t))
+            D = np.column_stack(
+                [np.outer(A[:, k], decays[k] * W).ravel() for k in range(n_peaks)]
+            )
+            Q, _ = np.linalg.qr(D)
+            amp0 = np.linalg.lstsq(D, (B * W).ravel(), rcond=None)[0]
+            C = amp0[:, np.newaxis] * decays
+            residuals = (A @ C - B) * W
+            jac = np.empty((n_data * n_planes, len(x)))
+            columns = [(j, np.outer(d, C[k] * W)) for j, k, d in derivatives]
+            columns += [
+                (n_shape + k, -np.outer(A[:, k], C[k] * t * W)) for k in range(n_peaks)
+            ]
+            for j, column in columns:
+                column = column.ravel()
+                jac[:, j] = column - Q @ (Q.T @ column)
+            return residuals, jac, D, amp0
+
+    # least_squares evaluates residual and jacobian separately at the same x
+    cache = {}
+
+    def evaluate(x):
+        key = x.tobytes()
+        if key not in cache:
+            cache.clear()
+            cache[key] = solve(x)
+        return cache[key]
+
+    x0 = [params[name].value for name in shape_names]
+    lower = [params[name].min for name in shape_names]
+    upper = [params[name].max for name in shape_names]
+    if decay_times is not None:
+        # initial rates from log-linear fits to amplitudes with starting shapes
+        A, _ = basis(np.array(x0))
+        C = np.abs(np.linalg.lstsq(A, B, rcond=None)[0]) + tiny
+        rates = -np.polyfit(t, log(C.T), 1)[0]
+        x0 += list(rates)
+        lower += [-np.inf] * n_peaks
+        upper += [np.inf] * n_peaks
+    x0 = np.clip(x0, lower, upper)
+
+    fit_kws.setdefault("method", "trf")
+    fit_kws.setdefault("x_scale", "jac")
+    if len(x0) > 0:
+        out = optimize.least_squares(
+            lambda x: evaluate(x)[0].ravel(),
+            x0,
+            jac=lambda x: evaluate(x)[1],
+            bounds=(lower, upper),
+            **fit_kws,
+        )
+        x, nfev, success, message = out.x, out.nfev, out.success, out.message
+    else:
+        x, nfev, success, message = x0, 1, True, "No shape parameters to fit"
+
+    residuals, jac, design, linear = solve(x)
+    chisqr_total = max(np.sum(residuals ** 2), 1e-250 * residuals.size)
+    redchi_total = chisqr_total / max(1, residuals.size - len(x) - n_linear)
+    # the projected jacobian gives the covariance of the nonlinear parameters
+    # with the linear ones eliminated
+    x_err = sqrt(_diag_inv(jac.T @ jac) * redchi_total)
+    for name, value, err in zip(shape_names, x, x_err):
+        params[name].value = value
+        params[name].stderr = err
+
+    residuals = residual_sign * residuals
+    if decay_times is None:
+        chisqr, redchi, aic, residual_sum = plane_statistics(residuals, n_peaks)
+        amp_err = sqrt(np.outer(redchi / W ** 2, _diag_inv(design.T @ design)))
+        return GlobalFitResult(
+            params=params,
+            amplitudes=linear.T,
+            stderr=amp_err,
+            chisqr=chisqr,
+            redchi=redchi,
+            aic=aic,
+            residual_sum=residual_sum,
+            nfev=nfev,
+            success=success,
+            message=message,
+        )
+
+    amp0 = linear
+    amp0_err = sqrt(_diag_inv(design.T @ design) * redchi_total)
+    rates = x[n_shape:]
+    rate_err = x_err[n_shape:]
+    decay = exp(-np.outer(t, rates))
+    amplitudes = amp0[np.newaxis, :] * decay
+    # propagate errors of amp0 and rate (ignoring their covariance) in
+    # absolute terms so that amp0 = 0 needs no special case
+    amp_err = decay * sqrt(
+        amp0_err[np.newaxis, :] ** 2
+        + (amp0[np.newaxis, :] * np.outer(t, rate_err)) ** 2
+    )
+    chisqr, redchi, aic, residual_sum = plane_statistics(
+        residuals, (n_shape + 2 * n_peaks) / n_planes
+    )
+    return GlobalFitResult(
+        params=params,
+        amplitudes=amplitudes,
+        stderr=amp_err,
+        chisqr=chisqr,
+        redchi=redchi,
+        aic=aic,
+        residual_sum=residual_sum,
+        amp0=amp0,
+        amp0_err=amp0_err,
+        rates=rates,
+        rate_err=rate_err,
+        nfev=nfev,
+        success=success,
+        message=message,
+    )
+
+
+# size of the NMRPipe header in bytes (512 float32 values)
+pipe_header_size = 2048
+# file extensions of planes when a directory is given to read_pipe
+pipe_plane_suffixes = [".ft", ".ft1", ".ft2", ".ft3", ".ft4", ".fid", ".dat"]
+
+
+def pipe_byte_order(path):
+    """ Byte order of the data in an NMRPipe file ("=" if native) """
+    # header value 2 is 2.345 when read with the byte order of the file
+    if abs(np.fromfile(path, "f4", 3)[2] - 2.345) < 1e-6:
+        return "="
+    return "<" if sys.byteorder == "big" else ">"
+
+
+def pipe_is_real(dic):
+    """ True if the directly detected dimension of an NMRPipe file is real """
+    if dic["FDTRANSPOSED"] == 1:
+        return dic["FDF1QUADFLAG"] == 1
+    return dic["FDF2QUADFLAG"] == 1
+
+
+def pipe_plane_files(path):
+    """ Files of a series of NMRPipe planes
+
+        :param path: filename template (e.g. data%03d.ft2 numbered from 1 as
+                     in NMRPipe) or a directory containing one file per plane
+                     (sorted by name with numbers in natural order)
+        :type path: str
+
+        :returns: list of files (empty if path is not a template or directory)
+        :rtype: list
+    """
+    if os.path.isdir(path):
+        files = [
+            str(f)
+            for f in Path(path).iterdir()
+            if f.is_file() and f.suffix in pipe_plane_suffixes
+        ]
+        return sorted(
+            files,
+            key=lambda f: [
+                int(part) if part.isdigit() else part
+                for part in re.split(r"(\d+)", os.path.basename(f))
+            ],
+        )
+    files = []
+    if "%" in os.path.basename(path):
+        while os.path.isfile(path % (len(files) + 1)):
+            files.append(path % (len(files) + 1))
+    return files
+
+
+def read_pipe(path):
+    """ Read an NMRPipe file with the data memory mapped
+
+        Real valued 2D files and 3D data streams (single file) are memory
+        mapped so that only the parts of the spectrum that are used are read
+        from disk. A filename template (e.g. data%03d.ft2) or a directory of
+        2D planes is read as a pseudo 3D series of :class:`PlaneFiles` using
+        the header (and so unit conversion) of the first plane. Anything else
+        (e.g. complex data) is read into memory with nmrglue.pipe.read.
+
+        :param path: NMRPipe file, filename template or directory of planes
+        :type path: str or pathlib.Path
+
+        :returns: dic, data
+        :rtype: tuple
+    """
+    path = str(path)
+    files = pipe_plane_files(path)
+    if files:
+        dic = ng.pipe.fdata2dic(ng.pipe.get_fdata(files[0]))
+        if not pipe_is_real(dic):
+            raise ValueError(f"Planes in {path} should be real valued spectra")
+        data = PlaneFiles(
+            files, ng.pipe.find_shape(dic)[-2:], pipe_byte_order(files[0]) + "f4"
+        )
+        return dic, data
+    if "%" in os.path.basename(path) or os.path.isdir(path):
+        raise FileNotFoundError(f"No NMRPipe planes found for {path}")
+
+    fdata = ng.pipe.get_fdata(path)
+    dic = ng.pipe.fdata2dic(fdata)
+    shape = ng.pipe.find_shape(dic)
+    real = pipe_is_real(dic)
+    # 3D/4D files that are not streams are only read as a single plane by nmrglue
+    stream = dic["FDDIMCOUNT"] == 2 or dic["FDPIPEFLAG"] != 0
+    shape = tuple(np.atleast_1d(shape))
+    size = pipe_header_size + 4 * int(np.prod(shape))
+    if not (real and stream and len(shape) in (2, 3)) or (
+        os.path.getsize(path) != size
+    ):
+        return ng.pipe.read(path)
+    data = np.memmap(
+        path,
+        dtype=pipe_byte_order(path) + "f4",
+        mode="r",
+        offset=pipe_header_size,
+        shape=shape,
+    )
+    return dic, data
+
+
+class PlaneFiles:
+    """ Pseudo 3D data stored as one NMRPipe file per plane
+
+        Indexing with a plane number memory maps that file so only the parts
+        of the plane that are used are read. :meth:`read` reads whole planes
+        in parallel threads. Pickling only sends the list of files.
+
+        :param files: NMRPipe file of each plane
+        :type files: list
+        :param shape: shape of each plane (as stored in the files)
+        :type shape: tuple
+        :param dtype: dtype of the data in the files
+        :type dtype: str
+        :param transposed: swap the axes of each plane
+        :type transposed: bool
+        :param threads: number of threads used by :meth:`read` (default is the number of CPUs)
+        :type threads: int
+
+    """
+
+    def __init__(self, files, shape, dtype, transposed=False, threads=None):
+        self.files = list(files)
+        self.threads = threads or os.cpu_count() or 1
+        self._plane_shape = tuple(int(i) for i in shape)
+        self._dtype = np.dtype(dtype)
+        self._transposed = transposed
+        size = pipe_header_size + self._dtype.itemsize * int(np.prod(shape))
+        for f in self.files:
+            if os.path.getsize(f) != size:
+                raise ValueError(
+                    f"{f} is not a {self._plane_shape} plane like {self.files[0]}"
+                )
+
+    @property
+    def shape(self):
+        shape = self._plane_shape[::-1] if self._transposed else self._plane_shape
+        return (len(self.files),) + shape
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def dtype(self):
+        return self._dtype.newbyteorder("=")
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, plane):
+        data = np.memmap(
+            self.files[plane],
+            dtype=self._dtype,
+            mode="r",
+            offset=pipe_header_size,
+            shape=self._plane_shape,
+        )
+        return data.T if self._transposed else data
+
+    def transpose(self, axes):
+        """ Transpose with axes given as [planes, f1, f2] (planes must be first) """
+        if axes[0] != 0:
+            raise ValueError("The planes of a series of files must be dimension 0")
+        return PlaneFiles(
+            self.files,
+            self._plane_shape,
+            self._dtype,
+            self._transposed != (list(axes[1:]) == [2, 1]),
+            self.threads,
+        )
+
+    def _read(self, plane):
+        data = np.fromfile(
+            self.files[plane],
+            dtype=self._dtype,
+            count=int(np.prod(self._plane_shape)),
+            offset=pipe_header_size,
+        ).reshape(self._plane_shape)
+        return data.T if self._transposed else data
+
+    def read(self, planes):
+        """ Read planes in parallel threads
+
+            At most threads + 1 planes are held in memory at once.
+
+            :param planes: plane numbers
+            :type planes: list
+
+            :returns: generator of planes in the order given
+            :rtype: numpy.array
+        """
+        with ThreadPoolExecutor(self.threads) as pool:
+            pending = deque()
+            for plane in planes:
+                pending.append(pool.submit(self._read, plane))
+                if len(pending) > self.threads:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+class Planes:
+    """ Pseudo 3D data (planes, f1, f2) that is read plane by plane
+
+        Indexing with a plane number returns that plane and indexing with a
+        list, boolean mask or slice of planes returns a new :class:`Planes`
+        without copying the data. Tuples (e.g. data[:, y0:y1, x0:x1]) only read
+        the requested window of each plane. When the data is memory mapped
+        from a file (or a :class:`PlaneFiles` series) only the planes and
+        windows that are used are read from disk and pickling sends the
+        location of the data rather than the data itself.
+
+        :param array: array with shape (planes, f1, f2) e.g. a transposed numpy.memmap
+        :type array: numpy.array
+        :param planes: indices of the selected planes (all if None)
+        :type planes: list
+        :param mapping: filename, dtype, offset, file shape, shape and axes
+                        used to memory map array (see :meth:`from_memmap`)
+        :type mapping: tuple
+
+    """
+
+    def __init__(self, array, planes=None, mapping=None):
+        self._array = array
+        if planes is None:
+            planes = np.arange(array.shape[0])
+        self._planes = np.asarray(planes, dtype=int)
+        self._mapping = mapping
+
+    @classmethod
+    def from_memmap(cls, memmap, shape, axes):
+        """ Planes of a memory map reshaped to shape and then transposed by axes """
+        mapping = (memmap.filename, memmap.dtype.str, memmap.offset, memmap.shape)
+        mapping = mapping + (tuple(shape), tuple(axes))
+        return cls._map(mapping)
+
+    @classmethod
+    def _map(cls, mapping, planes=None):
+        filename, dtype, offset, file_shape, shape, axes = mapping
+        memmap = np.memmap(
+            filename, dtype=dtype, mode="r", offset=offset, shape=file_shape
+        )
+        return cls(np.transpose(memmap.reshape(shape), axes), planes, mapping)
+
+    def __reduce__(self):
+        if self._mapping is not None:
+            return (Planes._map, (self._mapping, self._planes))
+        return (Planes, (self._array, self._planes))
+
+    @property
+    def mapped(self):
+        """ True if the data is memory mapped from a file (or files) """
+        return self._mapping is not None or isinstance(self._array, PlaneFiles)
+
+    @property
+    def planes(self):
+        """ Indices of the selected planes in the full data """
+        return self._planes
+
+    @property
+    def shape(self):
+        return (len(self._planes),) + self._array.shape[1:]
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def dtype(self):
+        return self._array.dtype
+
+    def __len__(self):
+        return len(self._planes)
+
+    def __iter__(self):
+        for plane in self._planes:
+            yield self._array[plane]
+
+    def _read(self):
+        """ generator of whole planes (read in parallel from a PlaneFiles series) """
+        if isinstance(self._array, PlaneFiles):
+            return self._array.read(self._planes)
+        return iter(self)
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.empty(self.shape, dtype=dtype or self.dtype)
+        for num, plane in enumerate(self._read()):
+            data[num] = plane
+        return data
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            planes, window = key[0], key[1:]
+            selected = self[planes]
+            if isinstance(selected, Planes):
+                return np.array([plane[window] for plane in selected])
+            return selected[window]
+        if isinstance(key, (int, np.integer)):
+            return self._array[self._planes[key]]
+        if isinstance(key, slice):
+            return Planes(self._array, self._planes[key], self._mapping)
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.flatnonzero(key)
+        return Planes(self._array, self._planes[key], self._mapping)
+
+    def sum(self, axis=None):
+        """ Sum of data (planes are summed one at a time for axis=0) """
+        if axis != 0:
+            return np.asarray(self).sum(axis=axis)
+        summed = np.zeros(self.shape[1:], dtype=self.dtype)
+        for plane in self._read():
+            summed += plane
+        return summed
+
+
+def cluster_colors(df):
+    """ Colors of peaks by cluster (singlets are black)
+
+        :param df: peaklist with CLUSTID and MEMCNT columns
+        :type df: pandas.DataFrame
+
+        :returns: color of each peak
+        :rtype: numpy.array
+    """
+    palette = np.array(Category20[20])
+    colors = palette[df.CLUSTID.to_numpy(dtype=int) % 20]
+    return np.where(df.MEMCNT.to_numpy() > 1, colors, "black")
+
+
+class AxisConverter:
+    """ Vectorized conversions between points, ppm and Hz for one dimension
+
+        The conversions are affine (ppm = ppm_0 + ppm_step * points) so the
+        coefficients are taken once from the nmrglue unit conversion object and
+        whole arrays or DataFrame columns are converted with numpy operations
+        instead of calling the unit converter for each value.
+
+        :param uc: nmrglue unit conversion object
+        :type uc: nmrglue.fileio.fileiobase.unit_conversion
+        :param size: number of points in the dimension
+        :type size: int
+
+    """
+
+    def __init__(self, uc, size):
+        self.size = size
+        self.ppm_limits = uc.ppm_limits()
+        self.hz_limits = uc.hz_limits()
+        self.ppm_scale = np.linspace(*self.ppm_limits, size)
+        self.ppm_0 = self.ppm_limits[0]
+        # ppm per point (negative since ppm decreases along the axis)
+        self.ppm_step = (self.ppm_limits[1] - self.ppm_0) / max(1, size - 1)
+        self.hz_step = (self.hz_limits[1] - self.hz_limits[0]) / max(1, size - 1)
+
+    def ppm(self, pts):
+        """ Points to ppm """
+        return self.ppm_0 + self.ppm_step * np.asarray(pts, dtype=float)
+
+    def pts(self, ppm):
+        """ ppm to (fractional) points """
+        return (np.asarray(ppm, dtype=float) - self.ppm_0) / self.ppm_step
+
+    def index(self, ppm):
+        """ ppm to nearest integer point """
+        return np.round(self.pts(ppm)).astype(int)
+
+    def hz_to_pts(self, hz):
+        """ Widths in Hz to widths in points """
+        return np.asarray(hz, dtype=float) / abs(self.hz_step)
+
+    def ppm_to_pts(self, ppm):
+        """ Widths in ppm to widths in points """
+        return np.asarray(ppm, dtype=float) / abs(self.ppm_step)
+
+
 class Pseudo3D:
     """Read dic, data from NMRGlue and dims from input to create a Pseudo3D dataset
 
@@ -1153,28 +3763,34 @@ class Pseudo3D:
             self._planes = 0
             self._uc_f1 = ng.pipe.make_uc(dic, data, dim=self._f1_dim)
             self._uc_f2 = ng.pipe.make_uc(dic, data, dim=self._f2_dim)
-            # make data pseudo3d
-            self._data = data.reshape((1, data.shape[0], data.shape[1]))
             self._dims = [self._planes, self._f1_dim + 1, self._f2_dim + 1]
 
         else:
             self._planes, self._f1_dim, self._f2_dim = dims
             self._dims = dims
-            self._data = data
             # make unit conversion dicts
             self._uc_f2 = ng.pipe.make_uc(dic, data, dim=self._f2_dim)
             self._uc_f1 = ng.pipe.make_uc(dic, data, dim=self._f1_dim)
 
         #  rearrange data if dims not in standard order
-        if self._dims != [0, 1, 2]:
-            # np.argsort returns indices of array for order 0,1,2 to transpose data correctly
-            # self._dims = np.argsort(self._dims)
-            self._data = np.transpose(data, self._dims)
+        # np.argsort returns indices of array for order 0,1,2 to transpose data correctly
+        # self._dims = np.argsort(self._dims)
+        # make data pseudo3d (planes are only read when they are used)
+        shape = (1,) * (3 - data.ndim) + data.shape
+        if isinstance(data, PlaneFiles):
+            self._data = Planes(data.transpose(self._dims))
+        elif isinstance(data, np.memmap):
+            self._data = Planes.from_memmap(data, shape, self._dims)
+        else:
+            self._data = Planes(np.transpose(data.reshape(shape), self._dims))
 
         self._dic = dic
 
         self._f1_label = self._udic[self._f1_dim]["label"]
         self._f2_label = self._udic[self._f2_dim]["label"]
+        # unit conversion coefficients and axis scales are only calculated once
+        self._axis_f1 = AxisConverter(self._uc_f1, self.f1_size)
+        self._axis_f2 = AxisConverter(self._uc_f2, self.f2_size)
 
     @property
     def uc_f1(self):
@@ -1186,6 +3802,16 @@ class Pseudo3D:
         """ Return unit conversion dict for F2"""
         return self._uc_f2
 
+    @property
+    def axis_f1(self):
+        """ Return vectorized unit converter for F1 """
+        return self._axis_f1
+
+    @property
+    def axis_f2(self):
+        """ Return vectorized unit converter for F2 """
+        return self._axis_f2
+
     @property
     def dims(self):
         """ Return dimension order """
@@ -1198,6 +3824,8 @@ class Pseudo3D:
 
     @data.setter
     def data(self, data):
+        if not isinstance(data, Planes):
+            data = Planes(np.asarray(data))
         self._data = data
 
     @property
@@ -1228,7 +3856,7 @@ class Pseudo3D:
 
     @property
     def n_planes(self):
-        return self.data.shape[self.planes]
+        return self.data.shape[0]
 
     @property
     def f1(self):
@@ -1292,19 +3920,19 @@ class Pseudo3D:
     # get ppm limits for ppm scales
     @property
     def f2_ppm_scale(self):
-        return self.uc_f2.ppm_scale()
+        return self.axis_f2.ppm_scale
 
     @property
     def f1_ppm_scale(self):
-        return self.uc_f1.ppm_scale()
+        return self.axis_f1.ppm_scale
 
     @property
     def f2_ppm_limits(self):
-        return self.uc_f2.ppm_limits()
+        return self.axis_f2.ppm_limits
 
     @property
     def f1_ppm_limits(self):
-        return self.uc_f1.ppm_limits()
+        return self.axis_f1.ppm_limits
 
     @property
     def f1_ppm_max(self):
@@ -1380,7 +4008,7 @@ class Peaklist(Pseudo3D):
         verbose=False,
     ):
 
-        dic, data = ng.pipe.read(data_path)
+        dic, data = read_pipe(data_path)
         Pseudo3D.__init__(self, dic, data, dims)
         self.fmt = fmt
         self.peaklist_path = path
@@ -1512,42 +4140,36 @@ class Peaklist(Pseudo3D):
 
     def update_df(self):
         # int point value
-        self.df["X_AXIS"] = self.df.X_PPM.apply(lambda x: self.uc_f2(x, "ppm"))
-        self.df["Y_AXIS"] = self.df.Y_PPM.apply(lambda x: self.uc_f1(x, "ppm"))
+        self.df["X_AXIS"] = self.axis_f2.index(self.df.X_PPM)
+        self.df["Y_AXIS"] = self.axis_f1.index(self.df.Y_PPM)
         # decimal point value
-        self.df["X_AXISf"] = self.df.X_PPM.apply(lambda x: self.uc_f2.f(x, "ppm"))
-        self.df["Y_AXISf"] = self.df.Y_PPM.apply(lambda x: self.uc_f1.f(x, "ppm"))
+        self.df["X_AXISf"] = self.axis_f2.pts(self.df.X_PPM)
+        self.df["Y_AXISf"] = self.axis_f1.pts(self.df.Y_PPM)
         # in case of missing values (should estimate though)
         self.df.XW_HZ.replace("None", "20.0", inplace=True)
         self.df.YW_HZ.replace("None", "20.0", inplace=True)
         self.df.XW_HZ.replace(np.NaN, "20.0", inplace=True)
         self.df.YW_HZ.replace(np.NaN, "20.0", inplace=True)
         # convert linewidths to float
-        self.df["XW_HZ"] = self.df.XW_HZ.apply(lambda x: float(x))
-        self.df["YW_HZ"] = self.df.YW_HZ.apply(lambda x: float(x))
+        self.df["XW_HZ"] = self.df.XW_HZ.astype(float)
+        self.df["YW_HZ"] = self.df.YW_HZ.astype(float)
         # convert Hz lw to points
-        self.df["XW"] = self.df.XW_HZ.apply(lambda x: x * self.pt_per_hz_f2)
-        self.df["YW"] = self.df.YW_HZ.apply(lambda x: x * self.pt_per_hz_f1)
+        self.df["XW"] = self.axis_f2.hz_to_pts(self.df.XW_HZ)
+        self.df["YW"] = self.axis_f1.hz_to_pts(self.df.YW_HZ)
         # makes an assignment column
         if self.fmt == "a2":
-            self.df["ASS"] = self.df.apply(
-                lambda i: "".join([i["Assign F1"], i["Assign F2"]]), axis=1
-            )
+            self.df["ASS"] = self.df["Assign F1"] + self.df["Assign F2"]
 
         # make default values for X and Y radii for fit masks
         self.df["X_RADIUS_PPM"] = np.zeros(len(self.df)) + self.f2_radius
         self.df["Y_RADIUS_PPM"] = np.zeros(len(self.df)) + self.f1_radius
-        self.df["X_RADIUS"] = self.df.X_RADIUS_PPM.apply(
-            lambda x: x * self.pt_per_ppm_f2
-        )
-        self.df["Y_RADIUS"] = self.df.Y_RADIUS_PPM.apply(
-            lambda x: x * self.pt_per_ppm_f1
-        )
+        self.df["X_RADIUS"] = self.axis_f2.ppm_to_pts(self.df.X_RADIUS_PPM)
+        self.df["Y_RADIUS"] = self.axis_f1.ppm_to_pts(self.df.Y_RADIUS_PPM)
         # add include column
         if "include" in self.df.columns:
             pass
         else:
-            self.df["include"] = self.df.apply(lambda x: "yes", axis=1)
+            self.df["include"] = "yes"
 
         # check assignments for duplicates
         self.check_assignments()
@@ -1729,7 +4351,9 @@ class Peaklist(Pseudo3D):
 
         labeled_array, num_features = ndimage.label(closed_data, l_struc)
 
-        self.df.loc[:, "CLUSTID"] = [labeled_array[i[0], i[1]] for i in peaks]
+        self.df.loc[:, "CLUSTID"] = labeled_array[
+            self.df.Y_AXIS.to_numpy(), self.df.X_AXIS.to_numpy()
+        ]
 
         #  renumber "0" clusters
         max_clustid = self.df["CLUSTID"].max()
@@ -1739,13 +4363,9 @@ class Peaklist(Pseudo3D):
         )
 
         # count how many peaks per cluster
-        for ind, group in self.df.groupby("CLUSTID"):
-            self.df.loc[group.index, "MEMCNT"] = len(group)
+        self.df.loc[:, "MEMCNT"] = self.df.groupby("CLUSTID").CLUSTID.transform("size")
 
-        self.df.loc[:, "color"] = self.df.apply(
-            lambda x: Category20[20][int(x.CLUSTID) % 20] if x.MEMCNT > 1 else "black",
-            axis=1,
-        )
+        self.df.loc[:, "color"] = cluster_colors(self.df)
         return ClustersResult(labeled_array, num_features, closed_data, peaks)
 
     # def adaptive_clusters(self, block_size, offset, l_struc=None):
@@ -1798,7 +4418,9 @@ class Peaklist(Pseudo3D):
         peaks = [[y, x] for y, x in zip(self.df.Y_AXIS, self.df.X_AXIS)]
         labeled_array, num_features = ndimage.label(mask, l_struc)
 
-        self.df.loc[:, "CLUSTID"] = [labeled_array[i[0], i[1]] for i in peaks]
+        self.df.loc[:, "CLUSTID"] = labeled_array[
+            self.df.Y_AXIS.to_numpy(), self.df.X_AXIS.to_numpy()
+        ]
 
         #  renumber "0" clusters
         max_clustid = self.df["CLUSTID"].max()
@@ -1808,13 +4430,9 @@ class Peaklist(Pseudo3D):
         )
 
         # count how many peaks per cluster
-        for ind, group in self.df.groupby("CLUSTID"):
-            self.df.loc[group.index, "MEMCNT"] = len(group)
+        self.df.loc[:, "MEMCNT"] = self.df.groupby("CLUSTID").CLUSTID.transform("size")
 
-        self.df.loc[:, "color"] = self.df.apply(
-            lambda x: Category20[20][int(x.CLUSTID) % 20] if x.MEMCNT > 1 else "black",
-            axis=1,
-        )
+        self.df.loc[:, "color"] = cluster_colors(self.df)
 
         return ClustersResult(labeled_array, num_features, mask, peaks)
 
@@ -1897,14 +4515,7 @@ class LoadData(Peaklist):
 
     def read_peaklist(self):
 
-        if self.peaklist_path.suffix == ".csv":
-            self.df = pd.read_csv(self.peaklist_path)  # , comment="#")
-
-        elif self.peaklist_path.suffix == ".tab":
-            self.df = pd.read_csv(self.peaklist_path, sep="\t")  # comment="#")
-
-        else:
-            self.df = pd.read_pickle(self.peaklist_path)
+        self.df = read_table(self.peaklist_path)
 
         self._thres = threshold_otsu(self.data[0])
 
@@ -1929,13 +4540,10 @@ class LoadData(Peaklist):
         if "include" in self.df.columns:
             pass
         else:
-            self.df["include"] = self.df.apply(lambda _: "yes", axis=1)
+            self.df["include"] = "yes"
 
         # color clusters
-        self.df["color"] = self.df.apply(
-            lambda x: Category20[20][int(x.CLUSTID) % 20] if x.MEMCNT > 1 else "black",
-            axis=1,
-        )
+        self.df["color"] = cluster_colors(self.df)
 
         # get rid of unnamed columns
         unnamed_cols = [i for i in self.df.columns if "Unnamed:" in i]
@@ -1944,42 +4552,36 @@ class LoadData(Peaklist):
     def update_df(self):
         """ Slightly modified to retain previous configurations """
         # int point value
-        self.df["X_AXIS"] = self.df.X_PPM.apply(lambda x: self.uc_f2(x, "ppm"))
-        self.df["Y_AXIS"] = self.df.Y_PPM.apply(lambda x: self.uc_f1(x, "ppm"))
+        self.df["X_AXIS"] = self.axis_f2.index(self.df.X_PPM)
+        self.df["Y_AXIS"] = self.axis_f1.index(self.df.Y_PPM)
         # decimal point value
-        self.df["X_AXISf"] = self.df.X_PPM.apply(lambda x: self.uc_f2.f(x, "ppm"))
-        self.df["Y_AXISf"] = self.df.Y_PPM.apply(lambda x: self.uc_f1.f(x, "ppm"))
+        self.df["X_AXISf"] = self.axis_f2.pts(self.df.X_PPM)
+        self.df["Y_AXISf"] = self.axis_f1.pts(self.df.Y_PPM)
         # in case of missing values (should estimate though)
         # self.df.XW_HZ.replace("None", "20.0", inplace=True)
         # self.df.YW_HZ.replace("None", "20.0", inplace=True)
         self.df.XW_HZ.replace(np.NaN, "20.0", inplace=True)
         self.df.YW_HZ.replace(np.NaN, "20.0", inplace=True)
         # convert linewidths to float
-        self.df["XW_HZ"] = self.df.XW_HZ.apply(lambda x: float(x))
-        self.df["YW_HZ"] = self.df.YW_HZ.apply(lambda x: float(x))
+        self.df["XW_HZ"] = self.df.XW_HZ.astype(float)
+        self.df["YW_HZ"] = self.df.YW_HZ.astype(float)
         # convert Hz lw to points
-        self.df["XW"] = self.df.XW_HZ.apply(lambda x: x * self.pt_per_hz_f2)
-        self.df["YW"] = self.df.YW_HZ.apply(lambda x: x * self.pt_per_hz_f1)
+        self.df["XW"] = self.axis_f2.hz_to_pts(self.df.XW_HZ)
+        self.df["YW"] = self.axis_f1.hz_to_pts(self.df.YW_HZ)
         # makes an assignment column
         if self.fmt == "a2":
-            self.df["ASS"] = self.df.apply(
-                lambda i: "".join([i["Assign F1"], i["Assign F2"]]), axis=1
-            )
+            self.df["ASS"] = self.df["Assign F1"] + self.df["Assign F2"]
 
         # make default values for X and Y radii for fit masks
         # self.df["X_RADIUS_PPM"] = np.zeros(len(self.df)) + self.f2_radius
         # self.df["Y_RADIUS_PPM"] = np.zeros(len(self.df)) + self.f1_radius
-        self.df["X_RADIUS"] = self.df.X_RADIUS_PPM.apply(
-            lambda x: x * self.pt_per_ppm_f2
-        )
-        self.df["Y_RADIUS"] = self.df.Y_RADIUS_PPM.apply(
-            lambda x: x * self.pt_per_ppm_f1
-        )
+        self.df["X_RADIUS"] = self.axis_f2.ppm_to_pts(self.df.X_RADIUS_PPM)
+        self.df["Y_RADIUS"] = self.axis_f1.ppm_to_pts(self.df.Y_RADIUS_PPM)
         # add include column
         if "include" in self.df.columns:
             pass
         else:
-            self.df["include"] = self.df.apply(lambda x: "yes", axis=1)
+            self.df["include"] = "yes"
 
         # check assignments for duplicates
         self.check_assignments()
@@ -1987,6 +4589,102 @@ class LoadData(Peaklist):
         self.check_peak_bounds()
 
 
+def hash_inputs(*parts):
+    """ Hash of numpy arrays, DataFrames and JSON serialisable objects
+
+        :returns: hex digest
+        :rtype: str
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(str((part.shape, part.dtype)).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, Planes):
+            # hashed one plane at a time
+            h.update(str((part.shape, part.dtype)).encode())
+            for plane in part:
+                h.update(np.ascontiguousarray(plane).tobytes())
+        elif isinstance(part, pd.DataFrame):
+            h.update(",".join(str(c) for c in part.columns).encode())
+            h.update(pd.util.hash_pandas_object(part, index=False).values.tobytes())
+        else:
+            h.update(json.dumps(part, sort_keys=True, default=str).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class FitCache:
+    """ Persistent content addressed cache of per-cluster fit results
+
+        Results are pickled to <path>/<key>.pkl where the key is a hash of
+        everything that determines the fit of a cluster (see :meth:`key`).
+        Reading an entry updates its modification time so that :meth:`evict`
+        can remove the least recently used entries once the cache grows
+        beyond max_size.
+
+        :param path: cache directory
+        :type path: str or pathlib.Path
+        :param max_size: maximum size of cache in bytes
+        :type max_size: int
+
+    """
+
+    # increase to invalidate entries written by older versions
+    version = 2
+
+    def __init__(self, path=".peakipy_cache", max_size=512 * 1024 ** 2):
+        self.path = Path(path)
+        self.max_size = max_size
+
+    def key(self, *parts):
+        """ Cache key for parts (see :func:`hash_inputs`)
+
+            :returns: hex digest
+            :rtype: str
+        """
+        return hash_inputs(self.version, *parts)
+
+    def get(self, key):
+        """ Return cached value or None """
+        path = self.path / f"{key}.pkl"
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return value
+
+    def put(self, key, value):
+        """ Store value (written atomically so that workers can share the cache) """
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.path / f"{key}.pkl"
+        tmp_path = self.path / f"{key}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        """ Remove least recently used entries until cache is smaller than max_size """
+        entries = []
+        for path in self.path.glob("*.pkl"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+
+
 def read_config(args, config_path="peakipy.config"):
     """ read a peakipy config file, extract params and update args dict
 
@@ -1,11 +1,29 @@
+import os
+import time
 import unittest
 import shutil
+import tempfile
+import threading
+from multiprocessing import Process, Event
+
+import numpy as np
+import pandas as pd
 
 import peakipy.commandline.edit
 import peakipy.commandline.check
 import peakipy.commandline.fit
 import peakipy.commandline.read
 import peakipy.commandline.spec
+import peakipy.commandline.worker
+
+
+def claim_and_hang(path, claimed):
+    """ Spool worker that claims a task and never finishes it """
+    spool = peakipy.commandline.fit.Spool(path)
+    while spool.run_id() is None or spool.claim() is None:
+        time.sleep(0.01)
+    claimed.set()
+    time.sleep(600)
 
 
 class TestPeakipyCommandline(unittest.TestCase):
@@ -28,9 +46,148 @@ class TestPeakipyCommandline(unittest.TestCase):
     #     peakipy.commandline.read.main(argv)
 
     def test_fit_main_with_default(self):
-        argv = ["test_protein_L/test.csv", "test_protein_L/test1.ft2", "fits.csv"]
+        argv = [
+            "test_protein_L/test.csv",
+            "test_protein_L/test1.ft2",
+            "fits.csv",
+            "--no-cache",
+        ]
         peakipy.commandline.fit.main(argv)
 
+    def test_fit_main_with_direct_engine(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fits = {}
+            for engine in ["lmfit", "direct"]:
+                path = os.path.join(tmp, f"fits_{engine}.csv")
+                argv = [
+                    "test_protein_L/test.csv",
+                    "test_protein_L/test1.ft2",
+                    path,
+                    f"--engine={engine}",
+                    "--no-cache",
+                ]
+                peakipy.commandline.fit.main(argv)
+                fits[engine] = pd.read_csv(path)
+            lmfit, direct = [
+                fits[engine].sort_values(["assignment", "plane"]).reset_index(drop=True)
+                for engine in ["lmfit", "direct"]
+            ]
+            self.assertEqual(len(lmfit), len(direct))
+            self.assertTrue((lmfit.assignment == direct.assignment).all())
+            # amplitudes to 0.1 % and positions/widths to 0.01 points
+            np.testing.assert_allclose(direct.amp, lmfit.amp, rtol=1e-3)
+            for col in ["center_x", "center_y", "sigma_x", "sigma_y"]:
+                np.testing.assert_allclose(direct[col], lmfit[col], atol=1e-2)
+
+    def test_fit_main_with_block_size(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            argv = [
+                "test_protein_L/test.csv",
+                "test_protein_L/test1.ft2",
+                os.path.join(tmp, "fits_blocks.csv"),
+                "--block_size=3",
+                "--no-cache",
+            ]
+            peakipy.commandline.fit.main(argv)
+
+    def test_fit_main_with_flagged_plots(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            argv = [
+                "test_protein_L/test.csv",
+                "test_protein_L/test1.ft2",
+                os.path.join(tmp, "fits_plots.csv"),
+                "--plot=" + os.path.join(tmp, "plots"),
+                "--plot_style=2d",
+                "--plot_flagged",
+                "--no-cache",
+            ]
+            peakipy.commandline.fit.main(argv)
+
+    def test_fit_main_with_spool(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            spool = os.path.join(tmp, "spool")
+            workers = [
+                Process(
+                    target=peakipy.commandline.worker.main,
+                    args=([spool, "--once", "--poll=0.1"],),
+                    daemon=True,
+                )
+                for _ in range(2)
+            ]
+            for worker in workers:
+                worker.start()
+            argv = [
+                "test_protein_L/test.csv",
+                "test_protein_L/test1.ft2",
+                os.path.join(tmp, "fits_spool.csv"),
+                "--spool=" + spool,
+                "--no-cache",
+            ]
+            try:
+                peakipy.commandline.fit.main(argv)
+                for worker in workers:
+                    worker.join(timeout=60)
+                    self.assertEqual(worker.exitcode, 0)
+            finally:
+                # workers only return once they have seen a run
+                for worker in workers:
+                    worker.terminate()
+                    worker.join()
+            argv = [
+                "test_protein_L/test.csv",
+                "test_protein_L/test1.ft2",
+                os.path.join(tmp, "fits_nomp.csv"),
+                "--nomp",
+                "--no-cache",
+            ]
+            peakipy.commandline.fit.main(argv)
+            spool_fits, nomp_fits = [
+                pd.read_csv(os.path.join(tmp, name))
+                .sort_values(["assignment", "plane"])
+                .reset_index(drop=True)
+                for name in ["fits_spool.csv", "fits_nomp.csv"]
+            ]
+            # every peak of every cluster is fitted exactly once in each plane
+            peaks = pd.read_csv("test_protein_L/test.csv")
+            self.assertEqual(set(spool_fits.clustid), set(peaks.CLUSTID))
+            self.assertFalse(spool_fits.duplicated(["assignment", "plane"]).any())
+            self.assertEqual(len(spool_fits), len(nomp_fits))
+            self.assertTrue((spool_fits.assignment == nomp_fits.assignment).all())
+            self.assertTrue((spool_fits.plane == nomp_fits.plane).all())
+            np.testing.assert_allclose(spool_fits.amp, nomp_fits.amp, rtol=1e-5)
+            for col in ["center_x", "center_y"]:
+                np.testing.assert_allclose(spool_fits[col], nomp_fits[col], atol=1e-3)
+
+    def test_fit_main_with_dead_spool_worker(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            claimed = Event()
+            worker = Process(
+                target=claim_and_hang,
+                args=(os.path.join(tmp, "spool"), claimed),
+                daemon=True,
+            )
+            worker.start()
+            argv = [
+                "test_protein_L/test.csv",
+                "test_protein_L/test1.ft2",
+                os.path.join(tmp, "fits.csv"),
+                "--spool=" + os.path.join(tmp, "spool"),
+                "--no-cache",
+            ]
+            fit = threading.Thread(target=peakipy.commandline.fit.main, args=(argv,))
+            fit.start()
+            try:
+                self.assertTrue(claimed.wait(timeout=300))
+            finally:
+                # the worker dies while holding its claim
+                worker.terminate()
+                worker.join()
+            fit.join(timeout=600)
+            self.assertFalse(fit.is_alive())
+            fits = pd.read_csv(os.path.join(tmp, "fits.csv"))
+            peaks = pd.read_csv("test_protein_L/test.csv")
+            self.assertEqual(fits.clustid.nunique(), peaks.CLUSTID.nunique())
+
     def test_check_main_with_default(self):
         argv = [
             "test_protein_L/fits.csv",
@@ -51,7 +208,15 @@ class TestPeakipyCommandline(unittest.TestCase):
 if __name__ == "__main__":
 
     unittest.main(verbosity=2)
-    to_clean = ["test.csv", "peakipy.config", "run_log.txt", "fits.csv"]
+    to_clean = [
+        "test.csv",
+        "peakipy.config",
+        "run_log.txt",
+        "fits.csv",
+        "fits.log",
+        "plots.pdf",
+        ".peakipy_cache",
+    ]
     for i in to_clean:
         print(f"Deleting: {i}")
         shutil.rmtree(i)
@@ -1,3 +1,7 @@
+import os
+import json
+import pickle
+import tempfile
 import unittest
 from unittest.mock import patch
 
@@ -8,6 +12,9 @@ from lmfit import Model
 
 from peakipy.core import (
     make_mask,
+    peak_free_mask,
+    estimate_noise,
+    plane_noise,
     fix_params,
     pvoigt2d,
     pv_pv,
@@ -15,8 +22,30 @@ from peakipy.core import (
     make_param_dict,
     to_prefix,
     make_models,
+    make_jacobian,
+    lineshape_jacobians,
+    GridXY,
+    ClusterModel,
+    fit_first_plane,
+    fit_amplitudes,
+    fit_quality,
+    fit_global,
+    fit_direct,
+    FitCache,
+    only_amplitudes_vary,
+    pv_l,
+    gaussian_lorentzian,
+    voigt2d,
+    voigt,
+    set_voigt_accuracy,
+    lineshapes,
     Pseudo3D,
+    Planes,
+    PlaneFiles,
+    read_pipe,
     Peaklist,
+    write_table,
+    read_table,
 )
 
 import peakipy.commandline.edit
@@ -85,6 +114,53 @@ class TestCoreFunctions(unittest.TestCase):
         # print(result)
         self.assertEqual(test.sum(), 0)
 
+    def test_estimate_noise(self):
+        peaks = pd.DataFrame(
+            dict(X_AXISf=[50.0], Y_AXISf=[40.0], X_RADIUS=[8.0], Y_RADIUS=[5.0])
+        )
+        mask = peak_free_mask((80, 100), peaks)
+        self.assertFalse(mask[40, 50])
+        self.assertFalse(mask[40, 57])
+        self.assertTrue(mask[40, 59])
+        self.assertTrue(mask[46, 50])
+        self.assertEqual((~mask).sum(), make_mask(mask, 50.0, 40.0, 8.0, 5.0).sum())
+
+        sigma = np.array([1.0, 2.0, 5.0])
+        data = np.random.RandomState(0).normal(size=(3, 80, 100)) * sigma[:, None, None]
+        # a strong peak and a few spikes outside the mask are ignored
+        data[:, 35:46, 42:59] += 1000.0
+        data[:, 10, :5] += 500.0
+        noise = estimate_noise(data, mask)
+        np.testing.assert_allclose(noise, sigma, rtol=0.05)
+        np.testing.assert_allclose(
+            estimate_noise(data, mask, max_points=1000), sigma, rtol=0.15
+        )
+        # planes without noise get the median noise
+        data[1] = 0.0
+        self.assertEqual(estimate_noise(data, mask)[1], np.median(noise[[0, 2]]))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_path = os.path.join(tmpdir, "noise.json")
+            dic, data = read_pipe("test/test_protein_L/test1.ft2")
+            planes = Pseudo3D(dic, data, [0, 1, 2]).data[[1, 3]]
+            args = (planes, peaks, "test/test_protein_L/test1.ft2")
+            first = plane_noise(*args, dims=[0, 1, 2], cache_path=cache_path)
+            with open(cache_path) as f:
+                cached = json.load(f)["noise"]
+            self.assertEqual(sorted(cached), ["1", "3"])
+            # cached values are used
+            with patch("peakipy.core.estimate_noise") as mock_estimate:
+                second = plane_noise(*args, dims=[0, 1, 2], cache_path=cache_path)
+            mock_estimate.assert_not_called()
+            np.testing.assert_array_equal(first, second)
+            # but not if the peaks change
+            moved = peaks.assign(X_RADIUS=[12.0])
+            with patch("peakipy.core.estimate_noise", return_value=[1.0, 2.0]):
+                third = plane_noise(
+                    planes, moved, args[2], dims=[0, 1, 2], cache_path=cache_path
+                )
+            np.testing.assert_array_equal(third, [1.0, 2.0])
+
     def test_fix_params(self):
 
         mod = Model(pvoigt2d)
@@ -202,6 +278,471 @@ class TestCoreFunctions(unittest.TestCase):
                 self.assertEqual(p_guess["_one_fraction_y"].vary, True)
                 self.assertEqual(p_guess["_one_fraction_y"].value, 0.5)
 
+    def test_lineshape_jacobians(self):
+
+        x, y = np.meshgrid(np.linspace(0, 20, 21), np.linspace(0, 10, 11))
+        XY = np.array([x.ravel(), y.ravel()])
+        values = dict(
+            amplitude=10.0,
+            center_x=9.3,
+            center_y=5.2,
+            sigma_x=2.1,
+            sigma_y=1.6,
+            fraction=0.3,
+            fraction_x=0.3,
+            fraction_y=0.7,
+            gamma_x=1.2,
+            gamma_y=0.8,
+        )
+        step = 1e-6
+        # w'(z) = -2zw + 2i/sqrt(pi) only holds to the accuracy of the voigt approximation
+        set_voigt_accuracy(32)
+        for func, jac_func in lineshape_jacobians.items():
+            with self.subTest(lineshape=func.__name__):
+                params = Model(func).param_names
+                kws = {k: values[k] for k in params}
+                jac = jac_func(XY, **kws)
+                self.assertEqual(sorted(jac), sorted(params))
+                for name in params:
+                    up = dict(kws, **{name: kws[name] + step})
+                    down = dict(kws, **{name: kws[name] - step})
+                    numeric = (func(XY, **up) - func(XY, **down)) / (2 * step)
+                    np.testing.assert_allclose(
+                        jac[name], numeric, rtol=1e-5, atol=1e-7 * np.abs(numeric).max()
+                    )
+        set_voigt_accuracy()
+
+    def test_lineshapes(self):
+
+        df = pd.DataFrame(
+            dict(
+                amp=[10.0, 4.0],
+                amp_err=[1.0, 0.5],
+                center_x=[9.3, 3.0],
+                center_y=[5.2, 7.0],
+                sigma_x=[2.1, 0.8],
+                sigma_y=[1.6, 1.1],
+                fraction=[0.3, 0.9],
+                fraction_x=[0.3, 0.1],
+                fraction_y=[0.7, 0.5],
+                gamma_x=[1.2, 0.4],
+                gamma_y=[0.8, 2.0],
+            )
+        )
+        for name, lineshape in lineshapes.items():
+            with self.subTest(lineshape=name):
+                # heights are the models evaluated at the peak centers
+                expected = [
+                    lineshape.model(
+                        np.array([[row.center_x], [row.center_y]]),
+                        *[getattr(row, i) for i in lineshape.columns],
+                    )[0]
+                    for row in df.itertuples()
+                ]
+                np.testing.assert_allclose(lineshape.height(df), expected)
+                np.testing.assert_allclose(
+                    lineshape.height(df, amplitude="amp_err"),
+                    np.array(expected) * df.amp_err / df.amp,
+                )
+                np.testing.assert_allclose(lineshape.volume(df), df.amp)
+                fwhm = lineshape.fwhm(df)
+                # profiles drop to half of their maximum at center + fwhm / 2
+                half = [
+                    lineshape.model(
+                        np.array([[row.center_x + fwhm_x / 2.0], [row.center_y]]),
+                        *[getattr(row, i) for i in lineshape.columns],
+                    )[0]
+                    for row, fwhm_x in zip(df.itertuples(), fwhm["fwhm_x"])
+                ]
+                # approximation is accurate to ~0.02 % for voigt
+                np.testing.assert_allclose(half, np.array(expected) / 2.0, rtol=1e-3)
+                # simulated peaks on a window match the models
+                x = np.arange(2, 12)
+                y = np.arange(3, 9)
+                sim = lineshape.simulate(df, x, y)
+                self.assertEqual(sim.shape, (2, len(y), len(x)))
+                for row, single in zip(df.itertuples(), sim):
+                    np.testing.assert_allclose(
+                        single,
+                        lineshape.model(
+                            GridXY(x, y), *[getattr(row, i) for i in lineshape.columns]
+                        ).reshape(len(y), len(x)),
+                    )
+
+    def test_voigt(self):
+
+        from scipy.special import wofz
+
+        x = np.linspace(-50, 50, 1001)
+        for sigma, gamma in [(0.5, 0.01), (2.0, 1.0), (1.0, 8.0)]:
+            z = (x + 1j * gamma) / (sigma * np.sqrt(2.0))
+            expected = wofz(z).real / (sigma * np.sqrt(2.0 * np.pi))
+            for n_terms, tol in [(8, 1e-3), (16, 1e-6), (32, 1e-12)]:
+                set_voigt_accuracy(n_terms)
+                np.testing.assert_allclose(
+                    voigt(x, 0.0, sigma, gamma),
+                    expected,
+                    rtol=0,
+                    atol=tol * expected.max(),
+                )
+        set_voigt_accuracy()
+        # gamma is no longer ignored
+        XY = GridXY(x, x)
+        self.assertFalse(
+            np.allclose(
+                voigt2d(XY, 1.0, 0.0, 0.0, 1.0, 1.0, 0.1, 0.1),
+                voigt2d(XY, 1.0, 0.0, 0.0, 1.0, 1.0, 2.0, 2.0),
+            )
+        )
+
+    def test_GridXY(self):
+
+        x = np.arange(3, 12)
+        y = np.arange(5, 11)
+        X, Y = np.meshgrid(x, y)
+        mask = make_mask(X, 4.3, 2.7, 3.0, 2.0)
+        kws = dict(center_x=7.3, center_y=7.7, sigma_x=1.5, sigma_y=2.0)
+
+        for func, frac in [
+            (pvoigt2d, dict(fraction=0.4)),
+            (pv_pv, dict(fraction_x=0.2, fraction_y=0.9)),
+        ]:
+            full = func([X, Y], **kws, **frac)
+            # outer product on full grid
+            np.testing.assert_allclose(func(GridXY(x, y), **kws, **frac), full)
+            # gathered masked pixels
+            XY_mask = GridXY.from_mask(mask, x0=3, y0=5)
+            np.testing.assert_allclose(func(XY_mask, **kws, **frac), full[mask])
+            np.testing.assert_array_equal(XY_mask.points, [X[mask], Y[mask]])
+
+    def test_ClusterModel(self):
+
+        x = np.arange(20)
+        y = np.arange(15)
+        X, Y = np.meshgrid(x, y)
+        mask = make_mask(X, 8.0, 7.0, 6.0, 5.0)
+        XY_mask = GridXY.from_mask(mask)
+        data = np.random.RandomState(1).normal(size=mask.sum())
+        weights = np.ones(mask.sum()) * 2.0
+        prefixes = ["_one_", "_two_"]
+
+        for func in [pvoigt2d, pv_pv, pv_l, gaussian_lorentzian, voigt2d]:
+            with self.subTest(lineshape=func.__name__):
+                mod = ClusterModel(func, prefixes)
+                composite = Model(func, prefix="_one_") + Model(func, prefix="_two_")
+                self.assertEqual(mod.param_names, composite.param_names)
+                params = composite.make_params(
+                    _one_center_x=6.3,
+                    _one_center_y=7.1,
+                    _two_center_x=9.7,
+                    _two_center_y=6.2,
+                    _two_amplitude=3.0,
+                )
+                np.testing.assert_allclose(
+                    mod.eval(params, XY=XY_mask),
+                    composite.eval(params, XY=[X[mask], Y[mask]]),
+                )
+                np.testing.assert_allclose(
+                    mod.eval(params, XY=GridXY(x, y)), composite.eval(params, XY=[X, Y])
+                )
+                np.testing.assert_allclose(
+                    mod._residual(params, data, weights, XY=XY_mask),
+                    composite._residual(params, data, weights, XY=[X[mask], Y[mask]]),
+                )
+
+        single = ClusterModel(pvoigt2d, ["_one_"])
+        self.assertEqual(single.prefix, "_one_")
+
+    def test_fit_first_plane_window(self):
+
+        peaks = pd.DataFrame(
+            {
+                "ASS": ["one", "two"],
+                "X_AXISf": [60.2, 64.7],
+                "X_AXIS": [60, 65],
+                "Y_AXISf": [30.4, 31.6],
+                "Y_AXIS": [30, 32],
+                "XW": [3.0, 3.0],
+                "YW": [2.0, 2.0],
+                "X_RADIUS": [5.0, 5.0],
+                "Y_RADIUS": [4.0, 4.0],
+                "CLUSTID": [1, 1],
+            }
+        )
+        X, Y = np.meshgrid(np.arange(200), np.arange(80))
+        data = pvoigt2d([X, Y], 100.0, 60.2, 30.4, 1.5, 1.0, 0.5) + pvoigt2d(
+            [X, Y], 50.0, 64.7, 31.6, 1.5, 1.0, 0.5
+        )
+        result = fit_first_plane(peaks, data, uc_dics=None)
+        window_shape = (result.max_y - result.min_y, result.max_x - result.min_x)
+        for array in [result.mask, result.X, result.Y, result.Z, result.Z_sim]:
+            self.assertEqual(array.shape, window_shape)
+        self.assertEqual(data[result.window].shape, window_shape)
+        full_mask = make_mask(data, 60.2, 30.4, 5.0, 4.0) | make_mask(
+            data, 64.7, 31.6, 5.0, 4.0
+        )
+        np.testing.assert_array_equal(result.mask, full_mask[result.window])
+        np.testing.assert_allclose(result.out.params["_one_amplitude"], 100.0)
+        np.testing.assert_allclose(
+            result.Z_sim[result.mask], data[result.window][result.mask]
+        )
+
+    def test_fit_amplitudes(self):
+
+        x = np.arange(30)
+        y = np.arange(20)
+        X, Y = np.meshgrid(x, y)
+        mask = make_mask(X, 12.0, 10.0, 10.0, 7.0)
+        XY = GridXY.from_mask(mask)
+        mod = ClusterModel(pvoigt2d, ["_one_", "_two_"])
+        params = mod.make_params(
+            _one_center_x=10.2,
+            _one_center_y=9.1,
+            _two_center_x=14.6,
+            _two_center_y=10.8,
+        )
+        fix_params(params, ["fraction", "sigma", "center"])
+        self.assertTrue(only_amplitudes_vary(params))
+
+        basis = mod.amplitude_basis(params, XY)
+        noise = np.random.RandomState(0).normal(scale=0.01, size=(4, mask.sum()))
+        planes = basis @ np.array([[1.0, 2.0, 0.5, -0.1], [0.5, 0.2, 1.0, 0.3]])
+        planes = planes.T + noise
+        weights = np.ones(mask.sum()) * 100.0
+        plane_weights = np.array([1.0, 2.0, 0.5, 4.0])
+        result = fit_amplitudes(basis, planes, weights, plane_weights=plane_weights)
+
+        for num, plane in enumerate(planes):
+            out = mod.fit(
+                plane, params=params, XY=XY, weights=weights * plane_weights[num]
+            )
+            np.testing.assert_allclose(
+                result.amplitudes[num],
+                [out.params["_one_amplitude"], out.params["_two_amplitude"]],
+            )
+            np.testing.assert_allclose(
+                result.stderr[num],
+                [
+                    out.params["_one_amplitude"].stderr,
+                    out.params["_two_amplitude"].stderr,
+                ],
+                rtol=1e-4,
+            )
+            np.testing.assert_allclose(result.chisqr[num], out.chisqr)
+            np.testing.assert_allclose(result.redchi[num], out.redchi)
+            np.testing.assert_allclose(result.aic[num], out.aic)
+            np.testing.assert_allclose(
+                result.residual_sum[num], np.sum(out.residual), atol=1e-8
+            )
+
+        nnls = fit_amplitudes(basis, planes, weights, nnls=True)
+        self.assertTrue(np.all(nnls.amplitudes >= 0))
+        np.testing.assert_allclose(nnls.amplitudes[:3], result.amplitudes[:3])
+
+        params["_one_sigma_x"].vary = True
+        self.assertFalse(only_amplitudes_vary(params))
+
+    def test_fit_quality(self):
+
+        rng = np.random.RandomState(0)
+        data = rng.normal(size=(3, 50)) * 10.0
+        sim = data * np.array([[1.0], [0.9], [1.1]]) + rng.normal(size=(3, 50))
+        noise = np.array([1.0, 2.0, 0.5])
+        quality = fit_quality(data, sim, noise)
+        for num in range(3):
+            slope, intercept = np.polyfit(data[num], sim[num], 1)
+            residual = data[num] - sim[num]
+            rmsd = np.sqrt(np.mean(residual ** 2))
+            np.testing.assert_allclose(quality["slope"][num], slope)
+            np.testing.assert_allclose(quality["intercept"][num], intercept)
+            np.testing.assert_allclose(
+                quality["r_squared"][num],
+                1.0
+                - np.sum(residual ** 2) / np.sum((data[num] - data[num].mean()) ** 2),
+            )
+            np.testing.assert_allclose(quality["rmsd"][num], rmsd)
+            np.testing.assert_allclose(
+                quality["max_residual"][num], np.abs(residual).max()
+            )
+            np.testing.assert_allclose(
+                quality["residual_noise"][num], rmsd / noise[num]
+            )
+
+        # single plane and perfect fit
+        quality = fit_quality(data[0], data[0])
+        self.assertAlmostEqual(quality["slope"], 1.0)
+        self.assertAlmostEqual(quality["intercept"], 0.0)
+        self.assertAlmostEqual(quality["r_squared"], 1.0)
+        self.assertEqual(quality["rmsd"], 0.0)
+
+    def test_fit_global(self):
+
+        x = np.arange(30)
+        y = np.arange(20)
+        X, Y = np.meshgrid(x, y)
+        mask = make_mask(X, 12.0, 10.0, 10.0, 7.0)
+        XY = GridXY.from_mask(mask)
+        mod = ClusterModel(pv_pv, ["_one_", "_two_"])
+        true = mod.make_params(
+            _one_center_x=10.2,
+            _one_center_y=9.1,
+            _one_sigma_x=1.8,
+            _one_fraction_x=0.3,
+            _two_center_x=14.6,
+            _two_center_y=10.8,
+            _two_sigma_y=1.4,
+            _two_fraction_y=0.7,
+        )
+        t = np.array([0.0, 0.1, 0.2, 0.4, 0.8])
+        amps = np.array([[100.0], [60.0]]) * np.exp(-np.outer([2.0, 0.5], t))
+        planes = (mod.amplitude_basis(true, XY) @ amps).T
+        planes += np.random.RandomState(0).normal(scale=1e-4, size=planes.shape)
+        weights = np.ones(mask.sum()) * 1e3
+
+        start = true.copy()
+        for k, v in start.items():
+            if not k.endswith("amplitude"):
+                v.value *= 1.05
+        start["_one_sigma_x"].min = 0.0
+
+        result = fit_global(mod, start, XY, planes, weights)
+        self.assertTrue(result.success)
+        for k in true:
+            if not k.endswith("amplitude"):
+                # within a few standard errors of the true value
+                self.assertLess(
+                    abs(result.params[k].value - true[k].value),
+                    5 * result.params[k].stderr,
+                )
+        np.testing.assert_allclose(result.amplitudes, amps.T, rtol=1e-3)
+        self.assertEqual(result.chisqr.shape, (len(t),))
+
+        decay = fit_global(mod, start, XY, planes, weights, decay_times=t)
+        np.testing.assert_allclose(decay.rates, [2.0, 0.5], rtol=1e-3)
+        np.testing.assert_allclose(decay.amp0, [100.0, 60.0], rtol=1e-3)
+        np.testing.assert_allclose(decay.amplitudes, amps.T, rtol=1e-3)
+        self.assertTrue(np.all(decay.rate_err > 0))
+        # errors of amp0 and rate are propagated to the amplitudes
+        np.testing.assert_allclose(
+            decay.stderr,
+            np.abs(decay.amplitudes)
+            * np.sqrt(
+                (decay.amp0_err / decay.amp0) ** 2 + np.outer(t, decay.rate_err) ** 2
+            ),
+        )
+
+    def test_fit_direct(self):
+
+        x = np.arange(30)
+        y = np.arange(20)
+        X, Y = np.meshgrid(x, y)
+        mask = make_mask(X, 12.0, 10.0, 10.0, 7.0)
+        XY = GridXY.from_mask(mask)
+        mod = ClusterModel(pvoigt2d, ["_one_", "_two_"])
+        true = mod.make_params(
+            _one_amplitude=100.0,
+            _one_center_x=10.2,
+            _one_center_y=9.1,
+            _two_amplitude=60.0,
+            _two_center_x=14.6,
+            _two_center_y=10.8,
+            _two_sigma_x=1.4,
+            _two_fraction=0.2,
+        )
+        data = mod.eval(true, XY=XY)
+        data += np.random.RandomState(0).normal(scale=0.01, size=data.shape)
+        weights = np.ones_like(data) * 100.0
+
+        start = true.copy()
+        for k, v in start.items():
+            v.value *= 1.05
+            if "fraction" in k:
+                v.min, v.max = 0.0, 1.0
+        ref = mod.fit(data, params=start.copy(), XY=XY, weights=weights)
+        out = fit_direct(mod, data, start.copy(), XY, weights)
+        self.assertTrue(out.success)
+        np.testing.assert_allclose(out.chisqr, ref.chisqr, rtol=1e-6)
+        np.testing.assert_allclose(out.redchi, ref.redchi, rtol=1e-6)
+        np.testing.assert_allclose(out.aic, ref.aic, rtol=1e-6)
+        np.testing.assert_allclose(out.residual, ref.residual, atol=1e-4)
+        for k in true:
+            np.testing.assert_allclose(out.params[k], ref.params[k], rtol=1e-5)
+            np.testing.assert_allclose(
+                out.params[k].stderr, ref.params[k].stderr, rtol=1e-3
+            )
+
+        # refit with fixed shapes as done for each plane
+        fix_params(out.params, ["sigma", "center", "fraction"])
+        out.fit(data=data * 0.5, params=out.params, weights=weights)
+        np.testing.assert_allclose(
+            out.params["_one_amplitude"], ref.params["_one_amplitude"] * 0.5, rtol=1e-3
+        )
+        self.assertIn("_two_amplitude", out.fit_report())
+
+    def test_fit_cache(self):
+        peaks = pd.DataFrame({"X_AXIS": [5, 9], "Y_AXIS": [6, 7], "ASS": ["a", "b"]})
+        data = np.arange(12.0).reshape(3, 4)
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = FitCache(tmp, max_size=0)
+            key = cache.key(peaks, data, "PV", [0.1, 0.2], None)
+            # same inputs give same key
+            self.assertEqual(
+                key, cache.key(peaks.copy(), data.copy(), "PV", [0.1, 0.2], None)
+            )
+            # any change gives a new key
+            self.assertNotEqual(
+                key, cache.key(peaks, data + 1e-12, "PV", [0.1, 0.2], None)
+            )
+            self.assertNotEqual(key, cache.key(peaks, data, "V", [0.1, 0.2], None))
+            moved = peaks.assign(X_AXIS=[5, 10])
+            self.assertNotEqual(key, cache.key(moved, data, "PV", [0.1, 0.2], None))
+
+            self.assertIsNone(cache.get(key))
+            cache.put(key, ({"amp": [1.0, 2.0]}, "log"))
+            self.assertEqual(cache.get(key), ({"amp": [1.0, 2.0]}, "log"))
+            other = cache.key("other")
+            cache.put(other, "value")
+            # make key the least recently used entry
+            os.utime(os.path.join(tmp, f"{key}.pkl"), (0, 0))
+            cache.max_size = os.path.getsize(os.path.join(tmp, f"{other}.pkl"))
+            cache.evict()
+            self.assertIsNone(cache.get(key))
+            self.assertEqual(cache.get(other), "value")
+
+    def test_make_jacobian(self):
+
+        peaks = pd.DataFrame(
+            {
+                "ASS": ["one", "two"],
+                "X_AXISf": [5.0, 9.0],
+                "X_AXIS": [5, 9],
+                "Y_AXISf": [6.0, 7.0],
+                "Y_AXIS": [6, 7],
+                "XW": [2.5, 2.5],
+                "YW": [2.5, 2.5],
+            }
+        )
+        data = np.ones((15, 15))
+        mod, params = make_models(pvoigt2d, peaks, data, "PV")
+        params["_two_sigma_x"].vary = False
+        x, y = np.meshgrid(np.arange(15), np.arange(15))
+        XY = np.array([x.ravel(), y.ravel()])
+        weights = np.ones(x.size) * 0.5
+        jac = make_jacobian(mod)(params, data.ravel(), weights, XY=XY)
+        var_names = [k for k, p in params.items() if p.vary]
+        self.assertEqual(jac.shape, (len(var_names), x.size))
+        # compare with finite difference of lmfit residual
+        step = 1e-6
+        for row, name in zip(jac, var_names):
+            up, down = params.copy(), params.copy()
+            up[name].value += step
+            down[name].value -= step
+            numeric = (
+                mod._residual(up, data.ravel(), weights, XY=XY)
+                - mod._residual(down, data.ravel(), weights, XY=XY)
+            ) / (2 * step)
+            np.testing.assert_allclose(row, numeric, rtol=1e-4, atol=1e-6)
+
     def test_Pseudo3D(self):
 
         datasets = [
@@ -224,8 +765,75 @@ class TestCoreFunctions(unittest.TestCase):
                 self.assertEqual(pseudo3D.dims, dims)
                 self.assertEqual(pseudo3D.f1_size, 256)
                 self.assertEqual(pseudo3D.f2_size, 546)
+                # vectorized conversions agree with nmrglue unit conversion
+                for axis, uc, pt_per_hz in [
+                    (pseudo3D.axis_f1, pseudo3D.uc_f1, pseudo3D.pt_per_hz_f1),
+                    (pseudo3D.axis_f2, pseudo3D.uc_f2, pseudo3D.pt_per_hz_f2),
+                ]:
+                    pts = np.array([0.0, 10.4, 100.5, axis.size - 1.0])
+                    ppm = np.array([uc.ppm(i) for i in pts])
+                    np.testing.assert_allclose(axis.ppm(pts), ppm)
+                    np.testing.assert_allclose(axis.pts(ppm), pts, atol=1e-9)
+                    self.assertEqual(list(axis.index(ppm)), [uc(i, "ppm") for i in ppm])
+                    np.testing.assert_allclose(axis.hz_to_pts(20.0), 20.0 * pt_per_hz)
             test_nu += 1
 
+    def test_read_pipe(self):
+
+        datasets = [
+            ("test/test_protein_L/test1.ft2", [0, 1, 2]),
+            ("test/test_protein_L/test_tp.ft2", [2, 1, 0]),
+            ("test/test_protein_L/test_tp2.ft2", [1, 2, 0]),
+        ]
+        for dataset, dims in datasets:
+            with self.subTest(dataset=dataset):
+                dic, data = read_pipe(dataset)
+                _, expected = ng.pipe.read(dataset)
+                self.assertIsInstance(data, np.memmap)
+                np.testing.assert_array_equal(data, expected)
+
+                planes = Pseudo3D(dic, data, dims).data
+                expected = np.transpose(expected, dims)
+                self.assertTrue(planes.mapped)
+                np.testing.assert_array_equal(planes[2], expected[2])
+                np.testing.assert_array_equal(planes.sum(axis=0), expected.sum(axis=0))
+                # selections are also Planes and pickle without the data
+                selected = planes[[False, True, False, True]]
+                self.assertEqual(list(selected.planes), [1, 3])
+                self.assertLess(len(pickle.dumps(selected)), 1000)
+                selected = pickle.loads(pickle.dumps(selected))
+                np.testing.assert_array_equal(np.asarray(selected), expected[[1, 3]])
+                np.testing.assert_array_equal(
+                    selected[:, 10:20, 5:8], expected[[1, 3], 10:20, 5:8]
+                )
+
+    def test_read_pipe_planes(self):
+        dic, data = ng.pipe.read("test/test_protein_L/test1.ft2")
+        dic["FDDIMCOUNT"] = 2.0
+        dic["FDPIPEFLAG"] = 0.0
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for num, plane in enumerate(data, start=1):
+                ng.pipe.write(os.path.join(tmpdir, f"test{num:03d}.ft2"), dic, plane)
+
+            for path in [os.path.join(tmpdir, "test%03d.ft2"), tmpdir]:
+                with self.subTest(path=path):
+                    plane_dic, planes = read_pipe(path)
+                    self.assertIsInstance(planes, PlaneFiles)
+                    self.assertEqual(planes.shape, data.shape)
+                    pseudo3D = Pseudo3D(plane_dic, planes, [0, 2, 1])
+                    expected = np.transpose(data, [0, 2, 1])
+                    self.assertTrue(pseudo3D.data.mapped)
+                    self.assertEqual(pseudo3D.f1_label, "HN")
+                    np.testing.assert_array_equal(pseudo3D.data[1], expected[1])
+                    np.testing.assert_array_equal(np.asarray(pseudo3D.data), expected)
+                    selected = pickle.loads(pickle.dumps(pseudo3D.data[1:3]))
+                    np.testing.assert_array_equal(
+                        selected.sum(axis=0), expected[1:3].sum(axis=0)
+                    )
+
+            with self.assertRaises(FileNotFoundError):
+                read_pipe(os.path.join(tmpdir, "missing%03d.ft2"))
+
 
 # test for read, edit, fit, check and spec scripts
 # need to actually write proper tests
@@ -252,6 +860,203 @@ class TestFitScript(unittest.TestCase):
         fit = MockFit(args)
         self.assertIsNotNone(fit)
 
+    def test_schedule_clusters(self):
+        peaks = pd.DataFrame(
+            {
+                "CLUSTID": [1, 2, 2, 2, 3, 4, 5, 6, 7, 8],
+                "X_RADIUS": [3.0] * 10,
+                "Y_RADIUS": [2.0] * 10,
+            }
+        )
+        costs = peakipy.commandline.fit.cluster_costs(peaks, n_planes=5)
+        self.assertEqual(costs.idxmax(), 2)
+        tasks = peakipy.commandline.fit.schedule_clusters(peaks, 5, n_workers=2)
+        # largest cluster is dispatched first on its own
+        self.assertEqual(tasks[0], [2])
+        # every cluster is scheduled exactly once
+        self.assertEqual(sorted(sum(tasks, [])), list(range(1, 9)))
+        # singlets are batched
+        self.assertLess(len(tasks), 8)
+
+    def test_Spool(self):
+        peaks = pd.DataFrame({"CLUSTID": [1, 2, 2, 3]})
+        data = np.ones((2, 5, 4))
+        fit_input = peakipy.commandline.fit.FitPeaksInput(
+            {"noise": 1.0}, data, {}, [0, 1]
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            spool = peakipy.commandline.fit.Spool(tmp)
+            spool.open(peaks, fit_input, [[2], [1, 3]])
+            run_id = spool.run_id()
+            claimed, task = spool.claim()
+            self.assertEqual(task, (run_id, 0, [2]))
+            # a task can only be claimed once
+            other_claimed, other_task = spool.claim()
+            self.assertEqual(other_task, (run_id, 1, [1, 3]))
+            self.assertIsNone(spool.claim())
+            self.assertFalse(spool.pending())
+
+            loaded_run_id, loaded_peaks, loaded_input = spool.load_input()
+            self.assertEqual(loaded_run_id, run_id)
+            pd.testing.assert_frame_equal(loaded_peaks, peaks)
+            self.assertIsInstance(loaded_input.data, np.memmap)
+            np.testing.assert_array_equal(loaded_input.summed_planes, data.sum(axis=0))
+
+            # claims that are not renewed expire and are requeued
+            self.assertEqual(spool.requeue(), 0)
+            os.utime(claimed, (0, 0))
+            self.assertEqual(spool.requeue(), 1)
+            self.assertTrue(spool.pending())
+            requeued, task = spool.claim()
+            self.assertEqual(task, (run_id, 0, [2]))
+
+            spool.finish(other_claimed, 1, "second")
+            # the worker of the expired claim may still finish it
+            spool.finish(claimed, 0, "first")
+            self.assertEqual(list(spool.collect()), ["first", "second"])
+            # results are removed once collected (and only collected once)
+            spool.finish(requeued, 0, "first again")
+            self.assertEqual(list(spool.collect()), [])
+            self.assertEqual(spool.failures(), [])
+            spool.close()
+            self.assertIsNone(spool.run_id())
+
+    def test_iter_spool_with_failed_task(self):
+        class FailedSpool(peakipy.commandline.fit.Spool):
+            def failures(self):
+                return ["Traceback"]
+
+        peaks = pd.DataFrame({"CLUSTID": [1]})
+        fit_input = peakipy.commandline.fit.FitPeaksInput(
+            {"noise": 1.0}, np.ones((2, 5, 4)), {}, [0, 1]
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            spool = FailedSpool(tmp)
+            results = peakipy.commandline.fit.iter_spool(spool, peaks, fit_input, [[1]])
+            with self.assertRaisesRegex(
+                peakipy.commandline.fit.SpoolError, "Traceback"
+            ):
+                next(results)
+            # the run is closed
+            self.assertIsNone(spool.run_id())
+
+    def test_ResultWriter(self):
+        batch = pd.DataFrame({"clustid": [1, 1], "amp": [1.0, 2.0]})
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "fits.csv")
+            writer = peakipy.commandline.fit.ResultWriter(output)
+            writer.write(batch)
+            # finished batches are readable before the run completes
+            partial = pd.read_csv(output + ".part")
+            pd.testing.assert_frame_equal(partial, batch)
+            writer.write(batch.assign(clustid=2)[["amp", "clustid"]])
+            writer.close()
+            self.assertFalse(os.path.exists(output + ".part"))
+            df = pd.read_csv(output)
+            self.assertEqual(list(df.columns), ["clustid", "amp"])
+            self.assertEqual(list(df.clustid), [1, 1, 2, 2])
+
+            # aborted output stays in <output>.part
+            output = os.path.join(tmp, "aborted.csv")
+            writer = peakipy.commandline.fit.ResultWriter(output)
+            writer.write(batch)
+            writer.abort()
+            self.assertFalse(os.path.exists(output))
+            pd.testing.assert_frame_equal(pd.read_csv(output + ".part"), batch)
+
+    def test_write_table(self):
+        df = pd.DataFrame(
+            {
+                "assignment": ["A1N-H", "G2N-H", "A1N-H"],
+                "clustid": [1, 2, 1],
+                "amp": [1.0, 2.5, 3.0],
+            }
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            for suffix in [".csv", ".tab", ".pkl", ".npz"]:
+                path = os.path.join(tmp, "fits" + suffix)
+                write_table(df, path)
+                pd.testing.assert_frame_equal(read_table(path), df)
+                # only requested columns that exist are loaded
+                projected = read_table(
+                    path, columns=["amp", "assignment", "missing"], categories=True
+                )
+                self.assertEqual(list(projected.columns), ["assignment", "amp"])
+            # binary formats store strings as categories
+            self.assertEqual(projected.assignment.dtype.name, "category")
+            # missing optional packages raise an ImportError with an install hint
+            with patch("importlib.import_module", side_effect=ImportError):
+                with self.assertRaisesRegex(ImportError, "pip install tables"):
+                    write_table(df, os.path.join(tmp, "fits.h5"))
+                with self.assertRaisesRegex(ImportError, "pip install pyarrow"):
+                    peakipy.commandline.fit.ResultWriter(
+                        os.path.join(tmp, "fits.feather")
+                    )
+
+    def test_ResultWriter_parquet(self):
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+        batch = pd.DataFrame({"clustid": [1, 1], "lineshape": ["PV", "PV"]})
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "fits.parquet")
+            writer = peakipy.commandline.fit.ResultWriter(output, row_group_size=2)
+            writer.write(batch)
+            writer.write(batch.assign(clustid=2, lineshape="G"))
+            writer.close()
+            df = read_table(output)
+            self.assertEqual(list(df.clustid), [1, 1, 2, 2])
+            self.assertEqual(list(df.lineshape), ["PV", "PV", "G", "G"])
+
+    def test_Journal(self):
+        fit = peakipy.commandline.fit
+        first = fit.FitPeaksResult(pd.DataFrame({"clustid": [1]}), "one")
+        second = fit.FitPeaksResult(pd.DataFrame({"clustid": [2]}), "two")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "fits.csv.journal")
+            journal = fit.Journal(path, "key")
+            self.assertIsNone(journal.resume())
+            journal.start()
+            journal.append(first)
+            journal.append(second)
+            journal._file.close()
+            # simulate crash while writing the last record
+            with open(path, "r+b") as f:
+                f.truncate(os.path.getsize(path) - 3)
+            # inputs changed
+            self.assertIsNone(fit.Journal(path, "other key").resume())
+
+            journal = fit.Journal(path, "key")
+            results = journal.resume()
+            self.assertEqual([i.log for i in results], ["one"])
+            journal.append(second)
+            journal._file.close()
+            results = fit.Journal(path, "key").resume()
+            self.assertEqual([i.log for i in results], ["one", "two"])
+
+    def test_SharedArray(self):
+        self.check_SharedArray()
+        # memory mapped temporary files are used without shared_memory
+        with patch("peakipy.commandline.fit.shared_memory", None):
+            self.check_SharedArray()
+
+    def check_SharedArray(self):
+        data = np.random.RandomState(0).normal(size=(3, 8, 6))
+        shared = peakipy.commandline.fit.SharedArray(data)
+        try:
+            # unpickling attaches to the same block instead of copying
+            attached = pickle.loads(pickle.dumps(shared))
+            np.testing.assert_array_equal(attached.array, data)
+            self.assertLess(len(pickle.dumps(shared)), data.nbytes)
+            self.assertFalse(attached.array.flags.writeable)
+            fit_input = peakipy.commandline.fit.FitPeaksInput(
+                {}, attached, {}, [0, 1, 2]
+            )
+            np.testing.assert_allclose(fit_input.summed_planes, data.sum(axis=0))
+        finally:
+            shared.unlink()
+
 
 class TestReadScript(unittest.TestCase):
     @patch("peakipy.commandline.read")